@@ -0,0 +1,4 @@
+"""
+Benchmarks of the txfeature build_db pipeline, see suite for the benchmark suite and synthetic for the generator of its
+input data. Run from the repository root, ex. python -m benchmarks.suite
+"""
@@ -0,0 +1,65 @@
+"""
+Benchmark of the transcript feature lookup performed during assembly. Compares the previous approach of rescanning
+(and re-parsing) every gff line of the parent gene for each transcript against the transcript index built by
+gff_parser.gff_table.
+
+usage: python benchmarks/assembly_lookup.py [gff_file] [repeats]
+"""
+
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from txfeature.db_builder import gff_parser, txfeat_functions  # noqa: E402
+from txfeature.db_builder.tx_classes import GffReadEntry  # noqa: E402
+
+default_gff = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                           'tests', 'test_data', 'test_set.gff3')
+
+
+def rescan_lookup(gff_file):
+    """Previous approach: raw lines stored per gene, every line re-parsed for each transcript of the gene."""
+    table = {}
+    tx_attr = {}
+    for gff_line in csv.reader(open(gff_file, 'r'), delimiter='\t'):
+        if gff_line[0][0] == '#':
+            continue
+        attr = dict(item.split('=') for item in gff_line[8].split(';'))
+        if gff_line[2] == 'transcript':
+            tx_attr[attr['transcript_id']] = attr['gene_id']
+        table.setdefault(attr['gene_id'], []).append(gff_line)
+
+    for tx, gene in tx_attr.items():
+        tx_features = {}
+        for item in table[gene]:
+            entry = GffReadEntry(item)
+            if entry.transcript_id == tx and entry.entry_type in txfeat_functions.tx_feature_types:
+                tx_features.setdefault(entry.entry_type, []).append(entry)
+
+
+def index_lookup(gff_file):
+    """Current approach: transcript index built while parsing, features grouped by type and exon number."""
+    gff_df = gff_parser.gff_table(gff_file)
+    for tx in gff_df['tx_attr']:
+        txfeat_functions.annot_coords(txfeat_functions.tx2gff_lookup(gff_df, tx))
+
+
+def timed(func, gff_file, repeats):
+    initial_time = time.time()
+    for _ in range(repeats):
+        func(gff_file)
+    return (time.time() - initial_time) / repeats
+
+
+if __name__ == '__main__':
+    gff = sys.argv[1] if len(sys.argv) > 1 else default_gff
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rescan_time = timed(rescan_lookup, gff, n)
+    index_time = timed(index_lookup, gff, n)
+    print('gff: %s (%i repeats)' % (gff, n))
+    print('rescan lookup:\t%.3f ms' % (rescan_time * 1000))
+    print('index lookup:\t%.3f ms' % (index_time * 1000))
+    print('speedup:\t%.1fx' % (rescan_time / index_time))
@@ -0,0 +1,366 @@
+"""
+Benchmark suite of the build_db pipeline. Input is a synthetic genome and annotation (see synthetic) of a chosen size,
+so the suite runs anywhere from the size of tests/test_data to genome scale without downloading a reference. Folding
+uses the stub engine (see stub_fold) unless another engine is selected, so ViennaRNA is not needed.
+
+Two groups of benchmarks are timed:
+    micro   - gff_parser.gff_table, tx2gff_lookup / annot_coords, tx_build.build, TxRead.get_sequence of the mRNA
+              regions and the gc_content, au_element and kozac_score sequence properties over all transcripts
+    build   - build_db runs end to end in batch and stream mode, timed per stage from the markers of the build log
+
+Every run also times a fixed reference workload that does not use the package, so timings of different machines
+or of a busy machine can be compared relative to it. Results are written as JSON and, only if --baseline is given,
+compared against a baseline of the same scale (e.g. benchmarks/baseline.json). Times are normalised by the reference
+workload of each run before comparing, benchmarks slower than the baseline by more than the tolerance are reported
+as regressions and the suite exits with status 1. --save-baseline writes the results to the baseline file.
+
+usage: python -m benchmarks.suite [--preset name | --transcripts N] [--out results.json]
+                                  [--baseline benchmarks/baseline.json] [--save-baseline]
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmarks import synthetic  # noqa: E402
+from txfeature import env_variables, version  # noqa: E402
+from txfeature.db_builder import gff_parser, packed_seq, tx_build, txfeat_functions  # noqa: E402
+from txfeature.db_builder import txseq_properties as tp  # noqa: E402
+from txfeature.db_builder import txseq_batch as tb  # noqa: E402
+from txfeature.db_builder.fasta_index import IndexedFasta  # noqa: E402
+from txfeature.db_builder.tx_classes import TxRead  # noqa: E402
+
+default_baseline = os.path.join(repo_dir, 'benchmarks', 'baseline.json')
+default_work_dir = os.path.join(tempfile.gettempdir(), 'txfeature_benchmarks')
+
+build_modes = ['batch', 'stream']
+mrna_regions = ['five_prime_UTR', 'CDS', 'three_prime_UTR']
+
+# build log messages starting each stage, a stage ends with the next marker or the completion message
+stage_markers = [('Parsing gene annotation file...', 'parse_gff'),
+                 ('Indexing transcript regions...', 'region_index'),
+                 ('Starting assembly of transcripts...', 'assembly'),
+                 ('Starting streaming assembly and feature aggregation...', 'stream'),
+                 ('Saving assembly store...', 'assembly_store'),
+                 ('Dividing data into manageable chunks...', 'chunking'),
+                 ('Computing sequence features and collecting fold requests...', 'sequences'),
+                 ('Folding distinct region sequences...', 'folding'),
+                 ('Aggregating features for transcripts...', 'features'),
+                 ('Saving txfeat_db to output directory...', 'save'),
+                 ('Indexing txfeat_db...', 'db_index')]
+end_marker = 'It took '
+
+# runs build_db in a fresh interpreter with the stub engine registered before the workers are started
+_build_code = ('import sys; from benchmarks import stub_fold; stub_fold.register(); '
+               'from txfeature.db_builder import db_builder; sys.argv[0] = "build_db"; db_builder.main()')
+
+
+def measure(func, repeats, setup=None):
+    """
+    Times repeated calls of a function.
+    :param func: function to time, called with the return value of setup if given
+    :param repeats: number of timed calls
+    :param setup: untimed function run before each call
+    :return: dict with the best ('seconds') and the median time of the calls
+    """
+    times = []
+    for _ in range(repeats):
+        arg = setup() if setup is not None else None
+        initial_time = time.perf_counter()
+        if setup is not None:
+            func(arg)
+        else:
+            func()
+        times.append(time.perf_counter() - initial_time)
+    return {'seconds': min(times), 'median': statistics.median(times)}
+
+
+def reference_workload():
+    """Fixed pure Python work of sorting, hashing and string building, independent of the package and the data."""
+    values = [(i * 2654435761) % 1000003 for i in range(100000)]
+    values.sort()
+    counts = {}
+    for value in values:
+        counts[value % 997] = counts.get(value % 997, 0) + 1
+    return len(''.join(str(value) for value in values[::7])) + len(counts)
+
+
+def micro_benchmarks(data, repeats):
+    """
+    Times the per transcript steps of the pipeline on the synthetic data.
+    :param data: summary of the synthetic data as returned by synthetic.generate
+    :param repeats: number of timed runs of each benchmark
+    :return: dict of benchmark name -> result
+    """
+    results = {}
+    gff_df = gff_parser.gff_table(data['gff'])
+    tx_ids = sorted(gff_df['tx_attr'])
+    results['gff_table'] = measure(lambda: gff_parser.gff_table(data['gff']), repeats)
+    results['gff_table']['items'] = gff_df['num_lines']
+
+    def lookup():
+        return {tx: txfeat_functions.annot_coords(txfeat_functions.tx2gff_lookup(gff_df, tx)) for tx in tx_ids}
+    tx_annots = lookup()
+    results['tx2gff_lookup'] = measure(lookup, repeats)
+
+    with IndexedFasta(data['fasta']) as fasta:
+        def build():
+            return [tx_build.build(tx, tx_annots[tx], gff_df['tx_attr'][tx], fasta) for tx in tx_ids]
+        transcripts = build()
+        results['tx_build.build'] = measure(build, repeats)
+
+    # TxRead caches region indices, every run gets fresh TxReads
+    def new_reads():
+        return [TxRead(transcript) for transcript in transcripts]
+
+    def region_sequences(tx_reads):
+        return [tx_read.get_sequence('mrna_region', region) for tx_read in tx_reads for region in mrna_regions
+                if tx_read.tx_status[region] == 'defined']
+    sequences = region_sequences(new_reads())
+    results['TxRead.get_sequence'] = measure(region_sequences, repeats, new_reads)
+    results['TxRead.get_sequence']['items'] = len(sequences)
+
+    results['gc_content'] = measure(lambda: [tp.gc_content(seq) for seq in sequences], repeats)
+    results['gc_content']['items'] = len(sequences)
+    results['gc_content.batch'] = measure(lambda: tb.gc_content(tb.encode(sequences)), repeats)
+    results['gc_content.batch']['items'] = len(sequences)
+    # all sequences packed into one buffer, counted per packed byte in one pass
+    packed = packed_seq.PackedBatch.pack(sequences)
+    results['gc_content.packed'] = measure(packed.gc_content, repeats)
+    results['gc_content.packed']['items'] = len(sequences)
+    results['au_element'] = measure(lambda: [tp.au_element(seq) for seq in sequences], repeats)
+    results['au_element']['items'] = len(sequences)
+    results['kozac_score'] = measure(lambda tx_reads: [tp.kozac_score(tx_read) for tx_read in tx_reads], repeats,
+                                     new_reads)
+    for name in ['tx2gff_lookup', 'tx_build.build', 'kozac_score']:
+        results[name]['items'] = len(tx_ids)
+    return results
+
+
+def stub_config(path, engine):
+    """Writes a copy of the default build_db.cfg using the given fold engine and no fold cache."""
+    options = {'fold_engine': engine, 'fold_cache': ''}
+    with open(env_variables.db_builder_path + 'build_db.cfg', 'r') as default, open(path, 'w') as config:
+        for line in default:
+            key = line.split('=')[0]
+            config.write('%s=%s\n' % (key, options[key]) if key in options else line)
+
+
+def stage_times(log_path):
+    """
+    Durations of the build stages from the markers of a build log.
+    :return: dict of stage name -> seconds, 'total' from the first to the last line
+    """
+    times = []
+    with open(log_path, 'r') as log:
+        for line in log:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            try:
+                line_time = datetime.datetime.strptime(fields[0], '%Y-%m-%d %H:%M:%S,%f')
+            except ValueError:
+                continue
+            times.append((line_time, fields[2]))
+    stages = {}
+    current = None
+    for line_time, message in times:
+        stage = [name for marker, name in stage_markers if message.startswith(marker)]
+        if stage or message.startswith(end_marker):
+            if current is not None:
+                stages[current[0]] = stages.get(current[0], 0) + (line_time - current[1]).total_seconds()
+            current = (stage[0], line_time) if stage else None
+    if times:
+        stages['total'] = (times[-1][0] - times[0][0]).total_seconds()
+    return stages
+
+
+def run_build(data, mode, threads, work_dir, engine):
+    """
+    Runs build_db end to end on the synthetic data.
+    :param mode: 'batch' or 'stream'
+    :return: dict of stage name -> seconds, 'wall' including the start of the interpreter
+    """
+    out_dir = os.path.join(work_dir, 'build_%s' % mode)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    config_path = os.path.join(work_dir, 'build_%s.cfg' % engine)
+    stub_config(config_path, engine)
+    command = [sys.executable, '-c', _build_code, '-gff', data['gff'], '-fa', data['fasta'], '-out', out_dir,
+               '-t', str(threads), '-c', config_path, '-s']
+    if mode == 'stream':
+        command.append('--stream')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    initial_time = time.perf_counter()
+    completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    wall = time.perf_counter() - initial_time
+    if completed.returncode != 0:
+        raise RuntimeError('build_db %s mode failed (exit status %i):\n%s'
+                           % (mode, completed.returncode, completed.stdout[-2000:]))
+    log_paths = sorted(glob.glob(os.path.join(out_dir, 'log', 'txfeature.*.log')))
+    stages = stage_times(log_paths[-1])
+    stages['wall'] = wall
+    return stages
+
+
+def build_benchmarks(data, modes, threads, repeats, work_dir, engine):
+    """
+    Times build_db runs, the best run of each stage is kept.
+    :return: dict of benchmark name (build.<mode>.<stage>) -> result
+    """
+    results = {}
+    for mode in modes:
+        runs = [run_build(data, mode, threads, work_dir, engine) for _ in range(repeats)]
+        for stage in sorted(set().union(*runs)):
+            times = [run[stage] for run in runs if stage in run]
+            results['build.%s.%s' % (mode, stage)] = {'seconds': min(times), 'median': statistics.median(times),
+                                                      'items': data['transcripts']}
+    return results
+
+
+def scale(results):
+    """Settings of a run that must match for timings to be comparable."""
+    return {key: results[key] for key in ['transcripts', 'seed', 'threads', 'engine']}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Compares the best times of a run against a baseline. Baseline times are scaled by the ratio of the reference
+    workload of both runs, so a slower or busier machine does not report every benchmark as regression.
+    :param tolerance: allowed slow down as fraction of the scaled baseline time
+    :param min_seconds: differences below this are never regressions (timer noise of short benchmarks)
+    :return: list of report lines and list of names of regressed benchmarks
+    """
+    speed = results['reference']['seconds'] / baseline['reference']['seconds']
+    lines = ['reference workload %.4f s, baseline %.4f s, baseline times scaled by %.2f'
+             % (results['reference']['seconds'], baseline['reference']['seconds'], speed),
+             '%-36s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio')]
+    regressions = []
+    for name in sorted(results['benchmarks']):
+        current = results['benchmarks'][name]['seconds']
+        if name not in baseline['benchmarks']:
+            lines.append('%-36s %12s %12.4f %8s' % (name, '-', current, 'new'))
+            continue
+        previous = baseline['benchmarks'][name]['seconds'] * speed
+        ratio = current / previous if previous > 0 else float('inf') if current > 0 else 1.0
+        regressed = ratio > 1 + tolerance and current - previous > min_seconds
+        if regressed:
+            regressions.append(name)
+        lines.append('%-36s %12.4f %12.4f %8.2f%s' % (name, previous, current, ratio, '  REGRESSION' if regressed
+                                                       else ''))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the build_db pipeline on a synthetic genome.",
+                                     prog="python -m benchmarks.suite")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--preset", type=str, default='test_set_500', choices=sorted(synthetic.presets),
+                      metavar="<name>", help="size of the synthetic data, one of %s (default = test_set_500)"
+                                             % ', '.join(sorted(synthetic.presets)))
+    size.add_argument("--transcripts", type=int, default=None, metavar="<N>",
+                      help="number of synthetic transcripts instead of a preset")
+    parser.add_argument("--seed", type=int, default=0, metavar="", help="seed of the synthetic data (default = 0)")
+    parser.add_argument("--work-dir", type=str, default=default_work_dir, metavar="",
+                        help="directory of the synthetic data and build outputs (default = %s)" % default_work_dir)
+    parser.add_argument("-t", "--threads", type=int, default=2, metavar="",
+                        help="number of threads of the builds (default = 2)")
+    parser.add_argument("--repeats", type=int, default=5, metavar="",
+                        help="number of timed runs of each micro benchmark (default = 5)")
+    parser.add_argument("--build-repeats", type=int, default=3, metavar="",
+                        help="number of timed builds of each mode (default = 3)")
+    parser.add_argument("--modes", nargs='+', default=build_modes, choices=build_modes, metavar="",
+                        help="build modes to run end to end, batch and / or stream (default = both)")
+    parser.add_argument("--skip-build", action='store_true', help="only run the micro benchmarks")
+    parser.add_argument("--engine", type=str, default='stub', metavar="",
+                        help="fold engine of the builds, stub, cli or vienna (default = stub)")
+    parser.add_argument("--out", type=str, default=None, metavar="", help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, metavar="",
+                        help="baseline JSON file to compare against, e.g. benchmarks/baseline.json (default = none)")
+    parser.add_argument("--save-baseline", action='store_true',
+                        help="write the results to the baseline file (default = benchmarks/baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=0.25, metavar="",
+                        help="allowed slow down against the baseline after scaling by the reference workload as "
+                             "fraction (default = 0.25)")
+    parser.add_argument("--min-seconds", type=float, default=0.01, metavar="",
+                        help="smallest slow down in seconds reported as regression (default = 0.01)")
+    args = parser.parse_args()
+
+    num_transcripts = args.transcripts if args.transcripts is not None else synthetic.presets[args.preset]
+    data = synthetic.generate(os.path.join(args.work_dir, 'synthetic_%i_%i' % (num_transcripts, args.seed)),
+                              num_transcripts, args.seed)
+    print('Synthetic data: %i transcripts of %i genes on %i chromosomes (%i bases)'
+          % (data['transcripts'], data['genes'], data['chromosomes'], data['bases']))
+
+    results = {'version': version.__version__,
+               'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'transcripts': data['transcripts'],
+               'seed': data['seed'],
+               'threads': args.threads,
+               'engine': args.engine,
+               'repeats': args.repeats,
+               'benchmarks': {}}
+    print('Running reference workload...')
+    results['reference'] = measure(reference_workload, args.repeats)
+    print('Running micro benchmarks...')
+    results['benchmarks'].update(micro_benchmarks(data, args.repeats))
+    if not args.skip_build:
+        print('Running build_db end to end (%s)...' % ', '.join(args.modes))
+        results['benchmarks'].update(build_benchmarks(data, args.modes, args.threads, args.build_repeats,
+                                                      args.work_dir, args.engine))
+
+    baseline_path = args.baseline if args.baseline is not None else default_baseline
+    for path in [args.out, baseline_path if args.save_baseline else None]:
+        if path is not None:
+            with open(path, 'w') as results_json:
+                json.dump(results, results_json, indent=1, sort_keys=True)
+                results_json.write('\n')
+            print('Results written to %s' % path)
+
+    baseline = None
+    if args.baseline is not None and not args.save_baseline:
+        if not os.path.isfile(args.baseline):
+            sys.exit('Baseline %s does not exist, record one with --save-baseline' % args.baseline)
+        with open(args.baseline, 'r') as baseline_json:
+            baseline = json.load(baseline_json)
+    if baseline is None:
+        for name, result in sorted(results['benchmarks'].items()):
+            print('%-36s %12.4f' % (name, result['seconds']))
+    elif scale(baseline) != scale(results):
+        for name, result in sorted(results['benchmarks'].items()):
+            print('%-36s %12.4f' % (name, result['seconds']))
+        print('Baseline %s was recorded with %s, not compared against %s'
+              % (args.baseline, scale(baseline), scale(results)))
+    elif 'reference' not in baseline:
+        for name, result in sorted(results['benchmarks'].items()):
+            print('%-36s %12.4f' % (name, result['seconds']))
+        print('Baseline %s has no reference workload time, record it again with --save-baseline' % args.baseline)
+    else:
+        lines, regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        print('\n'.join(lines))
+        if regressions:
+            print('%i benchmarks regressed by more than %i%% against %s: %s'
+                  % (len(regressions), round(args.tolerance * 100), args.baseline, ', '.join(regressions)))
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Deterministic synthetic genome (FASTA) and GENCODE style annotation (GFF3) for the benchmarks. Genes of 1 to 10 exons
+are laid out along the chromosomes with 1 to 4 isoforms each that skip some of the gene's exons, so isoforms share
+exons as in real annotations. Most transcripts are protein coding with 5' UTR, CDS, start / stop codon and 3' UTR
+features, the others are lncRNA. The genome holds soft-masked runs and runs of N between genes. The same seed and size
+always produce the same files, from the size of tests/test_data to genome scale (see presets).
+
+usage: python -m benchmarks.synthetic <out_dir> [-transcripts N | -preset name] [-seed S]
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+# number of transcripts of the presets, test_set and test_set_500 match the size of the files in tests/test_data
+presets = {'test_set': 1, 'test_set_500': 500, 'chromosome': 20000, 'genome': 250000}
+
+summary_file = 'synthetic.json'
+
+_bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+_complement = {ord('A'): ord('T'), ord('C'): ord('G'), ord('G'): ord('C'), ord('T'): ord('A')}
+_stop_codons = [b'TAA', b'TAG', b'TGA']
+_line_length = 60
+
+
+def _tx_blocks(exons, strand, start, stop):
+    """
+    Genomic blocks of a range of transcript coordinates.
+    :param exons: list of (genomic start, genomic stop) of the transcript exons in transcript order, 1-based inclusive
+    :param start: 0-based transcript coordinate of the first base
+    :param stop: 0-based transcript coordinate after the last base
+    :return: list of (exon number, genomic start, genomic stop)
+    """
+    blocks = []
+    exon_start = 0
+    for exon_number, (g_start, g_stop) in enumerate(exons, 1):
+        exon_stop = exon_start + g_stop - g_start + 1
+        low = max(start, exon_start)
+        high = min(stop, exon_stop)
+        if low < high:
+            if strand == '+':
+                blocks.append((exon_number, g_start + low - exon_start, g_start + high - exon_start - 1))
+            else:
+                blocks.append((exon_number, g_stop - (high - exon_start) + 1, g_stop - (low - exon_start)))
+        exon_start = exon_stop
+    return blocks
+
+
+def _splits_codon(exons, position):
+    """True if the codon at a transcript coordinate crosses an exon boundary."""
+    boundary = 0
+    for g_start, g_stop in exons:
+        boundary += g_stop - g_start + 1
+        if position < boundary < position + 3:
+            return True
+    return False
+
+
+def _write_codon(chrom_seq, exons, strand, position, codon):
+    """Writes a codon in transcript orientation at a transcript coordinate into the chromosome sequence."""
+    for i, base in enumerate(codon):
+        (_, g_start, _), = _tx_blocks(exons, strand, position + i, position + i + 1)
+        chrom_seq[g_start - 1] = base if strand == '+' else _complement[base]
+
+
+def _attributes(values):
+    return ';'.join('%s=%s' % (tag, value) for tag, value in values)
+
+
+def _gene(rng, gene_number, chrom, position, num_transcripts, tx_number, chrom_seq, gff):
+    """
+    Lays out a gene starting at position and writes its transcripts to the gff file.
+    :return: (position after the gene, number of transcripts written)
+    """
+    num_exons = int(rng.integers(1, 11))
+    exon_lengths = rng.integers(60, 400, num_exons)
+    intron_lengths = rng.integers(80, 2000, num_exons)
+    gene_exons = []
+    for exon_length, intron_length in zip(exon_lengths.tolist(), intron_lengths.tolist()):
+        gene_exons.append((position, position + exon_length - 1))
+        position += exon_length + intron_length
+    strand = '+' if rng.random() < 0.5 else '-'
+    gene_id = 'SYNG%08i.1' % gene_number
+    gene_name = 'Syn%i' % gene_number
+    exon_ids = ['SYNE%08i.1' % (gene_number * 10 + i) for i in range(num_exons)]
+
+    num_isoforms = min(int(rng.integers(1, 5)), num_transcripts)
+    for isoform in range(num_isoforms):
+        # the first isoform holds all exons of the gene, the others skip some of them
+        used = np.ones(num_exons, dtype=bool) if isoform == 0 else rng.random(num_exons) < 0.75
+        if not used.any():
+            used[int(rng.integers(0, num_exons))] = True
+        exons = [exon for exon, is_used in zip(gene_exons, used.tolist()) if is_used]
+        exon_numbers = [i for i, is_used in enumerate(used.tolist()) if is_used]
+        if strand == '-':
+            exons = exons[::-1]
+            exon_numbers = exon_numbers[::-1]
+        length = sum(g_stop - g_start + 1 for g_start, g_stop in exons)
+
+        # coding structure in transcript coordinates, lncRNA if a codon would be split by an exon boundary
+        coding = length >= 30 and rng.random() < 0.7
+        if coding:
+            utr5 = int(rng.integers(0, min(300, length // 4) + 1))
+            cds = 3 * int(rng.integers(2, max(3, (length - utr5 - 3) // 3 + 1)))
+            coding = not _splits_codon(exons, utr5) and not _splits_codon(exons, utr5 + cds)
+        tx_type = 'protein_coding' if coding else 'lncRNA'
+
+        tx_id = 'SYNT%08i.1' % (tx_number + isoform)
+        tx_start = min(g_start for g_start, _ in exons)
+        tx_stop = max(g_stop for _, g_stop in exons)
+        common = [('gene_id', gene_id), ('transcript_id', tx_id), ('gene_type', 'protein_coding'),
+                  ('gene_name', gene_name), ('transcript_type', tx_type),
+                  ('transcript_name', '%s-%i' % (gene_name, 201 + isoform)), ('level', 2)]
+        if coding:
+            common.append(('protein_id', 'SYNP%08i.1' % (tx_number + isoform)))
+        lines = [(tx_start, tx_stop, 'transcript', '.', _attributes([('ID', tx_id), ('Parent', gene_id)] + common))]
+
+        def features(feature_type, start, stop, phased=False):
+            done = 0
+            for exon_number, g_start, g_stop in _tx_blocks(exons, strand, start, stop):
+                phase = (3 - done % 3) % 3 if phased else '.'
+                done += g_stop - g_start + 1
+                attributes = [('ID', '%s:%s' % (feature_type, tx_id)), ('Parent', tx_id)] + common + \
+                    [('exon_number', exon_number), ('exon_id', exon_ids[exon_numbers[exon_number - 1]])]
+                lines.append((g_start, g_stop, feature_type, phase, _attributes(attributes)))
+
+        features('exon', 0, length)
+        if coding:
+            if utr5 > 0:
+                features('five_prime_UTR', 0, utr5)
+            features('CDS', utr5, utr5 + cds, phased=True)
+            features('start_codon', utr5, utr5 + 3, phased=True)
+            features('stop_codon', utr5 + cds, utr5 + cds + 3, phased=True)
+            if utr5 + cds + 3 < length:
+                features('three_prime_UTR', utr5 + cds + 3, length)
+            _write_codon(chrom_seq, exons, strand, utr5, b'ATG')
+            _write_codon(chrom_seq, exons, strand, utr5 + cds, _stop_codons[int(rng.integers(0, 3))])
+        for start, stop, feature_type, phase, attributes in lines:
+            gff.write('%s\tSYNTHETIC\t%s\t%i\t%i\t.\t%s\t%s\t%s\n'
+                      % (chrom, feature_type, start, stop, strand, phase, attributes))
+    return position, num_isoforms
+
+
+def generate(out_dir, num_transcripts, seed=0):
+    """
+    Writes genome.fa and annotation.gff3 to out_dir, files generated before with the same size and seed are reused.
+    :param out_dir: output directory
+    :param num_transcripts: number of annotated transcripts
+    :param seed: seed of the random generator
+    :return: dict with 'fasta', 'gff', 'transcripts', 'genes', 'chromosomes', 'bases' and 'seed'
+    """
+    fasta_path = os.path.join(out_dir, 'genome.fa')
+    gff_path = os.path.join(out_dir, 'annotation.gff3')
+    summary_path = os.path.join(out_dir, summary_file)
+    if os.path.isfile(summary_path):
+        with open(summary_path, 'r') as summary_json:
+            summary = json.load(summary_json)
+        if summary['transcripts'] == num_transcripts and summary['seed'] == seed and os.path.isfile(fasta_path) \
+                and os.path.isfile(gff_path):
+            return summary
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for path in [fasta_path + '.fai', summary_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    # chromosomes of about 10000 transcripts, at most 24
+    num_chroms = min(24, 1 + num_transcripts // 10000)
+    chrom_transcripts = [num_transcripts // num_chroms + (i < num_transcripts % num_chroms) for i in range(num_chroms)]
+    num_genes = 0
+    num_bases = 0
+    tx_number = 0
+    with open(fasta_path, 'wb') as fasta, open(gff_path, 'w') as gff:
+        gff.write('##gff-version 3\n')
+        for chrom_number, remaining in enumerate(chrom_transcripts, 1):
+            chrom = 'chr%i' % chrom_number
+            # the sequence is grown ahead of the genes so their codons can be written into it
+            chrom_seq = bytearray()
+            position = 1000
+            while remaining > 0:
+                gap = int(rng.integers(500, 5000))
+                position += gap
+                # room for the largest gene (10 exons of 400 and 10 introns of 2000 bases)
+                if len(chrom_seq) < position + 24000:
+                    chrom_seq.extend(_bases[rng.integers(0, 4, 1 << 20)].tobytes())
+                num_genes += 1
+                position, written = _gene(rng, num_genes, chrom, position, remaining, tx_number, chrom_seq, gff)
+                tx_number += written
+                remaining -= written
+            length = position + 1000
+            if len(chrom_seq) < length:
+                chrom_seq.extend(_bases[rng.integers(0, 4, length - len(chrom_seq))].tobytes())
+            del chrom_seq[length:]
+            _mask(rng, chrom_seq)
+
+            fasta.write(b'>%s\n' % chrom.encode())
+            for i in range(0, length, _line_length * 10000):
+                block = chrom_seq[i:i + _line_length * 10000]
+                fasta.write(b'\n'.join(block[j:j + _line_length] for j in range(0, len(block), _line_length)))
+                fasta.write(b'\n')
+            num_bases += length
+
+    summary = {'fasta': fasta_path, 'gff': gff_path, 'transcripts': tx_number, 'genes': num_genes,
+               'chromosomes': num_chroms, 'bases': num_bases, 'seed': seed}
+    with open(summary_path, 'w') as summary_json:
+        json.dump(summary, summary_json, indent=1)
+    return summary
+
+
+def _mask(rng, chrom_seq):
+    """Adds soft-masked (lower case) runs and runs of N to a chromosome sequence, the first 500 bases are N."""
+    length = len(chrom_seq)
+    chrom_seq[:500] = b'N' * 500
+    for start in rng.integers(500, length, length // 5000).tolist():
+        run = int(rng.integers(50, 500))
+        chrom_seq[start:start + run] = chrom_seq[start:start + run].lower()
+    for start in rng.integers(500, length, length // 100000).tolist():
+        run = int(rng.integers(10, 100))
+        chrom_seq[start:start + run] = b'N' * len(chrom_seq[start:start + run])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic genome and annotation for the benchmarks.",
+                                     prog="python -m benchmarks.synthetic")
+    parser.add_argument("out_dir", type=str, help="output directory")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("-transcripts", type=int, default=None, metavar="<N>", help="number of transcripts")
+    size.add_argument("-preset", type=str, default='test_set_500', choices=sorted(presets), metavar="<name>",
+                      help="size preset, one of %s (default = test_set_500)" % ', '.join(sorted(presets)))
+    parser.add_argument("-seed", type=int, default=0, metavar="<S>", help="seed of the generator (default = 0)")
+    args = parser.parse_args()
+    num_transcripts = args.transcripts if args.transcripts is not None else presets[args.preset]
+    summary = generate(args.out_dir, num_transcripts, args.seed)
+    print('%i transcripts of %i genes on %i chromosomes (%i bases) written to %s'
+          % (summary['transcripts'], summary['genes'], summary['chromosomes'], summary['bases'], args.out_dir))
+
+
+if __name__ == '__main__':
+    main()
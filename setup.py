@@ -5,8 +5,9 @@ with open('README.md') as f:
 
 setup(name='txfeature',
       version='1.0',
-      packages=find_packages(),
-      install_requires=['pybedtools', 'Bio', 'pandas', 'biopython'],
+      packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+      install_requires=['Bio', 'numpy', 'pandas', 'biopython'],
+      extras_require={'arrow': ['pyarrow']},
 
       # metadata to display on PyPI
       author="Waqar Arif",
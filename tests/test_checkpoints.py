@@ -0,0 +1,103 @@
+"""
+Checks resumable and incremental streaming builds end to end: build_db --resume after an interrupted build and
+build_db --incremental against an unchanged annotation reproduce the rows of a clean build. Builds run on a small
+synthetic genome and annotation (see benchmarks.synthetic) with the stub fold engine in a fresh interpreter, as the
+benchmark suite runs them.
+
+usage: python -m pytest tests
+"""
+
+import glob
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks import synthetic
+from txfeature import env_variables
+from txfeature.db_builder import checkpoints, txfeat_writer
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# runs build_db with the stub engine, checkpoints.Checkpoints.save fails once interrupt_after batches were saved
+_build_code = '''
+import sys
+from benchmarks import stub_fold
+from txfeature.db_builder import checkpoints, db_builder
+stub_fold.register()
+interrupt_after = int(sys.argv.pop(1))
+save = checkpoints.Checkpoints.save
+
+
+def interrupted_save(self, job, *args, **kwargs):
+    if len(self.completed()) >= interrupt_after:
+        raise KeyboardInterrupt('build interrupted after %i batches' % interrupt_after)
+    save(self, job, *args, **kwargs)
+
+
+if interrupt_after >= 0:
+    checkpoints.Checkpoints.save = interrupted_save
+sys.argv[0] = 'build_db'
+db_builder.main()
+'''
+
+
+def build_db(data, out_dir, *options, interrupt_after=-1):
+    """Runs build_db in stream mode with 2 threads, :return: completed process"""
+    command = [sys.executable, '-c', _build_code, str(interrupt_after), '-gff', data['gff'], '-fa', data['fasta'],
+               '-out', out_dir, '-t', '2', '-c', data['config'], '-s', '--stream'] + list(options)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    return subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+
+
+def rows(out_dir):
+    return sorted(txfeat_writer.read_rows(out_dir), key=lambda row: row['tx_id'])
+
+
+def build_log(out_dir):
+    with open(sorted(glob.glob(os.path.join(out_dir, 'log', 'txfeature.*.log')))[-1], 'r') as log:
+        return log.read()
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    """Synthetic genome and annotation, a build_db.cfg using the stub engine and the rows of a clean build."""
+    work_dir = str(tmp_path_factory.mktemp('builds'))
+    summary = synthetic.generate(os.path.join(work_dir, 'synthetic'), 120)
+    summary['config'] = os.path.join(work_dir, 'build_stub.cfg')
+    options = {'fold_engine': 'stub', 'fold_cache': ''}
+    with open(env_variables.db_builder_path + 'build_db.cfg', 'r') as default, open(summary['config'], 'w') as config:
+        for line in default:
+            key = line.split('=')[0]
+            config.write('%s=%s\n' % (key, options[key]) if key in options else line)
+    summary['clean'] = os.path.join(work_dir, 'clean')
+    completed = build_db(summary, summary['clean'])
+    assert completed.returncode == 0, completed.stdout
+    return summary
+
+
+def test_resume(data, tmp_path):
+    out_dir = str(tmp_path / 'resumed')
+    interrupted = build_db(data, out_dir, interrupt_after=3)
+    assert interrupted.returncode != 0
+    checkpoint_dir = os.path.join(out_dir, 'txfeat_db', checkpoints.checkpoint_dir)
+    assert len([name for name in os.listdir(checkpoint_dir) if name.startswith('batch-') and
+                name.endswith('.json')]) == 3
+
+    completed = build_db(data, out_dir, '--resume')
+    assert completed.returncode == 0, completed.stdout
+    assert 'Resuming build, 3 of' in build_log(out_dir)
+    assert not os.path.exists(checkpoint_dir)
+    assert rows(out_dir) == rows(data['clean'])
+
+
+def test_incremental(data, tmp_path):
+    out_dir = str(tmp_path / 'incremental')
+    completed = build_db(data, out_dir, '--incremental', data['clean'])
+    assert completed.returncode == 0, completed.stdout
+    clean_rows = rows(data['clean'])
+    assert 'Incremental build: %i transcripts unchanged, 0 recomputed' % len(clean_rows) in build_log(out_dir)
+    assert rows(out_dir) == clean_rows
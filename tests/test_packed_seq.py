@@ -0,0 +1,21 @@
+"""
+Checks that PackedBatch restores the transcripts and region sequences of tests/test_data without loss and that its gc
+content matches txseq_properties.gc_content, including soft-masked, N and IUPAC bases.
+
+usage: python -m pytest tests
+"""
+
+from test_txseq_batch import region_sequences, transcripts
+from txfeature.db_builder import packed_seq
+from txfeature.db_builder import txseq_properties as tp
+
+edge_cases = ['', 'A', 'ACGTn', 'nnNNacgtRYACG', 'gcGC', 'GGGGCCCCN', 'ACGTACGTAcgtacgtaNNNNNNNNG']
+
+
+def test_packed_batch():
+    tx_reads = transcripts()
+    for seqs in [[tx_read.sequence for tx_read in tx_reads], region_sequences(tx_reads), edge_cases]:
+        batch = packed_seq.PackedBatch.pack(seqs)
+        assert batch.sequences() == seqs
+        assert batch.unpack().codes.tobytes().decode() == ''.join(seqs)
+        assert batch.gc_content().tolist() == [tp.gc_content(seq) for seq in seqs]
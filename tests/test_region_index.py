@@ -0,0 +1,106 @@
+"""
+Checks the genome-wide region queries of region_index.RegionIndex and the bulk position annotation of annotate against
+the per transcript TxRead.coord_to_region and coord_map.g2t on random loci around the transcripts of
+tests/test_data/test_set_500.gff3, assembled from the pseudo genome of test_txseq_batch.
+
+usage: python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+
+from test_txseq_batch import test_data, transcripts
+from txfeature.db_builder import gff_parser
+from txfeature.db_builder.feature_store import FeatureStore
+from txfeature.db_reader import annotate, region_index
+
+gff_file = 'test_set_500.gff3'
+
+
+def indexed_build(out_dir):
+    """Writes the region index of the test annotation as build_db does."""
+    os.makedirs(os.path.join(out_dir, 'txfeat_db'))
+    store = FeatureStore.create(gff_parser.gff_table(os.path.join(test_data, gff_file)))
+    try:
+        region_index.build_region_index(out_dir, store)
+    finally:
+        store.close()
+        store.unlink()
+
+
+def spans(tx_reads):
+    """:return: dict of tx_id -> (chrom, first, last exonic coordinate)"""
+    tx_spans = {}
+    for tx_read in tx_reads:
+        g_starts, g_stops, _ = tx_read.coord_map.genomic_arrays()
+        tx_spans[tx_read.tx_id] = (tx_read.chrom, int(np.min(g_starts)), int(np.max(g_stops)))
+    return tx_spans
+
+
+def random_loci(tx_reads, per_tx=6, seed=0):
+    """:return: list of (chrom, start, stop) within or around the transcripts, single positions have start == stop"""
+    random = np.random.RandomState(seed)
+    loci = []
+    for chrom, low, high in spans(tx_reads).values():
+        for _ in range(per_tx):
+            start = random.randint(max(low - 500, 1), high + 500)
+            loci.append((chrom, start, start + random.choice([0, 0, random.randint(1, 3000)])))
+    return loci
+
+
+def nearby(tx_reads, tx_spans, chrom, start, stop):
+    return [tx_read for tx_read in tx_reads if tx_spans[tx_read.tx_id][0] == chrom
+            and tx_spans[tx_read.tx_id][1] - 5000 <= stop and start <= tx_spans[tx_read.tx_id][2] + 5000]
+
+
+def test_query(tmp_path):
+    out_dir = str(tmp_path)
+    indexed_build(out_dir)
+    tx_reads = transcripts([gff_file])
+    tx_spans = spans(tx_reads)
+    with region_index.RegionIndex(out_dir) as index:
+        for chrom, start, stop in random_loci(tx_reads):
+            locus = '%s:%i-%i' % (chrom, start, stop) if start != stop else '%s:%i' % (chrom, start)
+            expected = {}
+            for tx_read in nearby(tx_reads, tx_spans, chrom, start, stop):
+                regions = tx_read.coord_to_region(locus)
+                if regions:
+                    expected[tx_read.tx_id] = sorted(regions)
+            found = {tx_id: sorted(regions) for tx_id, regions in index.query(locus).items()}
+            assert found == expected, locus
+
+
+def test_annotate(tmp_path):
+    out_dir = str(tmp_path)
+    indexed_build(out_dir)
+    tx_reads = transcripts([gff_file])
+    tx_spans = spans(tx_reads)
+    positions = [(chrom, start) for chrom, start, _ in random_loci(tx_reads, seed=1)] + [('chrUn', 1000)]
+    positions_path = os.path.join(out_dir, 'positions.tsv')
+    with open(positions_path, 'w') as positions_file:
+        positions_file.write('#chrom\tpos\n')
+        for chrom, position in positions:
+            positions_file.write('%s\t%i\tA\tG\n' % (chrom, position))
+    output_path = os.path.join(out_dir, 'positions.txfeat.tsv')
+    assert annotate.annotate(out_dir, positions_path, output_path, threads=2, chunk_size=500) == len(positions) + 1
+
+    found = {}
+    with open(output_path, 'r') as output:
+        assert next(output) == 'chrom\tpos\ttx_id\tregion\ttx_pos\n'
+        for line in output:
+            chrom, position, tx_id, regions, tx_pos = line.rstrip('\n').split('\t')
+            found.setdefault((chrom, int(position)), {})[tx_id] = (sorted(regions.split(';')), tx_pos)
+
+    for chrom, position in positions:
+        expected = {}
+        for tx_read in nearby(tx_reads, tx_spans, chrom, position, position):
+            regions = tx_read.coord_to_region('%s:%i' % (chrom, position))
+            tx_index = tx_read.coord_map.g2t(position)
+            if regions:
+                expected[tx_read.tx_id] = (sorted(regions), str(tx_index + 1) if tx_index is not None else '.')
+            elif tx_spans[tx_read.tx_id][1] <= position <= tx_spans[tx_read.tx_id][2]:
+                expected[tx_read.tx_id] = ([annotate.intron_label], '.')
+        if not expected:
+            expected = {'.': (['intergenic'], '.')}
+        assert found[(chrom, position)] == expected, (chrom, position)
@@ -0,0 +1,61 @@
+"""
+Checks the batch spliced sequence extraction of TxReadBatch and TxRead.get_sequences against TxRead.get_sequence on
+random genomic intervals around the transcripts of tests/test_data.
+
+usage: python -m pytest tests
+"""
+
+import numpy as np
+
+from test_txseq_batch import regions, transcripts
+from txfeature.db_builder import tx_features
+from txfeature.db_builder.tx_classes import TxReadBatch
+
+
+def random_intervals(tx_reads, per_tx=20, seed=0):
+    """:return: arrays of transcript positions, starts and stops, intervals overlap the transcript span or its flanks"""
+    random = np.random.RandomState(seed)
+    tx_positions, starts, stops = [], [], []
+    for position, tx_read in enumerate(tx_reads):
+        g_starts, g_stops, _ = tx_read.coord_map.genomic_arrays()
+        low, high = int(np.min(g_starts)), int(np.max(g_stops))
+        for _ in range(per_tx):
+            start = random.randint(max(low - 200, 1), high + 200)
+            tx_positions.append(position)
+            starts.append(start)
+            stops.append(start + random.randint(0, 2000))
+    return np.array(tx_positions), np.array(starts), np.array(stops)
+
+
+def expected(tx_reads, tx_positions, starts, stops, region_type):
+    return [tx_reads[position].get_sequence(region_type, '%s:%i-%i' % (tx_reads[position].chrom, start, stop))
+            for position, start, stop in zip(tx_positions, starts, stops)]
+
+
+def test_batch_sequences():
+    tx_reads = transcripts()
+    tx_positions, starts, stops = random_intervals(tx_reads)
+    batch = TxReadBatch(tx_reads)
+    for overlap, region_type in [(False, 'coordinates'), (True, 'coordinates_overlap')]:
+        sequences = batch.sequences(tx_positions, starts, stops, overlap)
+        assert sequences == expected(tx_reads, tx_positions, starts, stops, region_type)
+        assert any(sequences)
+
+
+def test_get_sequences():
+    for tx_read in transcripts()[::25]:
+        tx_positions, starts, stops = random_intervals([tx_read], per_tx=50, seed=len(tx_read.sequence))
+        for overlap, region_type in [(False, 'coordinates'), (True, 'coordinates_overlap')]:
+            assert tx_read.get_sequences(starts, stops, overlap) == \
+                expected([tx_read], tx_positions, starts, stops, region_type), tx_read.tx_id
+
+
+def test_region_sequences():
+    tx_reads = transcripts()
+    region_seqs = tx_features.region_sequences(tx_reads)
+    for i, tx_read in enumerate(tx_reads):
+        for region in regions:
+            if tx_read.tx_status[region] == 'defined':
+                assert region_seqs[region][i] == tx_read.get_sequence('mrna_region', region), (tx_read.tx_id, region)
+            else:
+                assert region_seqs[region][i] is None
@@ -0,0 +1,45 @@
+"""
+Checks that rows written by the txfeat_db writers are read back unchanged by txfeat_writer.read_rows, including
+Ensembl style chromosome names that look like numbers in the partition paths of parquet and feather output.
+
+usage: python -m pytest tests
+"""
+
+import os
+
+import pytest
+
+from txfeature.db_builder import tx_features, txfeat_writer
+
+# all names numeric, a mix with X or MT would be inferred as strings
+chroms = ['1', '2', '10']
+
+
+def feature_rows():
+    rows = []
+    for i, chrom in enumerate(chroms * 3):
+        row = {column: None for column in tx_features.feature_columns}
+        row.update({'tx_id': 'tx%i' % i, 'gene_id': 'gene%i' % (i // 2), 'tx_type': 'protein_coding', 'chrom': chrom,
+                    'tx.length': 100 + i, 'tx.exon_count': 1 + i % 4})
+        rows.append(row)
+    return rows
+
+
+def written(out_dir, file_format):
+    path = os.path.join(out_dir, 'txfeat_db.csv' if file_format == 'csv' else 'txfeat_db')
+    with txfeat_writer.open_writer(file_format, path, tx_features.feature_schema) as writer:
+        writer.write(feature_rows())
+    return sorted(txfeat_writer.read_rows(out_dir), key=lambda row: row['tx_id'])
+
+
+def test_csv_rows(tmp_path):
+    assert written(str(tmp_path), 'csv') == sorted(feature_rows(), key=lambda row: row['tx_id'])
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'feather'])
+def test_partitioned_rows(tmp_path, file_format):
+    pytest.importorskip('pyarrow')
+    rows = written(str(tmp_path), file_format)
+    assert [row['chrom'] for row in rows] == [row['chrom'] for row in sorted(feature_rows(),
+                                                                             key=lambda row: row['tx_id'])]
+    assert rows == sorted(feature_rows(), key=lambda row: row['tx_id'])
@@ -0,0 +1,78 @@
+"""
+Checks the vectorized sequence properties of txseq_batch against the per sequence functions of txseq_properties on the
+transcripts of tests/test_data. The genome is not shipped, sequences are assembled from a deterministic pseudo genome
+with soft-masked and N runs.
+
+usage: python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+
+from txfeature.db_builder import gff_parser, tx_build, txfeat_functions
+from txfeature.db_builder import txseq_batch as tb
+from txfeature.db_builder import txseq_properties as tp
+from txfeature.db_builder.fasta_index import reverse_complement
+from txfeature.db_builder.tx_classes import TxRead
+
+test_data = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_data')
+regions = ['five_prime_UTR', 'CDS', 'three_prime_UTR']
+
+
+class PseudoGenome:
+    """Sequence of every position derived from the position, with fetch as fasta_index.IndexedFasta."""
+
+    def fetch(self, chrom, start, stop, strand='+'):
+        positions = np.arange(start, stop + 1, dtype=np.int64) + len(chrom)
+        bases = np.frombuffer(b'ACGT', dtype=np.uint8)[(positions * 2654435761 >> 13) % 4]
+        bases = np.where((positions // 1000) % 7 == 0, bases + 32, bases)
+        bases = np.where(positions % 10007 < 20, ord('N'), bases).astype(np.uint8)
+        seq = bases.tobytes().decode()
+        return reverse_complement(seq) if strand == '-' else seq
+
+
+def transcripts(gff_files=('test_set_500.gff3', 'test_seleno.gff3', 'test_set.gff3')):
+    genome = PseudoGenome()
+    tx_reads = []
+    for gff_file in gff_files:
+        gff_df = gff_parser.gff_table(os.path.join(test_data, gff_file))
+        for tx in sorted(gff_df['tx_attr']):
+            tx_annot = txfeat_functions.annot_coords(txfeat_functions.tx2gff_lookup(gff_df, tx))
+            tx_reads.append(TxRead(tx_build.build(tx, tx_annot, gff_df['tx_attr'][tx], genome)))
+    return tx_reads
+
+
+def region_sequences(tx_reads):
+    return [tx_read.get_sequence('mrna_region', region) for tx_read in tx_reads for region in regions
+            if tx_read.tx_status[region] == 'defined']
+
+
+def test_gc_content():
+    tx_reads = transcripts()
+    for seqs in [[tx_read.sequence for tx_read in tx_reads], region_sequences(tx_reads)]:
+        batch = tb.gc_content(tb.encode(seqs))
+        assert batch.tolist() == [tp.gc_content(seq) for seq in seqs]
+
+
+def test_au_element():
+    seqs = [seq for seq in region_sequences(transcripts()) if seq]
+    batch = tb.au_element(tb.encode(seqs))
+    for i, seq in enumerate(seqs):
+        expected = tp.au_element(seq)
+        for key, value in expected.items():
+            assert batch[key][i] == value, (i, key)
+
+
+def test_kozac_score():
+    tx_reads = [tx_read for tx_read in transcripts() if tx_read.tx_type == 'protein_coding']
+    starts = [tp.kozac_start(tx_read) for tx_read in tx_reads]
+    assert max(starts) >= 0
+    batch = tb.kozac_score(tb.encode(tx_read.sequence for tx_read in tx_reads), starts)
+    for i, tx_read in enumerate(tx_reads):
+        try:
+            expected = tp.kozac_score(tx_read)
+        except IndexError:
+            # a start codon at the end of the transcript has no kozac score in the batch version
+            expected = -1
+        assert batch[i] == expected, tx_read.tx_id
@@ -0,0 +1,306 @@
+"""
+Persisted store of the assembled transcriptome. Every build writes the annotation tables of its FeatureStore together
+with the spliced transcript sequences to <out>/assembly/, so features can be recomputed with build_db --from-assembly
+without parsing the gff file or extracting sequence from the genome again. The store is a directory of .npy files
+that are memory mapped when opened:
+    transcripts.npy, features.npy, str_*.npy  - annotation tables as in FeatureStore, transcripts sorted by tx_id
+    seq.npy                                   - 2-bit packed sequence (A, C, G, T), every transcript starts on a byte
+    seq_offsets.npy, seq_lengths.npy          - byte offset and length of the sequence of every transcript
+    mask.npy                                  - runs of bases other than A, C, G, T (N mask) with their character
+    lower.npy                                 - runs of soft-masked (lower case) bases
+    regions.npy                               - transcript index of the first and last base of the 5' UTR, CDS and
+                                                3' UTR of every transcript, -1 if not defined
+    tx_hash.npy                               - content hash of every transcript (see checkpoints.transcript_hash)
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from txfeature.db_builder import tx_build, txfeat_functions, packed_seq
+from txfeature.db_builder.feature_store import FeatureStore, string_tables
+
+store_version = 2
+
+# regions with boundaries in regions.npy
+regions = ['five_prime_UTR', 'CDS', 'three_prime_UTR']
+
+mask_dtype = packed_seq.batch_mask_dtype
+lower_dtype = packed_seq.batch_lower_dtype
+
+
+def hash_array(hashes):
+    """:return: transcript hashes (hex digests) as fixed width byte string array"""
+    return np.array([tx_hash.encode() for tx_hash in hashes], dtype='S40')
+
+
+def pack(sequences):
+    """
+    Packs sequences into 2 bits per base (see packed_seq.PackedBatch).
+    :param sequences: list of sequences as strings or PackedSeq
+    :return: dict of numpy arrays 'seq', 'seq_lengths', 'mask' and 'lower', transcripts of mask and lower are indices
+             into sequences
+    """
+    batch = packed_seq.PackedBatch.pack(sequences)
+    return {'seq': batch.packed, 'seq_lengths': batch.lengths, 'mask': batch.mask, 'lower': batch.lower}
+
+
+def region_bounds(store):
+    """
+    Transcript index of the first and last base of the 5' UTR, CDS and 3' UTR of every transcript of a store.
+    :param store: FeatureStore
+    :return: int64 array of shape (transcripts, 3, 2), -1 where a region is not defined or not within the exons
+    """
+    from txfeature.db_reader import region_index
+    transcripts = store.transcripts
+    features = store.features
+    num_tx = len(transcripts)
+    bounds = np.full((num_tx, len(regions), 2), -1, dtype=np.int64)
+    tx_of_feature = np.repeat(np.arange(num_tx), transcripts['feat_stop'] - transcripts['feat_start'])
+    starts = np.minimum(features['start'], features['stop'])
+    stops = np.maximum(features['start'], features['stop'])
+    offsets = region_index.exon_offsets(tx_of_feature, features, starts, stops)
+    minus = transcripts['strand'] == b'-'
+
+    # exons sorted by transcript and start, shifted per transcript so one searchsorted finds the exon of a base
+    exons = np.flatnonzero(features['ftype'] == txfeat_functions.tx_feature_types.index('exon'))
+    exons = exons[np.lexsort((starts[exons], tx_of_feature[exons]))]
+    if len(exons) == 0:
+        return bounds
+    shift = np.int64(1) << 32
+    exon_tx = tx_of_feature[exons]
+    exon_starts = starts[exons]
+    exon_stops = stops[exons]
+    exon_offsets = offsets[exons]
+    shifted_starts = exon_starts + exon_tx * shift
+
+    def tx_index(tx, coord):
+        exon = np.clip(np.searchsorted(shifted_starts, coord + tx * shift, side='right') - 1, 0, len(exons) - 1)
+        inside = (exon_tx[exon] == tx) & (exon_starts[exon] <= coord) & (coord <= exon_stops[exon])
+        index = np.where(minus[tx], exon_stops[exon] - coord, coord - exon_starts[exon]) + exon_offsets[exon] - 1
+        return np.where(inside, index, -1)
+
+    for i, region in enumerate(regions):
+        selected = features['ftype'] == txfeat_functions.tx_feature_types.index(region)
+        low = np.full(num_tx, np.iinfo(np.int64).max, dtype=np.int64)
+        high = np.zeros(num_tx, dtype=np.int64)
+        np.minimum.at(low, tx_of_feature[selected], starts[selected])
+        np.maximum.at(high, tx_of_feature[selected], stops[selected])
+        defined = np.flatnonzero(high > 0)
+        five_prime = np.where(minus[defined], high[defined], low[defined])
+        three_prime = np.where(minus[defined], low[defined], high[defined])
+        first = tx_index(defined, five_prime)
+        last = tx_index(defined, three_prime)
+        found = (first >= 0) & (last >= 0)
+        bounds[defined[found], i, 0] = first[found]
+        bounds[defined[found], i, 1] = last[found]
+    return bounds
+
+
+class AssemblyWriter:
+    """
+    Writes the store while packed sequences of batches of transcripts are added. The byte offsets of all transcripts
+    follow from their exon lengths, so seq.npy is created memory mapped up front and every batch is written at its
+    offsets when added. Only the N mask and soft-mask runs are kept until the store is closed.
+    :param path: store directory, replaced when the writer is closed
+    :param store: FeatureStore of the build, its tables are written when the writer is created
+    """
+
+    def __init__(self, path, store):
+        self.path = path
+        self.num_tx = len(store)
+        self._tmp_path = path + '.tmp'
+        if os.path.exists(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        os.makedirs(self._tmp_path)
+        tables = {'transcripts': store.transcripts, 'features': store.features, 'regions': region_bounds(store)}
+        for name in string_tables:
+            tables['str_' + name] = store.strings[name]
+        for name, array in tables.items():
+            np.save(os.path.join(self._tmp_path, name + '.npy'), array)
+
+        self._lengths = store.tx_lengths()
+        packed_lengths = (self._lengths + 3) // 4
+        self._offsets = np.concatenate(([0], np.cumsum(packed_lengths)))
+        self._seq = np.lib.format.open_memmap(os.path.join(self._tmp_path, 'seq.npy'), mode='w+', dtype=np.uint8,
+                                              shape=(int(self._offsets[-1]),))
+        self._tx_hash = np.zeros(self.num_tx, dtype='S40')
+        self._runs = {'mask': [], 'lower': []}
+        self._added = np.zeros(self.num_tx, dtype=bool)
+
+    def add(self, tx_indices, packed):
+        """
+        Writes the packed sequences of a batch at the offsets of its transcripts.
+        :param tx_indices: store indices of the packed transcripts
+        :param packed: sequences of the transcripts packed with pack and their hashes as 'tx_hashes' (see hash_array)
+        """
+        tx_indices = np.asarray(tx_indices, dtype=np.int64)
+        differ = np.flatnonzero(packed['seq_lengths'] != self._lengths[tx_indices])
+        if len(differ) > 0:
+            raise ValueError('Assembled sequence of transcript %i has %i bases, its exons have %i'
+                             % (tx_indices[differ[0]], packed['seq_lengths'][differ[0]],
+                                self._lengths[tx_indices[differ[0]]]))
+        part_offset = 0
+        for offset, packed_length in zip(self._offsets[tx_indices].tolist(),
+                                         ((packed['seq_lengths'] + 3) // 4).tolist()):
+            self._seq[offset:offset + packed_length] = packed['seq'][part_offset:part_offset + packed_length]
+            part_offset += packed_length
+        self._tx_hash[tx_indices] = packed['tx_hashes']
+        for name in ['mask', 'lower']:
+            runs = packed[name].copy()
+            runs['tx'] = tx_indices[runs['tx']]
+            self._runs[name].append(runs)
+        self._added[tx_indices] = True
+
+    @property
+    def complete(self):
+        return bool(self._added.all())
+
+    def close(self):
+        """Completes the store, the sequences of all transcripts must have been added."""
+        if not self.complete:
+            raise ValueError('Assembly store %s is missing %i transcripts' % (self.path, (~self._added).sum()))
+        self._seq.flush()
+        self._seq = None
+        arrays = {'seq_offsets': self._offsets, 'seq_lengths': self._lengths, 'tx_hash': self._tx_hash}
+        for name, dtype in [('mask', mask_dtype), ('lower', lower_dtype)]:
+            runs = np.concatenate(self._runs[name]) if self._runs[name] else np.zeros(0, dtype=dtype)
+            arrays[name] = runs[np.lexsort((runs['start'], runs['tx']))]
+        self._runs = {'mask': [], 'lower': []}
+        for name, array in arrays.items():
+            np.save(os.path.join(self._tmp_path, name + '.npy'), array)
+        with open(os.path.join(self._tmp_path, 'manifest.json'), 'w') as manifest:
+            json.dump({'version': store_version, 'transcripts': self.num_tx, 'bases': int(self._lengths.sum())},
+                      manifest)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self):
+        """Removes the partly written store of a writer that is not closed."""
+        self._seq = None
+        if os.path.exists(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+
+
+def save_part(path, packed):
+    """
+    Saves the packed sequences of a part of the transcripts, the file is replaced atomically.
+    :param path: .npz file
+    :param packed: sequences packed with pack, the store indices of their transcripts as 'tx_indices' and their
+                   hashes as 'tx_hashes'
+    """
+    with open(path + '.tmp', 'wb') as tmp:
+        np.savez(tmp, **packed)
+    os.replace(path + '.tmp', path)
+
+
+def load_part(path):
+    """:return: packed sequences saved with save_part"""
+    with np.load(path) as part:
+        return {name: part[name] for name in part.files}
+
+
+class AssemblyStore(FeatureStore):
+    """
+    Memory mapped assembly store. The annotation tables are read as in FeatureStore so the store can be used in place
+    of the FeatureStore of a build, worker processes attach using the store path as handle.
+    :param path: store directory
+    """
+
+    def __init__(self, path):
+        manifest_path = os.path.join(path, 'manifest.json')
+        if not os.path.isfile(manifest_path):
+            raise IOError('%s is not an assembly store, manifest.json not found' % path)
+        with open(manifest_path, 'r') as manifest_json:
+            manifest = json.load(manifest_json)
+        if manifest['version'] != store_version:
+            raise IOError('Assembly store %s has version %s, expected %i' % (path, manifest['version'], store_version))
+        self.path = path
+        arrays = {}
+        for name in ['transcripts', 'features', 'seq', 'seq_offsets', 'seq_lengths', 'mask', 'lower', 'regions',
+                     'tx_hash'] + \
+                ['str_' + name for name in string_tables]:
+            arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        FeatureStore.__init__(self, {}, arrays)
+
+    @classmethod
+    def attach(cls, handle):
+        return cls(handle)
+
+    @property
+    def handle(self):
+        return self.path
+
+    def index(self, tx_id):
+        """Store index of a transcript, None if not found."""
+        tx_ids = self.strings['tx_id']
+        key = tx_id.encode()
+        i = int(np.searchsorted(tx_ids, key))
+        if i < len(tx_ids) and tx_ids[i] == key:
+            return i
+        return None
+
+    def packed_sequence(self, index):
+        """Spliced sequence of the transcript at index as PackedSeq on the memory mapped bytes of the store."""
+        length = int(self._arrays['seq_lengths'][index])
+        offset = int(self._arrays['seq_offsets'][index])
+        runs = {}
+        for name in ['mask', 'lower']:
+            first, last = np.searchsorted(self._arrays[name]['tx'], [index, index + 1])
+            runs[name] = self._arrays[name][first:last]
+        return packed_seq.PackedSeq.from_packed(self._arrays['seq'][offset:offset + (length + 3) // 4], length,
+                                                runs['mask'], runs['lower'])
+
+    def packed_batch(self, tx_indices):
+        """
+        Packed sequences of many transcripts, the bytes of every transcript are gathered from the store into one
+        contiguous buffer.
+        :param tx_indices: store indices
+        :return: packed_seq.PackedBatch, runs are numbered by the position of their transcript in tx_indices
+        """
+        tx_indices = np.asarray(tx_indices, dtype=np.int64)
+        lengths = np.asarray(self._arrays['seq_lengths'][tx_indices], dtype=np.int64)
+        offsets = np.asarray(self._arrays['seq_offsets'][tx_indices], dtype=np.int64)
+        packed = np.asarray(self._arrays['seq'][packed_seq.range_positions(offsets, (lengths + 3) // 4)])
+        runs = {}
+        for name in ['mask', 'lower']:
+            first = np.searchsorted(self._arrays[name]['tx'], tx_indices, side='left')
+            last = np.searchsorted(self._arrays[name]['tx'], tx_indices, side='right')
+            runs[name] = np.array(self._arrays[name][packed_seq.range_positions(first, last - first)])
+            runs[name]['tx'] = np.repeat(np.arange(len(tx_indices), dtype=np.int64), last - first)
+        return packed_seq.PackedBatch(packed, lengths, runs['mask'], runs['lower'])
+
+    def tx_hash(self, index):
+        """Content hash of the transcript at index, see checkpoints.transcript_hash."""
+        return self._arrays['tx_hash'][index].decode()
+
+    def sequence(self, index):
+        """Spliced sequence of the transcript at index."""
+        return str(self.packed_sequence(index))
+
+    def region_bounds(self, index, region):
+        """
+        :param region: one of regions
+        :return: (first, last) transcript index of the region or None if not defined
+        """
+        first, last = self._arrays['regions'][index, regions.index(region)]
+        return None if first < 0 else (int(first), int(last))
+
+    def assembled(self, tx_indices, packed=None):
+        """
+        Restores the assembled transcripts as returned by tx_build.build, the sequences of all transcripts are unpacked
+        in one pass.
+        :param tx_indices: store indices
+        :param packed: PackedBatch of the transcripts as returned by packed_batch, gathered if None
+        :return: dict of tx_id -> assembled transcript
+        """
+        if packed is None:
+            packed = self.packed_batch(tx_indices)
+        tx_assembled = {}
+        for tx_index, sequence in zip(tx_indices, packed.sequences()):
+            tx = self.tx_id(tx_index)
+            tx_assembled[tx] = tx_build.assembled(tx, self.tx_annot(tx_index), self.tx_attr(tx_index), sequence)
+        return tx_assembled
@@ -9,6 +9,9 @@ import sys
 
 cfg = {}
 
+# optional keys and their values if missing from the configuration file
+defaults = {'fold_engine': 'cli', 'fold_cache': '', 'fold_cache_max_entries': '5000000'}
+
 
 def config_parse(file):
     global cfg
@@ -23,6 +26,8 @@ def config_parse(file):
 
 def config_check():
     global cfg
+    for key, value in defaults.items():
+        cfg.setdefault(key, value)
     keys = ['rnafold_command', 'rnalfold_command', 'viennarna_dir']
     for item in keys:
         if item not in list(cfg.keys()):
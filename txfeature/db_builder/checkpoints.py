@@ -0,0 +1,196 @@
+"""
+Checkpoints of streaming builds and transcript content hashes used for resumable and incremental builds. Every
+completed gene batch is saved under <out>/txfeat_db/_checkpoints/ so an interrupted build can continue with --resume,
+and every build records a hash of the exon structure and sequence of each transcript in <out>/txfeat_db/_tx_hash.tsv
+so a later build with --incremental only recomputes new or changed transcripts. The settings the features depend on
+are recorded in <out>/txfeat_db/_build.json once a build completes, rows of a previous build with other settings are
+not reused. Names starting with '_' are skipped by readers of the partitioned parquet / feather output.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from txfeature.db_builder import assembly_store, tx_features
+from txfeature.db_reader import db_reader
+
+checkpoint_dir = '_checkpoints'
+hash_file = '_tx_hash.tsv'
+build_file = '_build.json'
+
+
+def transcript_hash(transcript):
+    """
+    Content hash of an assembled transcript (see tx_build.build) covering type, location, exon structure of all
+    feature types and sequence.
+    :return: hex digest as string
+    """
+    structure = []
+    for ftype in sorted(transcript['tx_annot'].keys()):
+        for exon_number in sorted(transcript['tx_annot'][ftype].keys()):
+            coord = transcript['tx_annot'][ftype][exon_number]
+            structure.append('%s:%s:%i-%i' % (ftype, exon_number, coord['start'], coord['stop']))
+    content = '|'.join([transcript['gene_id'], transcript['tx_type'], transcript['chrom'], transcript['strand'],
+                        ','.join(structure), str(transcript['tx_seq'])])
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def read_hashes(path):
+    """
+    :param path: _tx_hash.tsv file
+    :return: dict of tx_id -> hash
+    """
+    hashes = {}
+    with open(path, 'r') as hash_tsv:
+        for line in hash_tsv:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2:
+                hashes[fields[0]] = fields[1]
+    return hashes
+
+
+class HashWriter:
+    """Writes transcript hashes to a _tx_hash.tsv file as batches finish."""
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+
+    def write(self, hashes):
+        for tx, tx_hash in hashes.items():
+            self._file.write('%s\t%s\n' % (tx, tx_hash))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def save_build(out_dir, manifest):
+    """
+    Records the settings of a completed build next to its transcript hashes.
+    :param out_dir: output directory of the build (-out)
+    :param manifest: dict of the settings the feature values depend on
+    """
+    path = os.path.join(out_dir, 'txfeat_db', build_file)
+    with open(path + '.tmp', 'w') as tmp:
+        json.dump(manifest, tmp)
+    os.replace(path + '.tmp', path)
+
+
+def previous_build(out_dir, manifest):
+    """
+    Opens a previous build for incremental builds. Only the transcript hashes are loaded, the rows of unchanged
+    transcripts are read from the previous txfeat_db per gene batch with previous_rows.
+    :param out_dir: output directory of the previous build (-out)
+    :param manifest: settings of the current build as recorded by save_build
+    :return: dict with 'hashes' (tx_id -> hash of transcripts with a row) and 'db' (db_reader.TxfeatDB of the previous
+             build, to be closed by the caller), None if the previous build did not complete or was built with other
+             settings and all transcripts are recomputed
+    """
+    logger = logging.getLogger(__name__ + '.previous_build')
+    hash_path = os.path.join(out_dir, 'txfeat_db', hash_file)
+    if not os.path.isfile(hash_path):
+        raise IOError('%s not found, the previous build did not record transcript hashes' % hash_path)
+    build_path = os.path.join(out_dir, 'txfeat_db', build_file)
+    previous = None
+    if os.path.isfile(build_path):
+        with open(build_path, 'r') as build_json:
+            previous = json.load(build_json)
+    if previous != manifest:
+        logger.info('Warning: previous build %s %s, all transcripts are recomputed.'
+                    % (out_dir, 'used other settings' if previous is not None else 'did not complete'))
+        return None
+    hashes = read_hashes(hash_path)
+    # rows are not cached, every unchanged transcript is read once
+    db = db_reader.TxfeatDB(out_dir, cache_size=0)
+    indexed = set(db.tx_ids())
+    hashes = {tx: tx_hash for tx, tx_hash in hashes.items() if tx in indexed}
+    logger.debug('Loaded %i transcript hashes of previous build %s with %i feature rows'
+                 % (len(hashes), out_dir, len(indexed)))
+    return {'hashes': hashes, 'db': db}
+
+
+def previous_rows(previous, reused):
+    """
+    Rows of unchanged transcripts read from a previous build.
+    :param previous: previous build as returned by previous_build
+    :param reused: dict of tx_id -> chrom of the transcripts in the current build
+    :return: list of feature dicts in the order of reused
+    """
+    rows = []
+    for row in previous['db'].lookup('tx_id', list(reused)):
+        row = tx_features.restore_na(row)
+        row['chrom'] = reused[row['tx_id']]
+        rows.append(row)
+    return rows
+
+
+class Checkpoints:
+    """
+    Completed gene batches of a streaming build.
+    :param directory: checkpoint directory
+    :param manifest: dict describing the build inputs, checkpoints of a build with another manifest are discarded
+    """
+
+    def __init__(self, directory, manifest):
+        logger = logging.getLogger(__name__ + '.Checkpoints')
+        self.directory = directory
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as manifest_json:
+                previous = json.load(manifest_json)
+            if previous != manifest:
+                logger.info('Warning: checkpoints in %s belong to a build with different inputs and are discarded.'
+                            % directory)
+                shutil.rmtree(directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            self._dump(manifest, manifest_path)
+
+    def _path(self, job):
+        return os.path.join(self.directory, 'batch-%i.json' % job)
+
+    def _assembly_path(self, job):
+        return os.path.join(self.directory, 'batch-%i.assembly.npz' % job)
+
+    def _dump(self, content, path):
+        # written to a temporary file first so an interrupted write never leaves a partial checkpoint
+        with open(path + '.tmp', 'w') as tmp:
+            json.dump(content, tmp)
+        os.replace(path + '.tmp', path)
+
+    def completed(self):
+        """Set of completed batch numbers."""
+        jobs = set()
+        for name in os.listdir(self.directory):
+            if name.startswith('batch-') and name.endswith('.json'):
+                jobs.add(int(name[len('batch-'):-len('.json')]))
+        return jobs
+
+    def save(self, job, rows, hashes, assembly=None):
+        """
+        :param assembly: packed sequences of the batch (see assembly_store.pack) with their 'tx_indices'
+        """
+        if assembly is not None:
+            # saved before the batch json, a batch only counts as completed once both exist
+            assembly_store.save_part(self._assembly_path(job), assembly)
+        self._dump({'rows': rows, 'hashes': hashes}, self._path(job))
+
+    def load(self, job):
+        """:return: dict with 'rows' and 'hashes' of the batch, and 'assembly' if it was saved"""
+        with open(self._path(job), 'r') as batch_json:
+            saved = json.load(batch_json)
+        if os.path.isfile(self._assembly_path(job)):
+            saved['assembly'] = assembly_store.load_part(self._assembly_path(job))
+        return saved
+
+    def remove(self):
+        """Removes all checkpoints once the build is complete."""
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,115 @@
+"""
+Interval based genome <-> transcript coordinate map. A transcript is described by its exon blocks in transcript order
+so conversions cost O(log exons) and the map serializes in 8 bytes per exon instead of storing one genomic
+coordinate per transcript base.
+"""
+
+from array import array
+from bisect import bisect_right
+
+import numpy as np
+
+from txfeature.db_builder import intervals
+
+
+class CoordMap:
+    """
+    Maps 1-based genomic coordinates to 0-based transcript indices and back.
+    :param blocks: list of (start, stop) genomic exon coordinates (1-based, inclusive) in transcript order
+    :param strand: '+' or '-'
+    """
+
+    def __init__(self, blocks, strand):
+        self.strand = strand
+        self.blocks = tuple((min(start, stop), max(start, stop)) for start, stop in blocks)
+
+        # transcript index of the 5' most base of every block, in transcript order
+        self.tx_offsets = []
+        length = 0
+        for start, stop in self.blocks:
+            self.tx_offsets.append(length)
+            length += stop - start + 1
+        self.length = length
+
+        # blocks sorted by genomic start for genome -> transcript lookups
+        order = sorted(range(len(self.blocks)), key=lambda i: self.blocks[i][0])
+        self._g_starts = [self.blocks[i][0] for i in order]
+        self._g_stops = [self.blocks[i][1] for i in order]
+        self._g_offsets = [self.tx_offsets[i] for i in order]
+        self._arrays = None
+
+    def __reduce__(self):
+        return CoordMap.from_bytes, (self.to_bytes(),)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, coord):
+        return self.g2t(coord) is not None
+
+    def to_bytes(self):
+        """Serializes the map as strand byte followed by unsigned 32 bit start, stop pairs."""
+        flat = array('I', [coord for block in self.blocks for coord in block])
+        return self.strand.encode() + flat.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        flat = array('I')
+        flat.frombytes(data[1:])
+        return cls(zip(flat[0::2], flat[1::2]), data[:1].decode())
+
+    def g2t(self, coord):
+        """
+        Converts genomic coordinate to transcript index.
+        :param coord: 1-based genomic coordinate
+        :return: 0-based transcript index or None if the coordinate is not within an exon of the transcript
+        """
+        i = bisect_right(self._g_starts, coord) - 1
+        if i < 0 or coord > self._g_stops[i]:
+            return None
+        if self.strand == '-':
+            return self._g_offsets[i] + self._g_stops[i] - coord
+        return self._g_offsets[i] + coord - self._g_starts[i]
+
+    def index(self, coord):
+        """Same as g2t but raises ValueError for coordinates outside the transcript (as tuple.index)."""
+        tx_index = self.g2t(coord)
+        if tx_index is None:
+            raise ValueError('%i is not within the transcript' % coord)
+        return tx_index
+
+    def t2g(self, tx_index):
+        """
+        Converts transcript index to genomic coordinate.
+        :param tx_index: 0-based transcript index
+        :return: 1-based genomic coordinate
+        """
+        if tx_index < 0 or tx_index >= self.length:
+            raise IndexError('transcript index %i out of range' % tx_index)
+        i = bisect_right(self.tx_offsets, tx_index) - 1
+        start, stop = self.blocks[i]
+        if self.strand == '-':
+            return stop - (tx_index - self.tx_offsets[i])
+        return start + (tx_index - self.tx_offsets[i])
+
+    def genomic_arrays(self):
+        """
+        Blocks sorted by genomic start as numpy arrays for vectorized lookups, created on first use.
+        :return: tuple of int64 arrays (starts, stops, transcript index of the 5' most base of each block)
+        """
+        if self._arrays is None:
+            self._arrays = (np.array(self._g_starts, dtype=np.int64), np.array(self._g_stops, dtype=np.int64),
+                            np.array(self._g_offsets, dtype=np.int64))
+        return self._arrays
+
+    def overlap(self, start, stop):
+        """
+        Genomic span of transcript bases overlapping a genomic interval.
+        :param start: 1-based start coordinate (inclusive)
+        :param stop: 1-based stop coordinate (inclusive)
+        :return: (min, max) genomic coordinates of the overlapping transcript bases or None if there is no overlap
+        """
+        ovlp = intervals.intersect(self.blocks, [(start, stop)])
+        if not ovlp:
+            return None
+        return intervals.span(ovlp)
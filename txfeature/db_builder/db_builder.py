@@ -8,14 +8,23 @@ import argparse
 import logging
 import sys
 import os
-import csv
+import shutil
 import concurrent.futures
 import pandas as pd
+import numpy as np
 
-from txfeature.db_builder import gff_parser, tx_assembly, tx_features, txfeat_functions, build_config
-from txfeature.db_builder import system_check
+from txfeature.db_builder import gff_parser, tx_assembly, tx_features, build_config
+from txfeature.db_builder import system_check, fold_cache, tx_stream, txfeat_writer, checkpoints, scheduler
+from txfeature.db_builder import assembly_store
+from txfeature.db_builder.fasta_index import IndexedFasta
+from txfeature.db_builder.feature_store import FeatureStore
+from txfeature.db_reader import db_index, region_index
 from txfeature import version
 
+# spill directories of batch builds, assembly part files and the distinct sequences to fold of every chunk
+assembly_parts_dir = '_assembly_parts'
+fold_spill_dir = '_fold_requests'
+
 
 def main():
     # Start time of analysis
@@ -29,9 +38,9 @@ def main():
     optional = parser._action_groups.pop()
     required = parser.add_argument_group('required arguments')
     required.add_argument("-gff", type=str, default=None, metavar="<gff_file>",
-                          help="specify path to the associated gff3 file", required=True)
-    required.add_argument("-fa", type=str, default=None, metavar="<fasta_file>", help="specify path to the fasta file",
-                          required=True)
+                          help="specify path to the associated gff3 file (not needed with --from-assembly)")
+    required.add_argument("-fa", type=str, default=None, metavar="<fasta_file>",
+                          help="specify path to the fasta file (not needed with --from-assembly)")
     required.add_argument("-out", type=str, default=None, metavar="<output_name>", help="label for output directory",
                           required=True)
     optional.add_argument("-t", "--threads", nargs='?', const=1, type=int, default=1,  metavar="",
@@ -39,8 +48,29 @@ def main():
     optional.add_argument("-c", "--config", type=str, default=None, metavar="", help="specify path to config file")
     optional.add_argument("-v", "--version", action='version', version='%(prog)s v' + version.__version__)
     optional.add_argument("-s", action='store_true', help="silence terminal output")
+    optional.add_argument("--stream", action='store_true',
+                          help="assemble and featurize gene batches end to end and write rows as they finish")
+    optional.add_argument("--format", type=str, default='csv', choices=txfeat_writer.output_formats, metavar="",
+                          help="output format of txfeat_db, csv, parquet or feather (default = csv), parquet and "
+                               "feather output is partitioned by chromosome into <out>/txfeat_db/")
+    optional.add_argument("--resume", action='store_true',
+                          help="continue an interrupted build from its checkpoints in <out>/txfeat_db/ "
+                               "(implies --stream)")
+    optional.add_argument("--incremental", type=str, default=None, metavar="<previous_db>",
+                          help="output directory of a previous build, only transcripts that are new or changed are "
+                               "recomputed (implies --stream)")
+    optional.add_argument("--from-assembly", type=str, default=None, metavar="<assembly_store>",
+                          help="read the assembled transcripts from the store written by a previous build "
+                               "(<out>/assembly/) instead of parsing -gff and extracting sequence from -fa")
     parser._action_groups.append(optional)
     args = parser.parse_args()
+    if args.from_assembly is None and (args.gff is None or args.fa is None):
+        parser.error('-gff and -fa are required unless --from-assembly is given')
+    if args.incremental is not None and os.path.abspath(args.incremental) == os.path.abspath(args.out):
+        parser.error('--incremental must name another directory than -out, rows of the previous build are read while '
+                     'the new build is written')
+    if args.resume or args.incremental is not None:
+        args.stream = True
 
     # Creating sub-directories in output path
     sub_dir = ['log', 'txfeat_db']
@@ -74,64 +104,280 @@ def main():
     logger.debug('Performing system check to ensure necessary executables are installed.')
     build_config.load_check(args.config)
     system_check.ready()
+    if args.format != 'csv' and not txfeat_writer.pyarrow_available():
+        logger.info('Error: pyarrow is required to write txfeat_db in %s format!' % args.format)
+        sys.exit(1)
+
+    if args.from_assembly is not None:
+        # Assembled transcripts are read from the memory mapped store of a previous build
+        logger.info('Opening assembly store %s...' % args.from_assembly)
+        store = assembly_store.AssemblyStore(args.from_assembly)
+        gene_names = {store.tx_id(i): store.tx_attr(i)['gene_name'] for i in range(len(store))}
+        logger.info('Number of assembled transcripts: %i' % len(store))
+    else:
+        # Parse gff into searchable dataframe
+        logger.info('Parsing gene annotation file...')
+        gff_df = gff_parser.gff_table(args.gff)
+        logger.info('Parsing complete!')
+        logger.info('Number of entries in gff: %i' % gff_df['num_lines'])
+        logger.info('Number of annotated transcripts: %i' % len(gff_df['tx_attr'].keys()))
+
+        # Index genome fasta once so that assembly workers do not race to create the .fai
+        IndexedFasta(args.fa).close()
+
+        # Place parsed annotation into shared memory for the assembly workers
+        store = FeatureStore.create(gff_df)
+        gene_names = {tx: tx_attr['gene_name'] for tx, tx_attr in gff_df['tx_attr'].items()}
+        del gff_df
+    logger.info('Indexing transcript regions...')
+    region_index.build_region_index(args.out, store)
+
+    previous = None
+    if args.incremental is not None:
+        logger.info('Loading previous build %s...' % args.incremental)
+        previous = checkpoints.previous_build(args.incremental, feature_manifest(args))
+    # settings of the build are recorded once it completes
+    build_path = args.out + '/txfeat_db/' + checkpoints.build_file
+    if os.path.exists(build_path):
+        os.remove(build_path)
+
+    if args.stream:
+        # Assemble and featurize gene batches end to end, rows are written as batches finish
+        logger.info('Starting streaming assembly and feature aggregation...')
+        checkpoint_dir = args.out + '/txfeat_db/' + checkpoints.checkpoint_dir
+        if not args.resume and os.path.exists(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        checkpoint = checkpoints.Checkpoints(checkpoint_dir, build_manifest(args))
+        assembly_writer = None
+        if args.from_assembly is None:
+            assembly_writer = assembly_store.AssemblyWriter(assembly_path(args), store)
+        try:
+            with txfeat_writer.open_writer(args.format, output_path(args), tx_features.feature_schema) as writer:
+                tx_stream.stream_build(store, args.fa, writer, args.threads,
+                                       hash_path=args.out + '/txfeat_db/' + checkpoints.hash_file,
+                                       checkpoint=checkpoint, previous=previous, assembly_writer=assembly_writer)
+            if assembly_writer is not None:
+                if assembly_writer.complete:
+                    logger.info('Saving assembly store...')
+                    assembly_writer.close()
+                else:
+                    logger.info('Assembly store not written, resumed batches were checkpointed without their '
+                                'sequences.')
+        finally:
+            store.close()
+            store.unlink()
+            if assembly_writer is not None:
+                assembly_writer.discard()
+            if previous is not None:
+                previous['db'].close()
+        checkpoint.remove()
+        logger.debug('Streaming transcript assembly and feature aggregation complete!')
+    else:
+        batch_build(store, args)
+
+    # Index for lookups by tx_id, gene_id, gene_name and tx_type (see db_reader)
+    logger.info('Indexing txfeat_db...')
+    db_index.build_index(args.out, gene_names)
+    checkpoints.save_build(args.out, feature_manifest(args))
+    if build_config.cfg['fold_cache']:
+        evicted = fold_cache.prune_build(build_config.cfg['fold_cache'],
+                                         int(build_config.cfg['fold_cache_max_entries']))
+        if evicted:
+            logger.info('Fold cache: evicted %i least recently used entries.' % evicted)
+
+    # Completion time
+    task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
+    logger.debug('It took %s minutes to construct txfeature database' % task_time)
+
+
+def output_path(args):
+    """Path of the txfeat_db csv file or of the partition directory for parquet and feather output."""
+    if args.format == 'csv':
+        return args.out + '/txfeat_db.csv'
+    return args.out + '/txfeat_db'
+
+
+def assembly_path(args):
+    """Directory of the assembly store written by a build."""
+    return args.out + '/assembly'
 
-    # Parse gff into searchable dataframe
-    logger.info('Parsing gene annotation file...')
-    gff_num = sum(1 for _ in open(args.gff))
-    gff_df = gff_parser.gff_table(csv.reader(open(args.gff, 'r'), delimiter='\t'))
-    logger.info('Parsing complete!')
-    logger.info('Number of entries in gff: %i' % gff_num)
-    logger.info('Number of annotated transcripts: %i' % len(gff_df['tx_attr'].keys()))
+
+def build_manifest(args):
+    """Inputs and settings of a build, checkpoints are only resumed by a build with the same manifest."""
+    files = {}
+    if args.from_assembly is not None:
+        inputs = [('assembly', os.path.join(args.from_assembly, 'manifest.json'))]
+    else:
+        inputs = [('gff', args.gff), ('fa', args.fa)]
+    for name, path in inputs:
+        files[name] = [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+    return {'version': version.__version__,
+            'files': files,
+            'format': args.format,
+            # gene batches are balanced for the number of workers
+            'threads': args.threads,
+            'incremental': os.path.abspath(args.incremental) if args.incremental is not None else None,
+            'fold': [build_config.cfg[key] for key in ['fold_engine', 'rnafold_command', 'rnalfold_command']]}
+
+
+def feature_manifest(args):
+    """
+    Settings the feature values of a build depend on, an incremental build only reuses rows of a previous build with
+    the same settings. Input files, threads and output format do not change the values.
+    """
+    manifest = build_manifest(args)
+    return {key: value for key, value in manifest.items() if key not in ['files', 'threads', 'format', 'incremental']}
+
+
+def batch_build(store, args):
+    """
+    Assembles all transcripts, aggregates their features and saves the table once all features are complete.
+    :param store: FeatureStore holding the parsed gff file or AssemblyStore, closed and unlinked after assembly
+    :param args: parsed arguments of main
+    """
+    logger = logging.getLogger('db_builder.batch_build')
 
     # Setup parallel processing
     logger.info('Preparing transcript assembly for %i threads.' % args.threads)
-    chunk_size = int(len(gff_df['tx_attr'])/args.threads)
-    tx_chunks = txfeat_functions.chunks(gff_df['tx_attr'], chunk_size)
-    tx_jobs = []
-    for item in tx_chunks:
-        tx_jobs.append(item)
-
-    # Start tx assembly jobs
-    tx_assembled = {}
-    logger.info('Starting assembly of transcripts...')
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
-        njobs = range(len(tx_jobs))
-        jobs = [executor.submit(tx_assembly.assemble, gff_df, tx_jobs[i], args.fa, args.out, i) for i in njobs]
-
-        # collect results from jobs
-        for job in concurrent.futures.as_completed(jobs):
-            tx_assembled.update(job.result())
+    # every worker assembles a contiguous genomic shard of transcripts ordered by chromosome and start
+    tx_jobs = [shard for shard in np.array_split(store.genomic_order(), args.threads) if len(shard) > 0]
+
+    # Start tx assembly jobs, workers save the packed sequences and hashes of their shard to a part file which are
+    # combined into the assembly store, the later stages restore the transcripts from the memory mapped store so
+    # assembled transcripts are never pickled through the main process
+    parts_dir = args.out + '/' + assembly_parts_dir
+    exon_usage = {'hits': 0, 'misses': 0}
+    try:
+        if args.from_assembly is not None:
+            # transcripts of --from-assembly are already assembled, their hashes are read from the store
+            tx_hashes = {store.tx_id(i): store.tx_hash(i) for i in range(len(store))}
+        else:
+            if not os.path.exists(parts_dir):
+                os.makedirs(parts_dir)
+            part_paths = ['%s/part-%i.npz' % (parts_dir, i) for i in range(len(tx_jobs))]
+            tx_hashes = {}
+            logger.info('Starting assembly of transcripts...')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
+                njobs = range(len(tx_jobs))
+                jobs = [executor.submit(tx_assembly.assemble_part, store.handle, tx_jobs[i], args.fa, i,
+                                        part_paths[i]) for i in njobs]
+
+                # collect results from jobs
+                for job in concurrent.futures.as_completed(jobs):
+                    result = job.result()
+                    tx_hashes.update(result['hashes'])
+                    for name in exon_usage:
+                        exon_usage[name] += result['exon_usage'][name]
+            logger.info('Saving assembly store...')
+            assembly_writer = assembly_store.AssemblyWriter(assembly_path(args), store)
+            try:
+                # parts are written into the memory mapped store one at a time
+                for part_path in part_paths:
+                    part = assembly_store.load_part(part_path)
+                    assembly_writer.add(part['tx_indices'], part)
+                    del part
+                assembly_writer.close()
+            finally:
+                assembly_writer.discard()
+    finally:
+        store.close()
+        store.unlink()
+        if os.path.exists(parts_dir):
+            shutil.rmtree(parts_dir)
     logger.debug('Transcript assembly complete!')
+    logger.info(tx_assembly.exon_report(exon_usage))
+    with checkpoints.HashWriter(args.out + '/txfeat_db/' + checkpoints.hash_file) as hash_writer:
+        hash_writer.write(tx_hashes)
 
-    # Breaking into manageable chunks
+    # Breaking into manageable chunks of neighbouring transcripts, passed to the workers as store indices
     logger.info('Dividing data into manageable chunks...')
-    tx_chunks = txfeat_functions.chunks(tx_assembled, 500)
-    fjobs = []
-    for item in tx_chunks:
-        fjobs.append(item)
+    store_path = args.from_assembly if args.from_assembly is not None else assembly_path(args)
+    assembly = assembly_store.AssemblyStore(store_path)
+    order = assembly.genomic_order()
+    assembly.close()
+    fjobs = [(store_path, order[i:i + 500]) for i in range(0, len(order), 500)]
 
-    # Construct txfeat dataframe
-    txfeat_df = []
+    # Sequence features and fold requests of every chunk in one pass, the workers spill the distinct sequences of
+    # their chunk to disk and only digests are passed back, sequences shared between transcripts are folded once
+    logger.info('Computing sequence features and collecting fold requests...')
+    spill_dir = args.out + '/' + fold_spill_dir
+    if not os.path.exists(spill_dir):
+        os.makedirs(spill_dir)
+    spill_paths = ['%s/chunk-%i.npy' % (spill_dir, i) for i in range(len(fjobs))]
+    try:
+        prepared = [None] * len(fjobs)
+        utilization = scheduler.Utilization('Sequence features', args.threads)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
+            jobs = {executor.submit(scheduler.timed, tx_features.spill_chunk, fjobs[i], i, spill_paths[i]): i
+                    for i in range(len(fjobs))}
+            for job in concurrent.futures.as_completed(jobs):
+                prepared[jobs[job]] = utilization.add(job.result())
+        utilization.log()
+        unique_seqs = {'rnafold': {}, 'rnalfold': {}}
+        num_requests = 0
+        for i, chunk in enumerate(prepared):
+            for kind, locations in unique_seqs.items():
+                num_requests += len(chunk[kind])
+                for digest in chunk[kind].values():
+                    if digest not in locations:
+                        locations[digest] = (spill_paths[i],) + tuple(chunk['sequences'][digest])
+            del chunk['sequences']
+        num_unique = len(unique_seqs['rnafold']) + len(unique_seqs['rnalfold'])
+        logger.info('Deduplication: %i fold requests, %i distinct sequences (dedup ratio %.2f)'
+                    % (num_requests, num_unique, num_requests / float(num_unique) if num_unique > 0 else 1))
+
+        # Fold distinct sequences in units of similar estimated cost, most expensive units are dispatched first
+        window = scheduler.lfold_window(build_config.cfg['rnalfold_command'])
+        fold_items = [(kind, (digest,) + location) for kind, locations in unique_seqs.items()
+                      for digest, location in locations.items()]
+        fold_costs = [scheduler.fold_cost(request[3], kind, window) for kind, request in fold_items]
+        units = scheduler.cost_units(fold_items, fold_costs, args.threads * scheduler.units_per_worker)
+        del unique_seqs, fold_items, fold_costs
+        fold_parts = []
+        for _, unit in units:
+            part = {'rnafold': [], 'rnalfold': []}
+            for kind, request in unit:
+                part[kind].append(request)
+            fold_parts.append(part)
+        del units
+        folds = {'rnafold': {}, 'rnalfold': {}}
+        fold_usage = {'hits': 0, 'misses': 0}
+        logger.info('Folding distinct region sequences...')
+        utilization = scheduler.Utilization('Folding', args.threads)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
+            jobs = [executor.submit(scheduler.timed, tx_features.fold_spilled, fold_parts[i], i)
+                    for i in range(len(fold_parts))]
+            for job in concurrent.futures.as_completed(jobs):
+                results = utilization.add(job.result())
+                for kind in folds:
+                    folds[kind].update(results[kind])
+                for name in fold_usage:
+                    fold_usage[name] += results['usage'][name]
+        utilization.log()
+        del fold_parts
+    finally:
+        if os.path.exists(spill_dir):
+            shutil.rmtree(spill_dir)
+    if build_config.cfg['fold_cache']:
+        logger.info(fold_cache.usage_report(fold_usage))
+
+    # Fold results are filled into the rows of the prepared chunks
     logger.info('Aggregating features for transcripts...')
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.threads) as executor:
-        # jobs = [executor.submit(tx_features.add_features, tx_assembled, tx_jobs[i], i) for i in njobs]
-        nchunks = range(len(fjobs))
-        lchunks = len(fjobs)
-        jobs = [executor.submit(tx_features.add_features, fjobs[i], i, lchunks, args.threads) for i in nchunks]
-
-        # collect results from jobs
-        for job in concurrent.futures.as_completed(jobs):
-            txfeat_df += job.result()
+    txfeat_df = []
+    for i in range(len(prepared)):
+        txfeat_df += tx_features.chunk_rows(prepared[i], folds, i, len(prepared), args.threads)
+        prepared[i] = None
     logger.debug('Transcript feature aggregation complete!')
 
-    # Save results to csv using pandas
+    # Save results to csv using pandas, typed formats through the partitioned writer
     logger.info('Saving txfeat_db to output directory...')
-    output = pd.DataFrame(txfeat_df).fillna(pd.np.nan)
-    output.to_csv(args.out + '/txfeat_db.csv', index=False, na_rep='NULL')
-
-    # Completion time
-    task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
-    logger.debug('It took %s minutes to construct txfeature database' % task_time)
+    if args.format == 'csv':
+        # missing values are written as NULL by na_rep
+        output = pd.DataFrame(txfeat_df)
+        output.to_csv(output_path(args), index=False, na_rep='NULL')
+    else:
+        with txfeat_writer.open_writer(args.format, output_path(args), tx_features.feature_schema) as writer:
+            writer.write(txfeat_df)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+"""
+In-process indexed fasta reader used for transcript assembly. The genome fasta is memory mapped and sequences are
+sliced directly using a samtools style .fai index, which is created next to the fasta file if missing. WindowedFasta
+and ExonCache add a reference window and an exon sequence cache in front of it for assembly in genomic order.
+"""
+
+import collections
+import logging
+import mmap
+import os
+
+# complement table covering nucleotides and IUPAC ambiguity codes, case is preserved
+_complement = str.maketrans('ACGTUNRYKMSWBDHVacgtunrykmswbdhv', 'TGCAANYRMKSWVHDBtgcaanyrmkswvhdb')
+
+
+def reverse_complement(seq):
+    """
+    Returns the reverse complement of a nucleotide sequence.
+    :param seq: nucleotide sequence as string
+    :return: reverse complement as string
+    """
+    return seq.translate(_complement)[::-1]
+
+
+def build_fai(fasta_path, fai_path=None):
+    """
+    Creates a samtools compatible .fai index (name, length, offset, line bases, line width) for the fasta file.
+    :param fasta_path: path to fasta file
+    :param fai_path: path of the index to write, defaults to <fasta_path>.fai
+    :return: path to the written index
+    """
+    logger = logging.getLogger(__name__ + '.build_fai')
+    logger.debug('Creating fasta index for %s' % fasta_path)
+    if fai_path is None:
+        fai_path = fasta_path + '.fai'
+
+    entries = []
+    entry = None
+    offset = 0
+    with open(fasta_path, 'rb') as fasta:
+        for line in fasta:
+            line_width = len(line)
+            if line[:1] == b'>':
+                name = line[1:].split()[0].decode()
+                entry = [name, 0, offset + line_width, 0, 0, False]
+                entries.append(entry)
+            elif entry is not None:
+                line_bases = len(line.rstrip(b'\r\n'))
+                if line_bases > 0:
+                    # all lines except the last of an entry must have the same length
+                    if entry[5]:
+                        raise ValueError('Fasta entry %s has lines of different length, cannot index %s'
+                                         % (entry[0], fasta_path))
+                    if entry[3] == 0:
+                        entry[3] = line_bases
+                        entry[4] = line_width
+                    elif line_bases != entry[3] or line_width != entry[4]:
+                        entry[5] = True
+                    entry[1] += line_bases
+            offset += line_width
+
+    with open(fai_path, 'w') as fai:
+        for name, length, seq_offset, line_bases, line_width, _ in entries:
+            fai.write('%s\t%i\t%i\t%i\t%i\n' % (name, length, seq_offset, line_bases, line_width))
+    return fai_path
+
+
+def read_fai(fai_path):
+    """
+    Reads a .fai index into a dictionary.
+    :param fai_path: path to .fai file
+    :return: dict of chrom -> (length, offset, line bases, line width)
+    """
+    index = {}
+    with open(fai_path, 'r') as fai:
+        for line in fai:
+            fields = line.rstrip('\n').split('\t')
+            index[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]))
+    return index
+
+
+class IndexedFasta:
+    """Memory mapped fasta file allowing random access to sequences by genomic coordinates."""
+
+    def __init__(self, fasta_path):
+        self.fasta_path = fasta_path
+        fai_path = fasta_path + '.fai'
+        if not os.path.isfile(fai_path) or os.path.getmtime(fai_path) < os.path.getmtime(fasta_path):
+            build_fai(fasta_path, fai_path)
+        self.index = read_fai(fai_path)
+        self._file = open(fasta_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _byte_offset(self, chrom_index, position):
+        """File offset of 0-based position of a sequence."""
+        length, offset, line_bases, line_width = chrom_index
+        return offset + (position // line_bases) * line_width + position % line_bases
+
+    def fetch(self, chrom, start, stop, strand='+'):
+        """
+        Extracts sequence of a genomic region.
+        :param chrom: sequence name as found in the fasta header
+        :param start: 1-based start coordinate (inclusive)
+        :param stop: 1-based stop coordinate (inclusive)
+        :param strand: '+' or '-', sequence is reverse complemented for '-'
+        :return: sequence as string
+        """
+        if chrom not in self.index:
+            raise KeyError('Sequence %s not found in %s' % (chrom, self.fasta_path))
+        chrom_index = self.index[chrom]
+        if start < 1 or stop > chrom_index[0] or start > stop + 1:
+            raise ValueError('Coordinates %s:%i-%i out of range for %s' % (chrom, start, stop, self.fasta_path))
+
+        raw = self._mmap[self._byte_offset(chrom_index, start - 1):self._byte_offset(chrom_index, stop)]
+        seq = raw.decode().replace('\n', '').replace('\r', '')
+        if strand == '-':
+            seq = reverse_complement(seq)
+        return seq
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class WindowedFasta:
+    """
+    Indexed fasta keeping a window of decoded reference sequence, fetches of neighbouring transcripts processed in
+    genomic order are served from the window instead of being sliced and decoded from the fasta again.
+    :param fasta_path: path to fasta file
+    :param window_size: number of bases loaded when a fetch falls outside of the current window
+    """
+
+    def __init__(self, fasta_path, window_size=262144):
+        self.fasta = IndexedFasta(fasta_path)
+        self.index = self.fasta.index
+        self.window_size = window_size
+        self.hits = 0
+        self.misses = 0
+        self._chrom = None
+        self._start = 0
+        self._stop = -1
+        self._seq = ''
+        self._expected = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _covers(self, chrom, start, stop):
+        return chrom == self._chrom and self._start <= start and stop <= self._stop
+
+    def _load(self, chrom, start, stop):
+        """Moves the window to start at start and cover at least stop."""
+        if chrom not in self.index:
+            raise KeyError('Sequence %s not found in %s' % (chrom, self.fasta.fasta_path))
+        self.misses += 1
+        window_stop = min(max(stop, start + self.window_size - 1), self.index[chrom][0])
+        self._seq = self.fasta.fetch(chrom, start, window_stop)
+        self._chrom = chrom
+        self._start = start
+        self._stop = window_stop
+
+    def expect(self, chrom, start, stop):
+        """
+        Announces the region of the next fetches (ex. the span of a transcript), the window is moved to cover the whole
+        region at the first fetch within it that misses the current window.
+        :param start: 1-based start coordinate (inclusive)
+        :param stop: 1-based stop coordinate (inclusive)
+        """
+        self._expected = (chrom, start, stop)
+
+    def fetch(self, chrom, start, stop, strand='+'):
+        """Extracts sequence of a genomic region, see IndexedFasta.fetch."""
+        if self._covers(chrom, start, stop):
+            self.hits += 1
+        else:
+            if chrom in self.index and (start < 1 or stop > self.index[chrom][0] or start > stop + 1):
+                raise ValueError('Coordinates %s:%i-%i out of range for %s'
+                                 % (chrom, start, stop, self.fasta.fasta_path))
+            expected = self._expected
+            if expected is not None and expected[0] == chrom and expected[1] <= start and stop <= expected[2]:
+                self._load(*expected)
+            else:
+                self._load(chrom, start, stop)
+        seq = self._seq[start - self._start:stop - self._start + 1]
+        if strand == '-':
+            seq = reverse_complement(seq)
+        return seq
+
+    def close(self):
+        self._seq = ''
+        self.fasta.close()
+
+
+class ExonCache:
+    """
+    Least recently used cache of exon sequences keyed by (chrom, start, stop, strand) in front of a fasta reader, exons
+    shared by the isoforms of a gene are only extracted once.
+    :param fasta: IndexedFasta or WindowedFasta
+    :param max_entries: number of exon sequences kept
+    """
+
+    def __init__(self, fasta, max_entries=4096):
+        self.fasta = fasta
+        self.index = fasta.index
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._exons = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._exons)
+
+    def expect(self, chrom, start, stop):
+        """See WindowedFasta.expect, ignored by other readers."""
+        if hasattr(self.fasta, 'expect'):
+            self.fasta.expect(chrom, start, stop)
+
+    def fetch(self, chrom, start, stop, strand='+'):
+        """Extracts sequence of a genomic region, see IndexedFasta.fetch."""
+        key = (chrom, start, stop, strand)
+        seq = self._exons.get(key)
+        if seq is not None:
+            self.hits += 1
+            self._exons.move_to_end(key)
+            return seq
+        self.misses += 1
+        seq = self.fasta.fetch(chrom, start, stop, strand)
+        self._exons[key] = seq
+        if len(self._exons) > self.max_entries:
+            self._exons.popitem(last=False)
+        return seq
+
+    def close(self):
+        self._exons.clear()
+        self.fasta.close()
@@ -0,0 +1,208 @@
+"""
+Columnar store of the parsed gff annotation held in shared memory. The annotation is converted into numpy structured
+arrays (coordinates, feature type codes and indices into interned string tables) so that worker processes can attach
+to it zero-copy and only receive index ranges of transcripts to work on.
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from txfeature.db_builder import txfeat_functions
+
+# Transcript table, one row per transcript sorted by transcript id. Features of a transcript are found in
+# features[feat_start:feat_stop] and string columns are indices into the associated string table.
+tx_dtype = np.dtype([('gene_id', np.int32),
+                     ('gene_name', np.int32),
+                     ('tx_type', np.int32),
+                     ('chrom', np.int32),
+                     ('strand', 'S1'),
+                     ('feat_start', np.int64),
+                     ('feat_stop', np.int64)])
+
+# Feature table, ftype is the index of the feature type in txfeat_functions.tx_feature_types
+feature_dtype = np.dtype([('ftype', np.int8),
+                          ('exon_number', np.int32),
+                          ('start', np.int64),
+                          ('stop', np.int64)])
+
+# String tables stored alongside the transcript table
+string_tables = ['tx_id', 'gene_id', 'gene_name', 'tx_type', 'chrom']
+
+
+def _string_table(values):
+    """Converts list of strings into a fixed width bytes array."""
+    return np.array([value.encode() for value in values], dtype=bytes) if values else np.zeros(0, dtype='S1')
+
+
+class FeatureStore:
+    """
+    Shared memory backed annotation store. The parent process creates the store using FeatureStore.create and passes
+    FeatureStore.handle to worker processes which attach to the same memory using FeatureStore.attach.
+    """
+
+    def __init__(self, blocks, arrays, owner=False):
+        self._blocks = blocks
+        self._arrays = arrays
+        self._owner = owner
+        self.transcripts = arrays['transcripts']
+        self.features = arrays['features']
+        self.strings = {name: arrays['str_' + name] for name in string_tables}
+
+        # small string tables are decoded once
+        self._tx_types = [value.decode() for value in self.strings['tx_type']]
+        self._chroms = [value.decode() for value in self.strings['chrom']]
+
+    @classmethod
+    def create(cls, gff_ds):
+        """
+        Builds the columnar store from the structure returned by gff_parser.gff_table and places it in shared memory.
+        :param gff_ds: parsed gff file using gff_parser
+        :return: FeatureStore owning the shared memory blocks
+        """
+        tx_list = sorted(gff_ds['tx_attr'].keys())
+        type_code = {ftype: code for code, ftype in enumerate(txfeat_functions.tx_feature_types)}
+
+        # interned string tables
+        lookup = {name: {} for name in string_tables}
+
+        def intern_index(name, value):
+            if value not in lookup[name]:
+                lookup[name][value] = len(lookup[name])
+            return lookup[name][value]
+
+        transcripts = []
+        features = []
+        for tx in tx_list:
+            tx_attr = gff_ds['tx_attr'][tx]
+            intern_index('tx_id', tx)
+            feat_start = len(features)
+            for ftype, type_features in gff_ds['tx_index'].get(tx, {}).items():
+                if ftype not in type_code:
+                    continue
+                for exon_number, feature in type_features.items():
+                    features.append((type_code[ftype], exon_number, feature.start, feature.stop))
+            transcripts.append((intern_index('gene_id', tx_attr['gene_id']),
+                                intern_index('gene_name', tx_attr['gene_name']),
+                                intern_index('tx_type', tx_attr['tx_type']),
+                                intern_index('chrom', tx_attr['chrom']),
+                                tx_attr['strand'].encode(),
+                                feat_start,
+                                len(features)))
+        transcripts = np.array(transcripts, dtype=tx_dtype)
+        features = np.array(features, dtype=feature_dtype)
+
+        arrays = {'transcripts': transcripts, 'features': features}
+        for name in string_tables:
+            arrays['str_' + name] = _string_table(list(lookup[name].keys()))
+
+        # copy arrays into shared memory blocks
+        blocks = {}
+        shared = {}
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[name][...] = array
+            blocks[name] = block
+        return cls(blocks, shared, owner=True)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attaches to a store created in another process without copying the underlying data.
+        :param handle: FeatureStore.handle of the created store
+        """
+        blocks = {}
+        arrays = {}
+        for name, (block_name, dtype, shape) in handle.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            blocks[name] = block
+        return cls(blocks, arrays)
+
+    @property
+    def handle(self):
+        """Picklable description of the shared memory blocks used to attach from worker processes."""
+        return {name: (self._blocks[name].name, array.dtype, array.shape) for name, array in self._arrays.items()}
+
+    def __len__(self):
+        return len(self.transcripts)
+
+    def tx_id(self, index):
+        return self.strings['tx_id'][index].decode()
+
+    def tx_attr(self, index):
+        """Returns the attributes of transcript at index in the same form as gff_parser tx_attr entries."""
+        row = self.transcripts[index]
+        return {'gene_id': self.strings['gene_id'][row['gene_id']].decode(),
+                'chrom': self._chroms[row['chrom']],
+                'strand': row['strand'].decode(),
+                'gene_name': self.strings['gene_name'][row['gene_name']].decode(),
+                'tx_type': self._tx_types[row['tx_type']]}
+
+    def tx_annot(self, index):
+        """Returns the features of transcript at index in the tx_annot coordinate structure used by tx_build."""
+        row = self.transcripts[index]
+        tx_annot = {ftype: {} for ftype in txfeat_functions.tx_feature_types}
+        for feature in self.features[row['feat_start']:row['feat_stop']].tolist():
+            tx_annot[txfeat_functions.tx_feature_types[feature[0]]][feature[1]] = {'start': feature[2],
+                                                                                   'stop': feature[3]}
+        return tx_annot
+
+    def tx_spans(self, tx_indices=None):
+        """
+        Genomic span of transcripts covering all of their features.
+        :param tx_indices: store indices of the transcripts, all transcripts if None
+        :return: (starts, stops) arrays aligned with tx_indices (the transcript table if None), 0 for transcripts
+                 without features
+        """
+        if tx_indices is None:
+            tx_indices = np.arange(len(self.transcripts))
+        tx_indices = np.asarray(tx_indices, dtype=np.int64)
+        starts = np.zeros(len(tx_indices), dtype=np.int64)
+        stops = np.zeros(len(tx_indices), dtype=np.int64)
+        feat_start = self.transcripts['feat_start'][tx_indices].astype(np.int64)
+        counts = self.transcripts['feat_stop'][tx_indices] - feat_start
+        has_features = counts > 0
+        if has_features.any():
+            # features of a transcript are contiguous, only the feature ranges of the given transcripts are reduced
+            counts = counts[has_features]
+            offsets = np.cumsum(counts) - counts
+            selected = np.repeat(feat_start[has_features] - offsets, counts) + np.arange(int(counts.sum()))
+            low = np.minimum(self.features['start'][selected], self.features['stop'][selected])
+            high = np.maximum(self.features['start'][selected], self.features['stop'][selected])
+            starts[has_features] = np.minimum.reduceat(low, offsets)
+            stops[has_features] = np.maximum.reduceat(high, offsets)
+        return starts, stops
+
+    def tx_lengths(self):
+        """
+        Spliced length of every transcript, the summed length of its exons as assembled by tx_build.build.
+        :return: int64 array aligned with the transcript table
+        """
+        exons = np.flatnonzero(self.features['ftype'] == txfeat_functions.tx_feature_types.index('exon'))
+        tx_of_feature = np.repeat(np.arange(len(self.transcripts)),
+                                  self.transcripts['feat_stop'] - self.transcripts['feat_start'])
+        exon_lengths = np.maximum(self.features['stop'][exons] - self.features['start'][exons] + 1, 0)
+        return np.bincount(tx_of_feature[exons], weights=exon_lengths, minlength=len(self.transcripts)).astype(np.int64)
+
+    def genomic_order(self):
+        """
+        Transcript indices ordered by chromosome and start position, so consecutive transcripts read neighbouring
+        sequence of the genome. Chromosomes are ordered by their code in the chrom string table, which follows the
+        first transcript id (in sorted order) on each chromosome rather than the order of the annotation file.
+        """
+        starts, _ = self.tx_spans()
+        return np.lexsort((starts, self.transcripts['chrom']))
+
+    def close(self):
+        """Releases the views and detaches from the shared memory blocks."""
+        self.transcripts = self.features = self.strings = None
+        self._arrays = {}
+        for block in self._blocks.values():
+            block.close()
+
+    def unlink(self):
+        """Frees the shared memory blocks, only to be called by the process that created the store."""
+        if self._owner:
+            for block in self._blocks.values():
+                block.unlink()
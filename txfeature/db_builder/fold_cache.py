@@ -0,0 +1,247 @@
+"""
+Persistent fold energy cache shared between builds. Results of the fold engines are stored in a SQLite database keyed
+by the hash of the fold type, the engine signature (engine, ViennaRNA version or executable and fold command options)
+and the sequence, so unchanged sequences of a new annotation release are not folded again while results of another
+ViennaRNA release are never reused. The database runs in WAL mode so that worker processes
+can read and write concurrently. The least recently used entries are evicted once at the end of every build (see
+prune_build) or with txfeature fold_cache --prune, not by the fold jobs.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from txfeature.db_builder import fold_engine
+
+# maximum number of parameters used per query
+_query_size = 500
+
+# caches of the current process keyed by path, see cached_engine
+_caches = {}
+
+
+def cache_key(kind, signature, sequence):
+    """Content address of a fold result."""
+    return hashlib.sha1(('%s|%s|%s' % (kind, signature, sequence)).encode()).hexdigest()
+
+
+class FoldCache:
+    """
+    SQLite backed fold result cache.
+    :param path: path to the cache database, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=120)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS folds (key TEXT PRIMARY KEY, kind TEXT NOT NULL, '
+                             'signature TEXT NOT NULL, result TEXT NOT NULL, last_used INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS folds_last_used ON folds (last_used)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def get_many(self, keys):
+        """
+        Looks up results and marks them as recently used.
+        :param keys: list of cache keys
+        :return: dict of key -> result for the keys found in the cache
+        """
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), _query_size):
+            query_keys = keys[i:i + _query_size]
+            rows = self._db.execute('SELECT key, result FROM folds WHERE key IN (%s)'
+                                    % ','.join('?' * len(query_keys)), query_keys)
+            for key, result in rows:
+                found[key] = json.loads(result)
+        if found:
+            now = int(time.time())
+            hit_keys = list(found.keys())
+            with self._db:
+                for i in range(0, len(hit_keys), _query_size):
+                    query_keys = hit_keys[i:i + _query_size]
+                    self._db.execute('UPDATE folds SET last_used = ? WHERE key IN (%s)'
+                                     % ','.join('?' * len(query_keys)), [now] + query_keys)
+        return found
+
+    def put_many(self, kind, signature, results):
+        """
+        Stores results, entries are only evicted by prune.
+        :param results: dict of key -> result
+        """
+        if not results:
+            return
+        now = int(time.time())
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO folds VALUES (?, ?, ?, ?, ?)',
+                                 [(key, kind, signature, json.dumps(result), now) for key, result in results.items()])
+
+    def count_usage(self, hits, misses):
+        """Adds to the lifetime hit and miss counters of the cache."""
+        with self._db:
+            for name, value in [('hits', hits), ('misses', misses)]:
+                self._db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+                self._db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+
+    def counters(self):
+        """Lifetime hit and miss counters as dict."""
+        counters = {'hits': 0, 'misses': 0}
+        counters.update(dict(self._db.execute('SELECT name, value FROM counters')))
+        return counters
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM folds').fetchone()[0]
+
+    def prune(self, max_entries):
+        """
+        Evicts the least recently used entries until at most max_entries remain.
+        :return: number of evicted entries
+        """
+        excess = len(self) - max_entries
+        if excess <= 0:
+            return 0
+        with self._db:
+            self._db.execute('DELETE FROM folds WHERE key IN (SELECT key FROM folds ORDER BY last_used LIMIT ?)',
+                             (excess,))
+        return excess
+
+    def clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM folds')
+            self._db.execute('DELETE FROM counters')
+
+    def vacuum(self):
+        self._db.execute('VACUUM')
+
+    def summary(self):
+        """Number of entries per fold type and engine signature as list of (kind, signature, entries)."""
+        return self._db.execute('SELECT kind, signature, COUNT(*) FROM folds GROUP BY kind, signature '
+                                'ORDER BY kind, signature').fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+class CachedFoldEngine(fold_engine.FoldEngine):
+    """
+    Fold engine answering requests from the cache and folding only the missing sequences with the wrapped engine.
+    :param engine: FoldEngine computing results missing from the cache
+    :param cache: FoldCache
+    """
+
+    def __init__(self, engine, cache):
+        fold_engine.FoldEngine.__init__(self, engine.rnafold_command, engine.rnalfold_command)
+        self.name = engine.name
+        self.engine = engine
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def _fold(self, kind, requests, fold):
+        signature = self.engine.signature(kind)
+        keys = {key: cache_key(kind, signature, sequence) for key, sequence in requests.items()}
+        found = self.cache.get_many(set(keys.values()))
+        missing = {key: sequence for key, sequence in requests.items() if keys[key] not in found}
+        computed = fold(missing)
+        self.cache.put_many(kind, signature, {keys[key]: result for key, result in computed.items()})
+        self.cache.count_usage(len(requests) - len(missing), len(missing))
+        self.hits += len(requests) - len(missing)
+        self.misses += len(missing)
+
+        results = {key: found[keys[key]] for key in requests if keys[key] in found}
+        results.update(computed)
+        return results
+
+    def rnafold(self, requests):
+        return self._fold('rnafold', requests, self.engine.rnafold)
+
+    def rnalfold(self, requests):
+        return self._fold('rnalfold', requests, self.engine.rnalfold)
+
+    def close(self):
+        self.cache.close()
+
+
+def cached_engine(engine, path):
+    """
+    Wraps the engine with the cache at path, the cache connection is opened once per process.
+    """
+    key = (path, os.getpid())
+    if key not in _caches:
+        _caches[key] = FoldCache(path)
+    return CachedFoldEngine(engine, _caches[key])
+
+
+def prune_build(path, max_entries):
+    """
+    Evicts the least recently used entries of the cache once a build completed, the entries are counted once per build
+    instead of after every put of the fold jobs.
+    :param path: path to the cache database
+    :param max_entries: number of entries kept
+    :return: number of evicted entries
+    """
+    cache = FoldCache(path)
+    try:
+        return cache.prune(max_entries)
+    finally:
+        cache.close()
+
+
+def usage_report(usage):
+    """
+    Hit rate of the cache within a build, counted by the CachedFoldEngine of every job (the counters of the cache
+    database also count other builds sharing the cache).
+    :param usage: dict of 'hits' and 'misses' summed over the jobs of the build
+    :return: message for the build log
+    """
+    hits = usage['hits']
+    misses = usage['misses']
+    rate = 100.0 * hits / (hits + misses) if hits + misses > 0 else 0
+    return 'Fold cache: %i hits, %i misses (%.1f%% hit rate)' % (hits, misses, rate)
+
+
+def main():
+    # Setup of argparse for script arguments
+    parser = argparse.ArgumentParser(description="Inspect or prune the fold energy cache used by build_db.",
+                                     prog="txfeature fold_cache")
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument("-db", type=str, default=None, metavar="<cache_file>",
+                          help="specify path to the fold cache (fold_cache in build_db.cfg)", required=True)
+    optional.add_argument("--prune", type=int, default=None, metavar="<entries>",
+                          help="evict least recently used entries until at most <entries> remain")
+    optional.add_argument("--clear", action='store_true', help="remove all entries and counters")
+    optional.add_argument("--vacuum", action='store_true', help="reclaim unused space of the cache file")
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print('txfeature fold_cache: error: %s not found' % args.db)
+        return
+    cache = FoldCache(args.db)
+    if args.clear:
+        cache.clear()
+        print('Cleared fold cache.')
+    if args.prune is not None:
+        print('Evicted %i entries.' % cache.prune(args.prune))
+    if args.vacuum:
+        cache.vacuum()
+
+    counters = cache.counters()
+    lookups = counters['hits'] + counters['misses']
+    print('Fold cache: %s (%.1f MB)' % (args.db, os.path.getsize(args.db) / 1e6))
+    print('Entries: %i' % len(cache))
+    for kind, signature, entries in cache.summary():
+        print('  %-9s %-60s %i' % (kind, signature, entries))
+    print('Lifetime lookups: %i, hit rate %.1f%%'
+          % (lookups, 100.0 * counters['hits'] / lookups if lookups > 0 else 0))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Folding engines used to determine the structure energies of transcript regions. The engine is selected with the
+fold_engine option of build_db.cfg:
+    cli     - RNAfold / RNALfold executables run as persistent processes (see fold_service)
+    vienna  - ViennaRNA python bindings (RNA module) folding within the worker process
+Both engines take the rnafold_command and rnalfold_command options of build_db.cfg so that the same model settings are
+used and return the values with the precision printed by the executables.
+"""
+
+import abc
+import logging
+import shlex
+import shutil
+import subprocess
+
+from txfeature.db_builder import fold_service
+
+engine_names = ['cli', 'vienna']
+
+# engines of the current process, see get_engine
+_engines = {}
+
+
+class FoldEngine(abc.ABC):
+    """
+    Interface of the folding engines. Requests are dicts of request key -> sequence and results are returned as dicts
+    keyed by the same request keys, requests that could not be folded are left out of the results. Engines must
+    implement rnafold and rnalfold, an engine missing either fails when it is created.
+    """
+
+    name = None
+
+    def __init__(self, rnafold_command, rnalfold_command):
+        self.rnafold_command = rnafold_command
+        self.rnalfold_command = rnalfold_command
+
+    def version(self, kind):
+        """
+        Version of the folding software, energy parameters change between releases of ViennaRNA.
+        :param kind: 'rnafold' or 'rnalfold'
+        :return: version string, empty if the engine has none
+        """
+        return ''
+
+    def signature(self, kind):
+        """
+        String identifying the engine, its version and the fold parameters, results are only comparable for equal
+        signatures.
+        :param kind: 'rnafold' or 'rnalfold'
+        """
+        command = self.rnafold_command if kind == 'rnafold' else self.rnalfold_command
+        return '%s|%s|%s' % (self.name, self.version(kind), ' '.join(command.split()[1:]))
+
+    @abc.abstractmethod
+    def rnafold(self, requests):
+        """
+        Global folding of each sequence, see txseq_properties.rnafold_energy.
+        :return: dict of request key -> {'mfe', 'ensemble', 'centroid', 'mea'}
+        """
+
+    @abc.abstractmethod
+    def rnalfold(self, requests):
+        """
+        Local folding scan of each sequence, see txseq_properties.rnalfold_energy.
+        :return: dict of request key -> minimum free energy
+        """
+
+    def close(self):
+        pass
+
+
+class CliFoldEngine(FoldEngine):
+    """Folding through the RNAfold and RNALfold executables."""
+
+    name = 'cli'
+
+    def __init__(self, rnafold_command, rnalfold_command):
+        FoldEngine.__init__(self, rnafold_command, rnalfold_command)
+        self._service = fold_service.get_service(rnafold_command, rnalfold_command)
+        self._versions = {}
+
+    def version(self, kind):
+        """Resolved path of the executable (viennarna_dir or PATH) and the version it reports."""
+        if kind not in self._versions:
+            logger = logging.getLogger(__name__ + '.CliFoldEngine.version')
+            command = self.rnafold_command if kind == 'rnafold' else self.rnalfold_command
+            executable = command.split()[0]
+            executable = shutil.which(executable) or executable
+            try:
+                output = subprocess.run([executable, '--version'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60).stdout.strip()
+            except (OSError, subprocess.SubprocessError):
+                logger.debug('Could not determine the version of %s' % executable)
+                output = ''
+            self._versions[kind] = ('%s %s' % (executable, output)).strip()
+        return self._versions[kind]
+
+    def rnafold(self, requests):
+        return self._service.rnafold(requests)
+
+    def rnalfold(self, requests):
+        return self._service.rnalfold(requests)
+
+
+def _round(value):
+    """Rounds energy the way the executables print it (%6.2f)."""
+    return float('%.2f' % value)
+
+
+class ViennaFoldEngine(FoldEngine):
+    """
+    In-process folding using the ViennaRNA python bindings. Supported options of the commands are -T/--temp,
+    -d/--dangles, --noLP, --noGU and --MEA gamma for RNAfold, and additionally -L/--span for RNALfold.
+    """
+
+    name = 'vienna'
+
+    def __init__(self, rnafold_command, rnalfold_command):
+        FoldEngine.__init__(self, rnafold_command, rnalfold_command)
+        import RNA
+        self._rna = RNA
+        self._fold_md, self._mea_gamma = self._model_details(rnafold_command)
+        self._lfold_md, _ = self._model_details(rnalfold_command)
+        self._lfold_md.max_bp_span = self._lfold_md.window_size
+
+    def version(self, kind):
+        """Version of the ViennaRNA python bindings."""
+        return 'RNA %s' % getattr(self._rna, '__version__', '')
+
+    def _model_details(self, command):
+        """Model details of the ViennaRNA library matching the options of an RNAfold / RNALfold command."""
+        logger = logging.getLogger(__name__ + '.ViennaFoldEngine')
+        md = self._rna.md()
+        md.compute_bpp = 1
+        md.window_size = 150
+        mea_gamma = 1.0
+        options = shlex.split(command)[1:]
+        i = 0
+        while i < len(options):
+            option, _, value = options[i].partition('=')
+            if option in ['-T', '--temp', '-d', '--dangles', '-L', '--span'] and not value:
+                i += 1
+                value = options[i] if i < len(options) else ''
+            if option in ['-T', '--temp']:
+                md.temperature = float(value)
+            elif option in ['-d', '--dangles']:
+                md.dangles = int(value)
+            elif option in ['-L', '--span']:
+                md.window_size = int(value)
+            elif option == '--noLP':
+                md.noLP = 1
+            elif option == '--noGU':
+                md.noGU = 1
+            elif option == '--MEA':
+                if value:
+                    mea_gamma = float(value)
+                elif i + 1 < len(options) and not options[i + 1].startswith('-'):
+                    i += 1
+                    mea_gamma = float(options[i])
+            elif option not in ['-p', '--partfunc', '--noPS']:
+                logger.debug('Option %s of "%s" is not supported by the vienna fold engine and ignored'
+                             % (option, command))
+            i += 1
+        return md, mea_gamma
+
+    def rnafold(self, requests):
+        logger = logging.getLogger(__name__ + '.ViennaFoldEngine.rnafold')
+        results = {}
+        for key, sequence in requests.items():
+            if len(sequence) < 1:
+                results[key] = {'mfe': 0, 'ensemble': 0, 'centroid': 0, 'mea': 0}
+                continue
+            try:
+                fc = self._rna.fold_compound(sequence, self._fold_md)
+                structure, mfe = fc.mfe()
+                fc.exp_params_rescale(mfe)
+                structure, ensemble = fc.pf()
+                structure, distance = fc.centroid()
+                centroid = fc.eval_structure(structure)
+                structure, mea = fc.MEA(self._mea_gamma)
+                results[key] = {'mfe': _round(mfe),
+                                'ensemble': '%.2f' % ensemble,
+                                'centroid': _round(centroid),
+                                'mea': _round(fc.eval_structure(structure))}
+            except (ValueError, RuntimeError):
+                logger.debug('Could not fold request %s' % (key,))
+        return results
+
+    def rnalfold(self, requests):
+        logger = logging.getLogger(__name__ + '.ViennaFoldEngine.rnalfold')
+        results = {}
+        for key, sequence in requests.items():
+            if len(sequence) < 1:
+                results[key] = 0
+                continue
+            try:
+                fc = self._rna.fold_compound(sequence, self._lfold_md,
+                                             self._rna.OPTION_MFE | self._rna.OPTION_WINDOW)
+                # the local structures are not used, the callback only keeps them from being printed
+                results[key] = _round(fc.mfe_window_cb(lambda *hit: None, None))
+            except (ValueError, RuntimeError):
+                logger.debug('Could not fold request %s' % (key,))
+        return results
+
+
+_engine_classes = {'cli': CliFoldEngine, 'vienna': ViennaFoldEngine}
+
+
+def register_engine(engine_class):
+    """
+    Makes an additional fold engine available to the fold_engine option (ex. the stub engine of the benchmarks), the
+    engine must be registered before worker processes are started.
+    :param engine_class: FoldEngine subclass with a unique name
+    """
+    _engine_classes[engine_class.name] = engine_class
+    if engine_class.name not in engine_names:
+        engine_names.append(engine_class.name)
+
+
+def get_engine(name, rnafold_command, rnalfold_command):
+    """
+    Returns the fold engine of the current process, engines are created once and reused by every chunk the worker
+    process aggregates.
+    :param name: engine name as given by the fold_engine option, one of engine_names
+    """
+    key = (name, rnafold_command, rnalfold_command)
+    if key not in _engines:
+        if name not in _engine_classes:
+            raise ValueError('Unknown fold engine %s, expected one of %s' % (name, ', '.join(engine_names)))
+        _engines[key] = _engine_classes[name](rnafold_command, rnalfold_command)
+    return _engines[key]
@@ -0,0 +1,186 @@
+"""
+Persistent RNAfold / RNALfold processes used for feature aggregation. Instead of starting a shell and ViennaRNA for
+every sequence, each worker process keeps one long-lived RNAfold and RNALfold process and streams batches of sequences
+through stdin in fasta format. Output is parsed record by record as it arrives and results are returned keyed by the
+request keys of the batch.
+"""
+
+import logging
+import multiprocessing.util
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from txfeature.db_builder import txseq_properties
+
+# header of the record written after every batch, its output marks the end of the batch
+_end_header = 'txfeature_batch_end'
+
+# services of the current process, see get_service
+_services = {}
+
+
+class FoldProcess:
+    """
+    Long-lived ViennaRNA process reading fasta records from stdin.
+    :param command: command line of the program, ex. 'RNAfold --noPS --MEA -p'
+    :param parser: function parsing the output lines of a single record (header removed)
+    """
+
+    def __init__(self, command, parser):
+        self.command = command
+        self.parser = parser
+        self._process = None
+        # postscript files written by ViennaRNA for each record end up here instead of the working directory
+        self._work_dir = tempfile.mkdtemp(prefix='txfeature_fold_')
+
+    def _start(self):
+        logger = logging.getLogger(__name__ + '.FoldProcess')
+        logger.debug('Starting fold process: %s' % self.command)
+        self._process = subprocess.Popen(shlex.split(self.command),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         cwd=self._work_dir,
+                                         universal_newlines=True,
+                                         bufsize=1)
+
+    def _write(self, records):
+        """Writes the batch followed by the end record, runs in its own thread so stdout never fills up."""
+        try:
+            for header, sequence in records:
+                self._process.stdin.write('>%s\n%s\n' % (header, sequence))
+            self._process.stdin.write('>%s\nA\n' % _end_header)
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def run(self, requests):
+        """
+        Folds a batch of sequences.
+        :param requests: dict of request key -> sequence, sequences must not be empty
+        :return: dict of request key -> parsed result, records that could not be parsed are left out
+        """
+        logger = logging.getLogger(__name__ + '.FoldProcess.run')
+        results = {}
+        if not requests:
+            return results
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+
+        keys = list(requests.keys())
+        writer = threading.Thread(target=self._write,
+                                  args=(((str(i), requests[key]) for i, key in enumerate(keys)),),
+                                  daemon=True)
+        writer.start()
+
+        # lines are collected per record, lines before the first header belong to the end record of the last batch
+        header = None
+        lines = []
+        complete = False
+        for line in self._process.stdout:
+            line = line.rstrip('\n')
+            if line.startswith('>'):
+                self._parse_record(header, lines, keys, results)
+                header = line[1:].split()[0] if len(line) > 1 else ''
+                lines = []
+                if header == _end_header:
+                    complete = True
+                    break
+            else:
+                lines.append(line)
+        writer.join()
+
+        if not complete:
+            self._parse_record(header, lines, keys, results)
+            logger.info('Warning: %s exited unexpectedly, %i of %i sequences folded'
+                        % (self.command.split()[0], len(results), len(keys)))
+            self.close()
+        return results
+
+    def _parse_record(self, header, lines, keys, results):
+        if header is None or not header.isdigit() or int(header) >= len(keys):
+            return
+        try:
+            results[keys[int(header)]] = self.parser(lines)
+        except (IndexError, ValueError):
+            logger = logging.getLogger(__name__ + '.FoldProcess')
+            logger.debug('Could not parse %s output for request %s' % (self.command.split()[0], keys[int(header)]))
+
+    def close(self):
+        """Stops the process, it is restarted on the next call of run."""
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+    def cleanup(self):
+        self.close()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+
+class FoldService:
+    """
+    RNAfold and RNALfold processes of a worker.
+    :param rnafold_command: RNAfold command line as used in build_db.cfg
+    :param rnalfold_command: RNALfold command line as used in build_db.cfg
+    """
+
+    def __init__(self, rnafold_command, rnalfold_command):
+        self._rnafold = FoldProcess(rnafold_command, txseq_properties.parse_rnafold)
+        self._rnalfold = FoldProcess(rnalfold_command, txseq_properties.parse_rnalfold)
+
+    def rnafold(self, requests):
+        """
+        Batch version of txseq_properties.rnafold_energy.
+        :param requests: dict of request key -> sequence
+        :return: dict of request key -> {'mfe', 'ensemble', 'centroid', 'mea'}
+        """
+        results = {key: {'mfe': 0, 'ensemble': 0, 'centroid': 0, 'mea': 0}
+                   for key, sequence in requests.items() if len(sequence) < 1}
+        results.update(self._rnafold.run({key: sequence for key, sequence in requests.items() if len(sequence) > 0}))
+        return results
+
+    def rnalfold(self, requests):
+        """
+        Batch version of txseq_properties.rnalfold_energy.
+        :param requests: dict of request key -> sequence
+        :return: dict of request key -> minimum free energy
+        """
+        results = {key: 0 for key, sequence in requests.items() if len(sequence) < 1}
+        results.update(self._rnalfold.run({key: sequence for key, sequence in requests.items() if len(sequence) > 0}))
+        return results
+
+    def close(self):
+        self._rnafold.cleanup()
+        self._rnalfold.cleanup()
+
+
+def get_service(rnafold_command, rnalfold_command):
+    """
+    Returns the FoldService of the current process for the commands, processes are started once and reused by every
+    chunk the worker process aggregates.
+    """
+    key = (rnafold_command, rnalfold_command)
+    if key not in _services:
+        if not _services:
+            # pool worker processes skip atexit handlers but do run the multiprocessing finalizers registered by the
+            # process itself on shutdown
+            multiprocessing.util.Finalize(None, _close_services, exitpriority=10)
+        _services[key] = FoldService(rnafold_command, rnalfold_command)
+    return _services[key]
+
+
+def _close_services():
+    for service in _services.values():
+        service.close()
+    _services.clear()
@@ -2,32 +2,84 @@
 Takes gff annotation files as input and parses the entries and returns a dictionary.
 """
 
+import sys
 
-def gff_table(file):
+from txfeature.db_builder.tx_classes import GffFeature
+
+
+def gff_attributes(attr_field):
+    """
+    Splits the gff3 attribute column into a dictionary of tag/value pairs.
+    :param attr_field: ninth column of a gff3 line as string
+    :return: dict of attribute tags and values
+    """
+    attr = {}
+    for item in attr_field.split(';'):
+        tag, _, value = item.partition('=')
+        attr[tag] = value
+    return attr
+
+
+def gff_table(gff_file):
+    """
+    Streams through a gff3 file once and stores every transcript associated entry as a typed GffFeature record in a
+    transcript index grouped by feature type and exon number. Features without an exon number (ex.
+    'stop_codon_redefined_as_selenocysteine') are keyed 0, -1, -2, ... in order of appearance. Repeated strings (chrom,
+    source, feature type, strand, gene and transcript ids) are interned so that records of the same gene or transcript
+    share a single copy of each string.
+    :param gff_file: path to the gff3 annotation file
+    :return: dict with keys 'tx_index' (transcript_id -> feature_type -> exon_number -> GffFeature), 'tx_attr'
+             (transcript_id -> attributes) and 'num_lines' (number of lines read from the file)
+    """
     # Initializing the gff annotation data structure which will be used within the pipeline
-    gff_ds = {'table': {}, 'tx_attr': {}}
+    gff_ds = {'tx_index': {}, 'tx_attr': {}, 'num_lines': 0}
+    tx_index = gff_ds['tx_index']
+    tx_attr = gff_ds['tx_attr']
+    intern = sys.intern
+    num_lines = 0
 
     # Iterate through gff3 input and store information
-    for gff_line in file:
-
-        # Skip all non-data containing lines
-        if gff_line[0][0] == "#":
-            continue
-
-        # The following describes the parsing instructions to create the gff data structure
-        # gff is parsed and each line is stored into gff_ds under the associated gene
-        # transcript to gene association is stored under tx2gene
-        attr = dict(item.split('=') for item in gff_line[8].split(';'))
-        gene_id = attr['gene_id']
-        if gff_line[2] == 'transcript':
-            gff_ds['tx_attr'][attr['transcript_id']] = {'gene_id': gene_id,
-                                                        'chrom': gff_line[0],
-                                                        'strand': gff_line[6],
-                                                        'gene_name': attr['gene_name'],
-                                                        'tx_type': attr['transcript_type']}
-        if gene_id not in gff_ds['table'].keys():
-            gff_ds['table'][gene_id] = []
-        # Entry of gff data line into gff_ds['table']
-        gff_ds['table'][gene_id].append(gff_line)
+    with open(gff_file, 'r') as file:
+        for line in file:
+            num_lines += 1
+
+            # Skip all non-data containing lines
+            if line[0] == '#' or line == '\n':
+                continue
+
+            # The following describes the parsing instructions to create the gff data structure
+            # gff is parsed and each line is stored as a GffFeature under the associated transcript and feature type
+            # transcript to gene association is stored under tx_attr
+            gff_line = line.rstrip('\n').split('\t')
+            attr = gff_attributes(gff_line[8])
+            gene_id = intern(attr['gene_id'])
+            tx_id = attr.get('transcript_id')
+            if tx_id is not None:
+                tx_id = intern(tx_id)
+            exon_number = attr.get('exon_number')
+            feature = GffFeature(intern(gff_line[0]), intern(gff_line[1]), intern(gff_line[2]), int(gff_line[3]),
+                                 int(gff_line[4]), intern(gff_line[6]), gff_line[7], gene_id, tx_id,
+                                 int(exon_number) if exon_number is not None else None, attr.get('exon_id'))
+
+            if feature.feature_type == 'transcript':
+                tx_attr[tx_id] = {'gene_id': gene_id,
+                                  'chrom': feature.chrom,
+                                  'strand': feature.strand,
+                                  'gene_name': intern(attr['gene_name']),
+                                  'tx_type': intern(attr['transcript_type'])}
+            # Entry of gff feature record into gff_ds['tx_index']
+            if tx_id is None or feature.feature_type == 'transcript':
+                continue
+            if tx_id not in tx_index:
+                tx_index[tx_id] = {}
+            tx_features = tx_index[tx_id]
+            if feature.feature_type not in tx_features:
+                tx_features[feature.feature_type] = {}
+            type_features = tx_features[feature.feature_type]
+            if feature.exon_number is not None:
+                type_features[feature.exon_number] = feature
+            else:
+                type_features[-len(type_features)] = feature
 
+    gff_ds['num_lines'] = num_lines
     return gff_ds
@@ -0,0 +1,77 @@
+"""
+Interval algebra on genomic (start, stop) blocks. All coordinates are 1-based and inclusive, so the cost of every
+operation scales with the number of blocks instead of the number of bases they cover.
+"""
+
+
+def region_blocks(exon_dict):
+    """
+    Converts a tx_annot region (ex. tx_annot['CDS']) into a list of (start, stop) blocks sorted by start.
+    :param exon_dict: dict of exon_number -> {'start': int, 'stop': int}
+    :return: list of (start, stop) tuples with start <= stop
+    """
+    blocks = []
+    for coord in exon_dict.values():
+        if coord['start'] < coord['stop']:
+            blocks.append((coord['start'], coord['stop']))
+        else:
+            blocks.append((coord['stop'], coord['start']))
+    blocks.sort()
+    return blocks
+
+
+def length(blocks):
+    """Total number of bases covered by the blocks (overlapping blocks are counted once per block)."""
+    return sum(stop - start + 1 for start, stop in blocks)
+
+
+def span(blocks):
+    """
+    Lowest and highest coordinate covered by the blocks.
+    :return: (min, max) tuple, raises ValueError for an empty list of blocks
+    """
+    if not blocks:
+        raise ValueError('span() of empty region')
+    return min(start for start, _ in blocks), max(stop for _, stop in blocks)
+
+
+def merge(blocks):
+    """Merges overlapping and adjacent blocks into a sorted list of disjoint blocks."""
+    merged = []
+    for start, stop in sorted(blocks):
+        if merged and start <= merged[-1][1] + 1:
+            if stop > merged[-1][1]:
+                merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def overlaps(blocks, start, stop):
+    """Checks if any block shares at least one base with the interval start-stop."""
+    for block_start, block_stop in blocks:
+        if block_start <= stop and start <= block_stop:
+            return True
+    return False
+
+
+def intersect(blocks_a, blocks_b):
+    """
+    Intersection of two sets of blocks.
+    :return: sorted list of disjoint (start, stop) blocks covered by both inputs
+    """
+    blocks_a = merge(blocks_a)
+    blocks_b = merge(blocks_b)
+    result = []
+    i = 0
+    j = 0
+    while i < len(blocks_a) and j < len(blocks_b):
+        start = max(blocks_a[i][0], blocks_b[j][0])
+        stop = min(blocks_a[i][1], blocks_b[j][1])
+        if start <= stop:
+            result.append((start, stop))
+        if blocks_a[i][1] < blocks_b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
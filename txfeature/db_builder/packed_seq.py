@@ -0,0 +1,421 @@
+"""
+2-bit packed nucleotide sequences. A, C, G and T are stored in 2 bits per base together with sparse lists of runs of
+other characters (N and IUPAC codes) and of soft-masked (lower case) bases, so sequences convert back to the original
+strings without loss.
+
+PackedBatch holds many sequences in one contiguous buffer with per sequence offsets, the layout of the sequences of
+assembly_store. Base counts of all sequences are looked up per packed byte in one vectorized pass and the batch
+unpacks into a txseq_batch.SeqBatch without building a string per sequence.
+
+PackedSeq is a single packed sequence for random access to one transcript. Slices are views on the packed bytes, base
+counts are looked up per packed byte and k-mers are read from the 2-bit codes, none of them unpack the whole sequence.
+Its per object overhead makes it larger than a str for transcripts of a few hundred bases, sequences of many
+transcripts are held in a PackedBatch.
+"""
+
+import numpy as np
+
+from txfeature.db_builder import txseq_batch
+from txfeature.db_builder.fasta_index import reverse_complement
+
+# 2-bit code of A, C, G, T (either case), 255 for any other character
+bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+codes = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    codes[_base] = _code
+    codes[_base + 32] = _code
+
+mask_dtype = np.dtype([('start', np.int64), ('length', np.int64), ('char', 'S1')])
+lower_dtype = np.dtype([('start', np.int64), ('length', np.int64)])
+# runs of a PackedBatch carry the index of their sequence
+batch_mask_dtype = np.dtype([('tx', np.int64), ('start', np.int64), ('length', np.int64), ('char', 'S1')])
+batch_lower_dtype = np.dtype([('tx', np.int64), ('start', np.int64), ('length', np.int64)])
+
+# bases of a byte are stored from the most significant bits
+_shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+_byte_codes = (np.arange(256, dtype=np.uint8)[:, None] >> _shifts) & 3
+# per byte lookup tables of the unpacked bases, the number of each code and the byte holding its bases reversed
+_unpacked = bases[_byte_codes]
+_code_counts = np.stack([(_byte_codes == code).sum(axis=1) for code in range(4)], axis=1).astype(np.int64)
+_reversed = (_byte_codes[:, ::-1].astype(np.uint8) << _shifts).sum(axis=1).astype(np.uint8)
+# number of G and C codes of every byte
+_gc_counts = (_code_counts[:, 1] + _code_counts[:, 2]).astype(np.uint8)
+
+
+def pack_codes(seq_codes):
+    """
+    :param seq_codes: array of 2-bit codes
+    :return: uint8 array of packed codes, the last byte is padded with code 0
+    """
+    padded = np.zeros((len(seq_codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(seq_codes)] = seq_codes
+    return (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+
+
+def _runs(flags, values=None, groups=None):
+    """Start positions and lengths of runs of set flags (holding equal values) that do not cross groups."""
+    continued = np.zeros(len(flags), dtype=bool)
+    continued[1:] = flags[1:] & flags[:-1]
+    if values is not None:
+        continued[1:] &= values[1:] == values[:-1]
+    if groups is not None:
+        continued[1:] &= groups[1:] == groups[:-1]
+    run_starts = np.flatnonzero(flags & ~continued)
+    run_ids = np.cumsum(flags & ~continued) - 1
+    return run_starts, np.bincount(run_ids[flags], minlength=len(run_starts))
+
+
+def _copy_runs(runs, dtype):
+    copied = np.zeros(len(runs), dtype=dtype)
+    for name in dtype.names:
+        copied[name] = runs[name]
+    return copied
+
+
+def kmer_string(code, k):
+    """Sequence of a k-mer code as returned by PackedSeq.kmer_codes."""
+    return ''.join('ACGT'[(int(code) >> (2 * (k - 1 - i))) & 3] for i in range(k))
+
+
+class PackedSeq:
+    """
+    Nucleotide sequence packed into 2 bits per base.
+    :param seq: sequence as string
+    """
+
+    __slots__ = ('_packed', '_offset', '_length', '_mask', '_lower', '_counts')
+
+    def __init__(self, seq):
+        raw = np.frombuffer(seq.encode(), dtype=np.uint8)
+        seq_codes = codes[raw]
+        other = seq_codes == 255
+        lower = (raw >= ord('a')) & ~other
+        seq_codes[other] = 0
+        self._packed = pack_codes(seq_codes)
+        self._offset = 0
+        self._length = len(raw)
+        mask_starts, mask_lengths = _runs(other, raw)
+        self._mask = np.zeros(len(mask_starts), dtype=mask_dtype)
+        self._mask['start'] = mask_starts
+        self._mask['length'] = mask_lengths
+        self._mask['char'] = raw[mask_starts].view('S1')
+        lower_starts, lower_lengths = _runs(lower)
+        self._lower = np.zeros(len(lower_starts), dtype=lower_dtype)
+        self._lower['start'] = lower_starts
+        self._lower['length'] = lower_lengths
+        self._counts = None
+
+    @classmethod
+    def from_packed(cls, packed, length, mask, lower, offset=0):
+        """
+        PackedSeq on already packed bytes, the bytes are not copied (ex. memory mapped by assembly_store).
+        :param packed: uint8 array of packed codes
+        :param length: number of bases
+        :param mask: runs of other characters with fields 'start', 'length' and 'char'
+        :param lower: runs of soft-masked bases with fields 'start' and 'length'
+        :param offset: position of the first base within packed
+        """
+        packed_seq = cls.__new__(cls)
+        packed_seq._packed = packed
+        packed_seq._offset = offset
+        packed_seq._length = length
+        packed_seq._mask = _copy_runs(mask, mask_dtype)
+        packed_seq._lower = _copy_runs(lower, lower_dtype)
+        packed_seq._counts = None
+        return packed_seq
+
+    def __getstate__(self):
+        # only the bytes holding the bases are pickled, slices do not carry the bytes of their parent
+        first = self._offset // 4
+        last = (self._offset + self._length + 3) // 4
+        return np.asarray(self._packed[first:last]).tobytes(), self._offset - first * 4, self._length, self._mask, \
+            self._lower
+
+    def __setstate__(self, state):
+        packed, self._offset, self._length, self._mask, self._lower = state
+        self._packed = np.frombuffer(packed, dtype=np.uint8)
+        self._counts = None
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return self._unpack(0, self._length).tobytes().decode()
+
+    def __repr__(self):
+        seq = str(self[:20]) + ('...' if self._length > 20 else '')
+        return 'PackedSeq(%r, length=%i)' % (seq, self._length)
+
+    def __eq__(self, other):
+        if isinstance(other, (PackedSeq, str)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    @property
+    def nbytes(self):
+        """Bytes used by the packed bases and the run lists."""
+        return (self._length + 3) // 4 + self._mask.nbytes + self._lower.nbytes
+
+    def _codes(self, start, stop):
+        """2-bit codes of the bases start to stop (exclusive)."""
+        first = (self._offset + start) // 4
+        last = (self._offset + stop + 3) // 4
+        skip = self._offset + start - first * 4
+        return _byte_codes[np.asarray(self._packed[first:last])].ravel()[skip:skip + stop - start]
+
+    def _unpack(self, start, stop):
+        """Characters of the bases start to stop (exclusive) as uint8 array."""
+        first = (self._offset + start) // 4
+        last = (self._offset + stop + 3) // 4
+        skip = self._offset + start - first * 4
+        chars = _unpacked[np.asarray(self._packed[first:last])].ravel()[skip:skip + stop - start].copy()
+        for run in self._lower[self._overlapping(self._lower, start, stop)]:
+            chars[max(run['start'], start) - start:min(run['start'] + run['length'], stop) - start] += 32
+        for run in self._mask[self._overlapping(self._mask, start, stop)]:
+            chars[max(run['start'], start) - start:min(run['start'] + run['length'], stop) - start] = ord(run['char'])
+        return chars
+
+    @staticmethod
+    def _overlapping(runs, start, stop):
+        """Slice of the runs overlapping the bases start to stop (exclusive), runs are sorted and do not overlap."""
+        if stop <= start:
+            return slice(0, 0)
+        first = np.searchsorted(runs['start'] + runs['length'], start, side='right')
+        last = np.searchsorted(runs['start'], stop, side='left')
+        return slice(first, max(first, last))
+
+    def _count_codes(self, start, stop):
+        """Number of bases of each 2-bit code between start and stop (exclusive)."""
+        first = -(-(self._offset + start) // 4)
+        last = (self._offset + stop) // 4
+        if last - first < 2:
+            return np.bincount(self._codes(start, stop), minlength=4).astype(np.int64)
+        counts = _code_counts[np.asarray(self._packed[first:last])].sum(axis=0)
+        counts += np.bincount(self._codes(start, first * 4 - self._offset), minlength=4)
+        counts += np.bincount(self._codes(last * 4 - self._offset, stop), minlength=4)
+        return counts
+
+    def base_counts(self):
+        """
+        Number of each character in the sequence as counted by str.count.
+        :return: dict of character -> count, characters not in the sequence are missing
+        """
+        if self._counts is None:
+            upper = self._count_codes(0, self._length)
+            lower = np.zeros(4, dtype=np.int64)
+            counts = {}
+            for run in self._mask:
+                upper -= self._count_codes(run['start'], run['start'] + run['length'])
+                char = run['char'].decode()
+                counts[char] = counts.get(char, 0) + int(run['length'])
+            for run in self._lower:
+                run_counts = self._count_codes(run['start'], run['start'] + run['length'])
+                upper -= run_counts
+                lower += run_counts
+            for code, base in enumerate('ACGT'):
+                for char, count in [(base, upper[code]), (base.lower(), lower[code])]:
+                    if count > 0:
+                        counts[char] = int(count)
+            self._counts = counts
+        return self._counts
+
+    def count(self, sub):
+        """str.count of the sequence, single characters are counted without unpacking."""
+        if len(sub) == 1:
+            return self.base_counts().get(sub, 0)
+        return str(self).count(sub)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                return PackedSeq(str(self)[key])
+            stop = max(start, stop)
+            mask = self._mask[self._overlapping(self._mask, start, stop)].copy()
+            lower = self._lower[self._overlapping(self._lower, start, stop)].copy()
+            for runs in [mask, lower]:
+                run_stops = np.minimum(runs['start'] + runs['length'], stop)
+                runs['start'] = np.maximum(runs['start'], start) - start
+                runs['length'] = run_stops - start - runs['start']
+            return PackedSeq.from_packed(self._packed, stop - start, mask, lower, self._offset + start)
+        index = key + self._length if key < 0 else key
+        if index < 0 or index >= self._length:
+            raise IndexError('PackedSeq index out of range')
+        return self._unpack(index, index + 1).tobytes().decode()
+
+    def reverse_complement(self):
+        """Reverse complement as PackedSeq, ambiguity codes are complemented and soft-masking is kept."""
+        first = self._offset // 4
+        last = (self._offset + self._length + 3) // 4
+        packed = _reversed[np.asarray(self._packed[first:last])[::-1] ^ 0xFF]
+        offset = (last - first) * 4 - (self._offset - first * 4 + self._length)
+        mask = self._mask[::-1].copy()
+        lower = self._lower[::-1].copy()
+        for runs in [mask, lower]:
+            runs['start'] = self._length - runs['start'] - runs['length']
+        mask['char'] = [reverse_complement(char.decode()).encode() for char in mask['char']]
+        return PackedSeq.from_packed(packed, self._length, mask, lower, offset)
+
+    def kmer_codes(self, k):
+        """
+        2-bit codes of all k-mers, the code of a k-mer is its bases as base 4 number with A = 0, C = 1, G = 2, T = 3
+        (see kmer_string), case is ignored.
+        :param k: k-mer length, at most 31
+        :return: int64 array of the code of the k-mer starting at each position, -1 for k-mers holding other
+                 characters than A, C, G, T
+        """
+        if k < 1 or k > 31:
+            raise ValueError('k-mer length must be between 1 and 31, got %i' % k)
+        if self._length < k:
+            return np.zeros(0, dtype=np.int64)
+        seq_codes = self._codes(0, self._length).astype(np.int64)
+        kmers = np.zeros(self._length - k + 1, dtype=np.int64)
+        for i in range(k):
+            kmers = (kmers << 2) | seq_codes[i:i + len(kmers)]
+        # k-mers overlapping a masked run are invalid
+        masked = np.zeros(self._length + 1, dtype=np.int64)
+        np.add.at(masked, self._mask['start'], 1)
+        np.add.at(masked, self._mask['start'] + self._mask['length'], -1)
+        masked = np.cumsum(masked[:-1]) > 0
+        covered = np.concatenate(([0], np.cumsum(masked)))
+        kmers[covered[k:] - covered[:-k] > 0] = -1
+        return kmers
+
+
+def range_positions(starts, lengths):
+    """Positions covered by the ranges starts[i] to starts[i] + lengths[i] (exclusive), concatenated in order."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    range_starts = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(starts, dtype=np.int64) - range_starts, lengths) + np.arange(lengths.sum())
+
+
+class PackedBatch:
+    """
+    Many sequences packed into one contiguous buffer of 2 bits per base, every sequence starts on a byte. Sequence i is
+    held by packed[byte_offsets[i]:byte_offsets[i + 1]], field 'tx' of the runs is the index of their sequence and
+    'start' the position within it.
+    :param packed: uint8 array of packed codes
+    :param lengths: number of bases of every sequence
+    :param mask: runs of other characters with fields 'tx', 'start', 'length' and 'char' sorted by tx and start
+    :param lower: runs of soft-masked bases with fields 'tx', 'start' and 'length' sorted by tx and start
+    """
+
+    def __init__(self, packed, lengths, mask, lower):
+        self.packed = packed
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.byte_offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum((self.lengths + 3) // 4, out=self.byte_offsets[1:])
+        self.mask = mask
+        self.lower = lower
+        self._unpacked = None
+
+    @classmethod
+    def pack(cls, sequences):
+        """
+        :param sequences: list of sequences as strings or PackedSeq
+        :return: PackedBatch of the sequences
+        """
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        raw = np.frombuffer(''.join(str(seq) for seq in sequences).encode(), dtype=np.uint8)
+        tx_of_base = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths)
+        seq_starts = np.cumsum(lengths) - lengths
+        seq_codes = codes[raw]
+        other = seq_codes == 255
+        lower = (raw >= ord('a')) & (raw <= ord('z')) & ~other
+        seq_codes[other] = 0
+
+        packed_lengths = (lengths + 3) // 4
+        padded = np.zeros(int(packed_lengths.sum()) * 4, dtype=np.uint8)
+        padded[range_positions((np.cumsum(packed_lengths) - packed_lengths) * 4, lengths)] = seq_codes
+        packed = (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+
+        mask_starts, mask_lengths = _runs(other, raw, tx_of_base)
+        mask = np.zeros(len(mask_starts), dtype=batch_mask_dtype)
+        mask['tx'] = tx_of_base[mask_starts]
+        mask['start'] = mask_starts - seq_starts[mask['tx']]
+        mask['length'] = mask_lengths
+        mask['char'] = raw[mask_starts].view('S1')
+        lower_starts, lower_lengths = _runs(lower, groups=tx_of_base)
+        soft = np.zeros(len(lower_starts), dtype=batch_lower_dtype)
+        soft['tx'] = tx_of_base[lower_starts]
+        soft['start'] = lower_starts - seq_starts[soft['tx']]
+        soft['length'] = lower_lengths
+        return cls(packed.astype(np.uint8), lengths, mask, soft)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the packed bases, the offsets and the run lists."""
+        return self.packed.nbytes + self.lengths.nbytes + self.byte_offsets.nbytes + self.mask.nbytes + \
+            self.lower.nbytes
+
+    def _gc_in_ranges(self, cumulative, starts, stops):
+        """
+        Number of G and C codes between base positions of the buffer, full bytes are counted from the cumulative per
+        byte counts and the up to 3 bases on either side from their codes.
+        :param cumulative: int64 array of the G and C codes before every byte
+        :param starts: int64 array of the first base positions
+        :param stops: int64 array of the base positions after the last base
+        """
+        first_full = -(-starts // 4)
+        last_full = stops // 4
+        counts = np.where(last_full > first_full,
+                          cumulative[np.maximum(last_full, first_full)] - cumulative[first_full], 0)
+        left_stops = np.minimum(stops, first_full * 4)
+        right_starts = np.maximum(left_stops, last_full * 4)
+        for k in range(3):
+            for positions, ends in [(starts + k, left_stops), (right_starts + k, stops)]:
+                valid = positions < ends
+                byte_codes = _byte_codes[self.packed[np.where(valid, positions // 4, 0)], positions % 4]
+                counts += valid & ((byte_codes == 1) | (byte_codes == 2))
+        return counts
+
+    def gc_content(self):
+        """
+        txseq_properties.gc_content of all sequences, only upper case G and C are counted and N are ignored.
+        :return: float array, 0 for sequences without any non-N base
+        """
+        percent_gc = np.zeros(len(self), dtype=np.float64)
+        if len(self.packed) == 0:
+            return percent_gc
+        cumulative = np.zeros(len(self.packed) + 1, dtype=np.int64)
+        np.cumsum(_gc_counts[self.packed], out=cumulative[1:])
+        seq_starts = self.byte_offsets[:-1] * 4
+        num_gc = self._gc_in_ranges(cumulative, seq_starts, seq_starts + self.lengths)
+        # bases of other characters are packed as A, soft-masked g and c are not counted
+        lower_starts = seq_starts[self.lower['tx']] + self.lower['start']
+        lower_gc = self._gc_in_ranges(cumulative, lower_starts, lower_starts + self.lower['length'])
+        num_gc -= np.bincount(self.lower['tx'], weights=lower_gc, minlength=len(self)).astype(np.int64)
+        n_runs = self.mask[self.mask['char'] == b'N']
+        denominator = self.lengths - np.bincount(n_runs['tx'], weights=n_runs['length'],
+                                                 minlength=len(self)).astype(np.int64)
+        np.divide(num_gc, denominator, out=percent_gc, where=denominator > 0)
+        return percent_gc
+
+    def unpack(self):
+        """
+        Characters of all sequences in one vectorized pass, the result is kept.
+        :return: txseq_batch.SeqBatch of the sequences
+        """
+        if self._unpacked is not None:
+            return self._unpacked
+        seq_starts = np.cumsum(self.lengths) - self.lengths
+        chars = _unpacked[self.packed].ravel()[range_positions(self.byte_offsets[:-1] * 4, self.lengths)]
+        chars[range_positions(seq_starts[self.lower['tx']] + self.lower['start'], self.lower['length'])] += 32
+        chars[range_positions(seq_starts[self.mask['tx']] + self.mask['start'], self.mask['length'])] = \
+            np.repeat(self.mask['char'].view(np.uint8), self.mask['length'])
+        self._unpacked = txseq_batch.SeqBatch.from_codes(chars, self.lengths)
+        return self._unpacked
+
+    def sequences(self):
+        """:return: list of the sequences as strings"""
+        batch = self.unpack()
+        joined = batch.codes.tobytes().decode()
+        offsets = batch.offsets.tolist()
+        return [joined[offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
@@ -0,0 +1,165 @@
+"""
+Cost-aware scheduling of the folding work. The cost of a transcript is estimated from the lengths of its regions and the
+folds tx_features will run for them (RNAfold scales cubically with length, RNALfold linearly with length and
+quadratically with the window size). Work is split into small units of similar cost which are dispatched most expensive
+first through the shared queue of the process pool, so idle workers pick up the next unit and long folds do not end up
+at the tail of a build. Per-worker utilization of each phase is logged once it completes.
+"""
+
+import logging
+import os
+import shlex
+import time
+
+import numpy as np
+
+from txfeature.db_builder import tx_features, txfeat_functions
+
+# number of work units per worker, more units balance better at the cost of more dispatch overhead
+units_per_worker = 8
+
+
+def lfold_window(rnalfold_command):
+    """Window size (-L / --span) of the RNALfold command, 150 (the RNALfold default) if not set."""
+    options = shlex.split(rnalfold_command)
+    for i, option in enumerate(options):
+        if option in ['-L', '--span'] and i + 1 < len(options):
+            return int(options[i + 1])
+        if option.startswith('--span='):
+            return int(option.split('=')[1])
+    return 150
+
+
+def fold_cost(length, kind, window=150):
+    """
+    Relative cost of folding a sequence.
+    :param length: sequence length
+    :param kind: 'rnafold' (mfe, partition function, centroid and MEA) or 'rnalfold' (local scan)
+    :param window: RNALfold window size
+    """
+    if kind == 'rnafold':
+        return 3.0 * length ** 3
+    return float(length) * min(length, window) ** 2
+
+
+def transcript_cost(region_lengths, window=150):
+    """
+    Relative cost of the features of a transcript, mirrors the folds requested by tx_features.fold_requests.
+    :param region_lengths: dict of 'five_prime_UTR', 'CDS', 'three_prime_UTR' -> length, 0 if not defined
+    """
+    cost = 1.0
+    for region in ['five_prime_UTR', 'CDS', 'three_prime_UTR']:
+        length = region_lengths.get(region, 0)
+        if length < 1:
+            continue
+        cost += fold_cost(length, 'rnalfold', window)
+        if length < tx_features.rnafold_max_length:
+            cost += fold_cost(length, 'rnafold')
+        if region == 'five_prime_UTR':
+            cost += fold_cost(min(length, tx_features.cap_length), 'rnafold')
+    return cost
+
+
+def store_costs(store, window=150):
+    """
+    Estimated cost of every transcript of a FeatureStore from the lengths of its annotated regions.
+    :param store: FeatureStore
+    :param window: RNALfold window size
+    :return: list of costs aligned with the transcripts of the store
+    """
+    features = store.features
+    num_tx = len(store)
+    tx_of_feature = np.repeat(np.arange(num_tx), store.transcripts['feat_stop'] - store.transcripts['feat_start'])
+    feature_lengths = np.abs(features['stop'] - features['start']) + 1
+    region_lengths = {}
+    for region in ['exon', 'five_prime_UTR', 'CDS', 'three_prime_UTR']:
+        selected = features['ftype'] == txfeat_functions.tx_feature_types.index(region)
+        region_lengths[region] = np.bincount(tx_of_feature[selected], weights=feature_lengths[selected],
+                                             minlength=num_tx)
+    costs = []
+    for i in range(num_tx):
+        # assembly and the sequence properties scale with the transcript length
+        costs.append(transcript_cost({region: int(lengths[i]) for region, lengths in region_lengths.items()}, window)
+                     + float(region_lengths['exon'][i]))
+    return costs
+
+
+def cost_units(items, costs, num_units, sizes=None, max_size=None, keep_order=False):
+    """
+    Splits items into work units of similar total cost, expensive items are placed first.
+    :param items: list of items
+    :param costs: list of costs aligned with items
+    :param num_units: targeted number of units
+    :param sizes: list of item sizes (ex. number of transcripts of a gene) aligned with items
+    :param max_size: units are closed once their size reaches max_size
+    :param keep_order: units are formed of consecutive items in the given order (ex. genes in genomic order) instead
+                       of items of similar cost
+    :return: list of (cost, list of items) sorted by descending cost
+    """
+    if not items:
+        return []
+    if sizes is None:
+        sizes = [1] * len(items)
+    target = sum(costs) / float(max(1, num_units))
+    units = []
+    unit = []
+    unit_cost = 0.0
+    unit_size = 0
+    weighted = list(zip(costs, sizes, items))
+    if not keep_order:
+        weighted.sort(key=lambda triple: triple[0], reverse=True)
+    for cost, size, item in weighted:
+        unit.append(item)
+        unit_cost += cost
+        unit_size += size
+        if unit_cost >= target or (max_size is not None and unit_size >= max_size):
+            units.append((unit_cost, unit))
+            unit = []
+            unit_cost = 0.0
+            unit_size = 0
+    if unit:
+        units.append((unit_cost, unit))
+    units.sort(key=lambda pair: pair[0], reverse=True)
+    return units
+
+
+def timed(function, *args):
+    """
+    Runs function within a worker process and records when it ran.
+    :return: dict with 'pid', 'start', 'stop' and 'result'
+    """
+    start = time.time()
+    result = function(*args)
+    return {'pid': os.getpid(), 'start': start, 'stop': time.time(), 'result': result}
+
+
+class Utilization:
+    """
+    Collects the run times of the jobs of a phase returned by timed.
+    :param phase: name of the phase used in the log
+    :param threads: number of worker processes
+    """
+
+    def __init__(self, phase, threads):
+        self.phase = phase
+        self.threads = threads
+        self.start = time.time()
+        self.busy = {}
+        self.jobs = {}
+
+    def add(self, timed_result):
+        """Records a job and returns its result."""
+        pid = timed_result['pid']
+        self.busy[pid] = self.busy.get(pid, 0) + timed_result['stop'] - timed_result['start']
+        self.jobs[pid] = self.jobs.get(pid, 0) + 1
+        return timed_result['result']
+
+    def log(self):
+        logger = logging.getLogger(__name__ + '.Utilization')
+        wall = max(time.time() - self.start, 1e-9)
+        total_busy = sum(self.busy.values())
+        logger.info('%s: %.1f%% worker utilization over %.1f seconds'
+                    % (self.phase, 100.0 * total_busy / (wall * self.threads), wall))
+        for number, pid in enumerate(sorted(self.busy.keys())):
+            logger.debug('%s: worker %i (pid %i) ran %i jobs, busy %.1f seconds (%.1f%%)'
+                         % (self.phase, number, pid, self.jobs[pid], self.busy[pid], 100.0 * self.busy[pid] / wall))
@@ -7,7 +7,7 @@ import subprocess
 import logging
 from shutil import which
 from typing import List
-from txfeature.db_builder import build_config
+from txfeature.db_builder import build_config, fold_engine
 
 
 def ready():
@@ -16,6 +16,25 @@ def ready():
     # Setup logger
     logger = logging.getLogger(__name__)
 
+    # Check fold engine, the vienna engine only needs the ViennaRNA python bindings
+    if build_config.cfg['fold_engine'] not in fold_engine.engine_names:
+        logger.info('Error: unknown fold_engine %s in build_db.cfg file, expected one of %s!'
+                    % (build_config.cfg['fold_engine'], ', '.join(fold_engine.engine_names)))
+        sys.exit(1)
+    if build_config.cfg['fold_engine'] == 'vienna':
+        try:
+            import RNA
+        except ImportError:
+            logger.info('Warning: ViennaRNA python bindings (RNA module) could not be found! Please install before '
+                        'running build_db.')
+            sys.exit()
+        logger.debug('System requirements are satisfied, proceeding with building.')
+        return
+    # Only the cli engine runs the RNAfold and RNALfold executables
+    if build_config.cfg['fold_engine'] != 'cli':
+        logger.debug('System requirements are satisfied, proceeding with building.')
+        return
+
     # Check if packages in list exists in path and executable
     packages = ['RNAfold', 'RNALfold']  # type: List[str]
     if build_config.cfg['viennarna_dir'] == '':
@@ -1,52 +1,116 @@
 """
 Component of the db_builder pipeline, uses gff structure and iterates through and uses tx_build to build
-transcripts.
+transcripts. Transcripts are assembled in genomic order (see FeatureStore.genomic_order) through a window buffer of
+reference sequence, so neighbouring genes reuse the sequence read for the previous ones, and an exon cache, so exons
+shared between the isoforms of a gene are extracted once.
 """
 
 import logging
 import time
 
-from txfeature.db_builder import tx_build, txfeat_functions, utils
+import numpy as np
 
+from txfeature.db_builder import tx_build, utils, assembly_store, checkpoints
+from txfeature.db_builder.fasta_index import WindowedFasta, ExonCache
+from txfeature.db_builder.feature_store import FeatureStore
 
-def assemble(gff_df, tx_dict, fasta, tmp_dir, job):
+
+def assemble(store_handle, tx_indices, fasta, job, show_progress=True):
     """
-    :param gff_df: parsed gff file using gff_parser
-    :param tx_dict: list of transcript id for assembly
-    :param fasta: fasta file for associated gff
-    :param tmp_dir: temporary directory for transcript building
+    :param store_handle: handle of the shared memory FeatureStore holding the parsed gff file, or path of an
+                         assembly_store from which the assembled transcripts are restored
+    :param tx_indices: indices of the transcripts within the store for assembly
+    :param fasta: fasta file for associated gff, not used for an assembly_store
     :param job: integer value of the job
+    :param show_progress: display a progress bar for job 0
+    :return: dict of tx_id -> assembled transcript and dict of exon cache 'hits' and 'misses'
     """
     # setup logger and time
     logger = logging.getLogger(__name__ + '.assemble')
     logger.debug('Build job %i assembling annotated transcripts...' % job)
     initial_time = time.time()
 
-    # setup return structure and tx list
+    if isinstance(store_handle, str):
+        store = assembly_store.AssemblyStore(store_handle)
+        tx_assembled = store.assembled(tx_indices)
+        store.close()
+        logger.debug('Build job %i restored %i transcripts from %s' % (job, len(tx_assembled), store_handle))
+        return tx_assembled, {'hits': 0, 'misses': 0}
+
+    # attach to annotation store, open genome and setup return structure and tx list
+    store = FeatureStore.attach(store_handle)
+    window = WindowedFasta(fasta)
+    genome = ExonCache(window)
     tx_assembled = {}
-    tx_list = sorted(tx_dict.keys())
+    # spans of the job's transcripts only, the window then moves along the genome in one direction
+    tx_indices = np.asarray(tx_indices, dtype=np.int64)
+    starts, stops = store.tx_spans(tx_indices)
+    order = np.lexsort((starts, store.transcripts['chrom'][tx_indices]))
+    tx_list = tx_indices[order].tolist()
+    starts = starts[order].tolist()
+    stops = stops[order].tolist()
 
     # progress bar variables
     progress = 0
     total_tx = len(tx_list)
 
     # iterate through tx_list and construct table
-    for tx in tx_list:
+    for tx_index, tx_start, tx_stop in zip(tx_list, starts, stops):
+        tx = store.tx_id(tx_index)
         # display progress of txfeat construction
-        if job == 0:
+        if job == 0 and show_progress:
             utils.progress_bar(progress, total_tx, status='txid: %s' % tx)
 
-        # assemble tx
-        tx_annot = txfeat_functions.tx2gff_lookup(gff_df, tx)
-        tx_assembled[tx] = tx_build.build(tx, tx_annot, tx_dict[tx], fasta, tmp_dir + '/_tmp_txfeature')
+        # assemble tx, the window is moved once to cover all exons of the transcript not found in the exon cache
+        tx_attr = store.tx_attr(tx_index)
+        if tx_stop > 0:
+            genome.expect(tx_attr['chrom'], tx_start, tx_stop)
+        tx_assembled[tx] = tx_build.build(tx, store.tx_annot(tx_index), tx_attr, genome)
         # progress bar up increment
         progress += 1
+    exon_usage = {'hits': genome.hits, 'misses': genome.misses}
+    window_usage = (window.hits, window.misses)
+    store.close()
+    genome.close()
 
     # Completion time
     task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
-    if job == 0:
+    if job == 0 and show_progress:
         utils.progress_bar(1, 1, status='Complete!')
     logger.debug('Build job %i took %s minutes to assemble %i annotated transcripts' % (job, task_time, total_tx))
+    logger.debug('Build job %i reference window: %i fetches reused, %i windows loaded' % ((job,) + window_usage))
+    logger.debug('Build job %i %s' % (job, exon_report(exon_usage)))
 
     # Return tx_assembled
-    return tx_assembled
+    return tx_assembled, exon_usage
+
+
+def assemble_part(store_handle, tx_indices, fasta, job, part_path):
+    """
+    Assembles transcripts as assemble, but the assembled transcripts are handed to the next stage of the build through
+    a part file of packed sequences and transcript hashes (see assembly_store.save_part) instead of being returned to
+    the main process.
+    :param part_path: path of the part file
+    :return: dict with 'hashes' (tx_id -> transcript hash, see checkpoints.transcript_hash) and 'exon_usage'
+    """
+    tx_assembled, exon_usage = assemble(store_handle, tx_indices, fasta, job)
+    hashes = {tx: checkpoints.transcript_hash(transcript) for tx, transcript in tx_assembled.items()}
+    store = FeatureStore.attach(store_handle)
+    index_of = {store.tx_id(tx_index): tx_index for tx_index in tx_indices}
+    store.close()
+    tx_ids = list(tx_assembled)
+    packed = assembly_store.pack([tx_assembled[tx]['tx_seq'] for tx in tx_ids])
+    packed['tx_indices'] = np.array([index_of[tx] for tx in tx_ids], dtype=np.int64)
+    packed['tx_hashes'] = assembly_store.hash_array([hashes[tx] for tx in tx_ids])
+    assembly_store.save_part(part_path, packed)
+    return {'hashes': hashes, 'exon_usage': exon_usage}
+
+
+def exon_report(exon_usage):
+    """
+    :param exon_usage: dict of exon cache 'hits' and 'misses'
+    :return: message for the build log
+    """
+    fetches = exon_usage['hits'] + exon_usage['misses']
+    rate = 100.0 * exon_usage['hits'] / fetches if fetches > 0 else 0
+    return 'Exon cache: %i of %i exon fetches were hits (%.1f%% hit rate)' % (exon_usage['hits'], fetches, rate)
@@ -2,22 +2,39 @@
 transcript_assembly.py assembles given transcripts using the provided annotation and fasta file.
 """
 
-import csv
 import copy
-import os
-from pybedtools import BedTool
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
-from .tx_classes import GffReadEntry
+from txfeature.db_builder.coord_map import CoordMap
 
 
-def build(transcript, annot, txi_dict, fasta_path, tmp_dir=''):
-    # Create temp_dir
-    if tmp_dir == '':
-        tmp_dir = './_tmp_txfeature'
-    if not os.path.exists(tmp_dir):
-        os.makedirs(tmp_dir)
-
+def build(transcript, tx_annot, txi_dict, fasta):
+    """
+    :param transcript: transcript id
+    :param tx_annot: features of the transcript in the tx_annot coordinate structure
+    :param txi_dict: transcript attributes (gene_id, chrom, strand, tx_type)
+    :param fasta: fasta_index.IndexedFasta of the genome associated to the gff
+    :return: dict of the assembled transcript
+    """
+    # Assemble transcript using tran_features
+    # Exon sequences are sliced from the indexed fasta in exon_number order (reverse complemented on '-' strand)
+    exon_seqs = []
+    for exon_number in range(1, max(tx_annot['exon'].keys()) + 1):
+        exon_coord = tx_annot['exon'][exon_number]
+        exon_seqs.append(fasta.fetch(txi_dict['chrom'], exon_coord['start'], exon_coord['stop'], txi_dict['strand']))
+    return assembled(transcript, tx_annot, txi_dict, ''.join(exon_seqs))
+
+
+def assembled(transcript, tx_annot, txi_dict, full_seq):
+    """
+    Assembled transcript structure of a transcript sequence, used by build and to restore transcripts from an
+    assembly_store.
+    :param transcript: transcript id
+    :param tx_annot: features of the transcript in the tx_annot coordinate structure
+    :param txi_dict: transcript attributes (gene_id, chrom, strand, tx_type)
+    :param full_seq: spliced exon sequence of the transcript as string or PackedSeq
+    :return: dict of the assembled transcript
+    """
     # Initializing return variables
     transcript_status = {'five_prime_UTR': '', 'stop_codon_redefined_as_selenocysteine': '', 'exon': '',
                          'stop_codon': '', 'CDS': '', 'three_prime_UTR': '', 'start_codon': ''}
@@ -28,20 +45,6 @@ def build(transcript, annot, txi_dict, fasta_path, tmp_dir=''):
     gene_id = txi_dict['gene_id']
     tx_type = txi_dict['tx_type']
 
-    # Find all features of transcript from gff_table and store it into tran_features dictionary
-    tx_annot = {'five_prime_UTR': {}, 'stop_codon_redefined_as_selenocysteine': {}, 'exon': {},
-                     'stop_codon': {}, 'CDS': {}, 'three_prime_UTR': {}, 'start_codon': {}}
-    seleno_index = 0
-    for item in annot:
-        gff_feature = GffReadEntry(item)
-        ftype = gff_feature.entry_type
-        if ftype in ['five_prime_UTR', 'exon', 'CDS', 'three_prime_UTR', 'stop_codon', 'start_codon']:
-            tx_annot[ftype][gff_feature.exon_number] = {'start': gff_feature.start_coord,
-                                                             'stop': gff_feature.stop_coord}
-        if ftype in ['stop_codon_redefined_as_selenocysteine']:
-            tx_annot[ftype][seleno_index] = {'start': gff_feature.start_coord, 'stop': gff_feature.stop_coord}
-            seleno_index -= 1
-
     # Complete transcript_status
     for ftype in transcript_status.keys():
         if len(tx_annot[ftype]) == 0:
@@ -49,45 +52,12 @@ def build(transcript, annot, txi_dict, fasta_path, tmp_dir=''):
         else:
             transcript_status[ftype] = 'defined'
 
-    # Assemble transcript using tran_features
-    # Create BED file of from the 'exon' features in tran_features
-    # name = ex_num:ex_start_coord:ex_stop_coord, this will be used when BED file is passed into pybedtools_getfasta
-    with open(tmp_dir + '/' + transcript + '_temp.bed', 'w') as temp_bed:
-        bed_out = csv.writer(temp_bed, delimiter='\t')
-        for exon_number in range(1, max(tx_annot['exon'].keys()) + 1):
-            exon_coord = tx_annot['exon'][exon_number]
-            name = '{ex_num}:{start}:{stop}'.format(ex_num=exon_number, start=exon_coord['start'],
-                                                    stop=exon_coord['stop'])
-            bed_out.writerow([chrom, exon_coord['start'] - 1, exon_coord['stop'], name, 0, strnd])
-    temp_bed.close()
-
-    # Pass BED file into pybedtools getfasta and extract transcript sequence
-    transcript_bed = BedTool(tmp_dir + '/' + transcript + '_temp.bed')
-    fasta_file = BedTool(fasta_path)
-    transcript_fasta = transcript_bed.sequence(fi=fasta_file, name=True, s=True,
-                                               fo=tmp_dir + '/' + transcript + '_temp.fa')
-
-    # Parse transcript fasta and create g2iloc table
-    g2iloc = []
-    full_seq = ''
-    with open(transcript_fasta.seqfn) as transcript_seq:
-        for fasta_entry in transcript_seq:
-            if fasta_entry[0] == '>':
-                seq_info = fasta_entry.strip('>').strip('\n').replace('(', ':').split(':')
-                ex_seq = next(transcript_seq).strip('\n')
-                full_seq += ex_seq
-                if strnd == '+':
-                    seq_start = int(seq_info[1])
-                if strnd == '-':
-                    seq_start = int(seq_info[2])
-                for base in range(len(ex_seq)):
-                    g2iloc.append(seq_start)
-                    if strnd == '+':
-                        seq_start += 1
-                    if strnd == '-':
-                        seq_start -= 1
-    g2iloc = tuple(g2iloc)
-    transcript_seq.close()
+    # The exon blocks in exon_number order are used to create the genome <-> transcript coordinate map
+    exon_blocks = []
+    for exon_number in range(1, max(tx_annot['exon'].keys()) + 1):
+        exon_coord = tx_annot['exon'][exon_number]
+        exon_blocks.append((exon_coord['start'], exon_coord['stop']))
+    coord_map = CoordMap(exon_blocks, strnd)
 
     # Setup output dictionary
     output = {'tx_id': transcript,
@@ -98,7 +68,7 @@ def build(transcript, annot, txi_dict, fasta_path, tmp_dir=''):
               'tx_status': transcript_status,
               'tx_seq': full_seq,
               'num_of_exons': max(tx_annot['exon'].keys()),
-              'g2iloc': g2iloc,
+              'coord_map': coord_map,
               'tx_annot': tx_annot}
     return output
 
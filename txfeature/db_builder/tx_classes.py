@@ -1,7 +1,37 @@
 """
 exfeat_classes.py contain the major classes used within the ExFeat Pipeline.
 """
-import txfeature.db_builder.txfeat_functions as txfeat_func
+import numpy as np
+
+from txfeature.db_builder import intervals
+
+
+class GffFeature:
+    """Compact typed record of a single gff3 entry as emitted by gff_parser.gff_table."""
+
+    __slots__ = ('chrom', 'source', 'feature_type', 'start', 'stop', 'strand', 'phase', 'gene_id', 'transcript_id',
+                 'exon_number', 'exon_id')
+
+    def __init__(self, chrom, source, feature_type, start, stop, strand, phase, gene_id, transcript_id, exon_number,
+                 exon_id):
+        self.chrom = chrom
+        self.source = source
+        self.feature_type = feature_type
+        self.start = start
+        self.stop = stop
+        self.strand = strand
+        self.phase = phase
+        self.gene_id = gene_id
+        self.transcript_id = transcript_id
+        self.exon_number = exon_number
+        self.exon_id = exon_id
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
 
 
 class GffReadEntry:
@@ -89,11 +119,14 @@ class TxRead:
         self.tx_type = transcript['tx_type']
         self.sequence = transcript['tx_seq']
         self.num_exons = transcript['num_of_exons']
-        self.g2iloc = transcript['g2iloc']
+        self.coord_map = transcript['coord_map']
         self.tx_status = transcript['tx_status']
         self.tx_annot = transcript['tx_annot']
         self.chrom = transcript['chrom']
         self.strand = transcript['strand']
+        self._region_blocks = {}
+        self._region_index = {}
+        self._batch = None
         if self.tx_status['start_codon'] == 'defined':
             self.start_codon_exon = list(self.tx_annot['start_codon'].keys())[0]
             self.start_codon_coord = self.chrom + ':' + \
@@ -119,47 +152,54 @@ class TxRead:
         qchrom = gen_coord.split(':')[0]
         qcoord = gen_coord.split(':')[1].split('-')
         if len(qcoord) == 1:
-            qcoord = {int(qcoord[0])}
+            qstart = qend = int(qcoord[0])
         elif len(qcoord) == 2:
-            qcoord = set(list(range(int(qcoord[0]), int(qcoord[1]) + 1)))
+            qstart = int(qcoord[0])
+            qend = int(qcoord[1])
         else:
             return region  # invalid coordinate, return empty
         # check overlap
         if qchrom == self.chrom:
             for region_type in self.tx_annot.keys():
-                region_coord = set(txfeat_func.region_coord_aggregate(self.tx_annot[region_type]))
-                if len(qcoord.intersection(region_coord)) > 0:
+                if intervals.overlaps(self.region_blocks(region_type), qstart, qend):
                     region.append(region_type)
         return region
 
+    # Method returning the sorted (start, stop) genomic blocks of a region, ex 'CDS'
+    def region_blocks(self, region_type):
+        if region_type not in self._region_blocks:
+            self._region_blocks[region_type] = intervals.region_blocks(self.tx_annot[region_type])
+        return self._region_blocks[region_type]
+
     # Method to extract sequence of specified mRNA region, ex 'five_prime_UTR'
     def get_sequence(self, region_type, query):
         # setting return variable
         sequence = ''
         # type for mRNA regions
         if region_type == 'mrna_region':
-            if query in self.tx_annot.keys():
-                region_coord = txfeat_func.region_coord_aggregate(self.tx_annot[query])
-            else:
+            if query not in self.tx_annot.keys():
                 return sequence
-            if self.strand == '+':
-                start = min(region_coord)
-                end = max(region_coord)
-            else:
-                start = max(region_coord)
-                end = min(region_coord)
-            seqi_start = self.g2iloc.index(start)
-            seqi_end = self.g2iloc.index(end)
+            # transcript indices of a region are looked up once per transcript
+            if query not in self._region_index:
+                region_start, region_end = intervals.span(self.region_blocks(query))
+                if self.strand == '+':
+                    start = region_start
+                    end = region_end
+                else:
+                    start = region_end
+                    end = region_start
+                self._region_index[query] = (self.coord_map.index(start), self.coord_map.index(end))
+            seqi_start, seqi_end = self._region_index[query]
 
         elif region_type == 'exon':
             if query in self.tx_annot['exon'].keys():
                 ex_coord = self.tx_annot['exon'][query]
                 if self.strand == '+':
-                    seqi_start = self.g2iloc.index(ex_coord['start'])
-                    seqi_end = self.g2iloc.index(ex_coord['stop'])
+                    seqi_start = self.coord_map.index(ex_coord['start'])
+                    seqi_end = self.coord_map.index(ex_coord['stop'])
                 else:
-                    seqi_start = self.g2iloc.index(ex_coord['stop'])
-                    seqi_end = self.g2iloc.index(ex_coord['start'])
+                    seqi_start = self.coord_map.index(ex_coord['stop'])
+                    seqi_end = self.coord_map.index(ex_coord['start'])
             else:
                 return sequence
 
@@ -169,22 +209,21 @@ class TxRead:
                 return ''
             qcoord = query.split(':')[1].split('-')
             if len(qcoord) == 1:
-                qcoord = int(qcoord[0])
-                if qcoord in self.g2iloc:
-                    index = self.g2iloc.index(qcoord)
+                index = self.coord_map.g2t(int(qcoord[0]))
+                if index is not None:
                     return self.sequence[index]
                 else:
                     return ''  # coordinate not in transcript
             elif len(qcoord) == 2:
                 start = int(qcoord[0])
                 end = int(qcoord[1])
-                if start in self.g2iloc and end in self.g2iloc:
+                if start in self.coord_map and end in self.coord_map:
                     if self.strand == '+':
-                        seqi_start = self.g2iloc.index(start)
-                        seqi_end = self.g2iloc.index(end)
+                        seqi_start = self.coord_map.index(start)
+                        seqi_end = self.coord_map.index(end)
                     else:
-                        seqi_start = self.g2iloc.index(end)
-                        seqi_end = self.g2iloc.index(start)
+                        seqi_start = self.coord_map.index(end)
+                        seqi_end = self.coord_map.index(start)
                 else:
                     return ''  # coordinates not in transcript
             else:
@@ -196,29 +235,34 @@ class TxRead:
                 return ''
             qcoord = query.split(':')[1].split('-')
             if len(qcoord) == 2:
-                start = int(qcoord[0])
-                end = int(qcoord[1])
-                qspan = set(list(range(start, end + 1)))
-                ovlp = qspan.intersection(set(self.g2iloc))
+                ovlp = self.coord_map.overlap(int(qcoord[0]), int(qcoord[1]))
+                if ovlp is None:
+                    return ''  # coordinates not in transcript
                 if self.strand == '+':
-                    seqi_start = self.g2iloc.index(min(ovlp))
-                    seqi_end = self.g2iloc.index(max(ovlp))
+                    seqi_start = self.coord_map.index(ovlp[0])
+                    seqi_end = self.coord_map.index(ovlp[1])
                 else:
-                    seqi_start = self.g2iloc.index(max(ovlp))
-                    seqi_end = self.g2iloc.index(min(ovlp))
+                    seqi_start = self.coord_map.index(ovlp[1])
+                    seqi_end = self.coord_map.index(ovlp[0])
             else:
                 return ''  # invalid coordinate, return empty
 
         else:
             return ''
-        return self.sequence[seqi_start:(seqi_end + 1)]
+        # str of the slice as the sequence may be a PackedSeq
+        return str(self.sequence[seqi_start:(seqi_end + 1)])
+
+    # Method to extract the spliced sequences of many genomic intervals at once, see TxReadBatch.sequences
+    def get_sequences(self, starts, stops, overlap=True):
+        if self._batch is None:
+            self._batch = TxReadBatch([self])
+        return self._batch.sequences(np.zeros(len(starts), dtype=np.int64), starts, stops, overlap)
 
     def length(self, region_type, query):
         # type for mRNA regions
         if region_type == 'mrna_region':
             if query in self.tx_annot.keys():
-                region_coord = txfeat_func.region_coord_aggregate(self.tx_annot[query])
-                return len(region_coord)
+                return intervals.length(self.region_blocks(query))
             else:
                 return 0
 
@@ -230,6 +274,79 @@ class TxRead:
                 return 0
 
 
+class TxReadBatch:
+    """
+    Spliced subsequence extraction for the genomic intervals of many transcripts in one vectorized pass. The exon blocks
+    of all transcripts are concatenated once into arrays sorted by genomic start, the blocks of every transcript shifted
+    by its own coordinate offset, so the interval ends of all queries are resolved with one searchsorted each.
+    :param tx_reads: list of TxRead
+    """
+
+    # coordinate shift between transcripts, larger than any chromosome
+    _shift = 1 << 32
+
+    def __init__(self, tx_reads):
+        self.tx_reads = tx_reads
+        starts, stops, offsets, minus, seq_starts, first_blocks = [], [], [], [], [0], [0]
+        for position, tx_read in enumerate(tx_reads):
+            g_starts, g_stops, g_offsets = tx_read.coord_map.genomic_arrays()
+            starts.append(g_starts)
+            stops.append(g_stops)
+            offsets.append(g_offsets)
+            minus.append(np.full(len(g_starts), tx_read.strand == '-'))
+            seq_starts.append(seq_starts[-1] + len(tx_read.sequence))
+            first_blocks.append(first_blocks[-1] + len(g_starts))
+        self._starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self._stops = np.concatenate(stops) if stops else np.zeros(0, dtype=np.int64)
+        self._offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+        self._minus = np.concatenate(minus) if minus else np.zeros(0, dtype=bool)
+        self._first_blocks = np.array(first_blocks, dtype=np.int64)
+        self._seq_starts = np.array(seq_starts, dtype=np.int64)
+        block_shift = np.repeat(np.arange(len(tx_reads), dtype=np.int64) * self._shift, np.diff(self._first_blocks))
+        self._shifted_starts = self._starts + block_shift
+        self._shifted_stops = self._stops + block_shift
+        self._sequence = ''.join(str(tx_read.sequence) for tx_read in tx_reads)
+
+    def sequences(self, tx_positions, starts, stops, overlap=True):
+        """
+        :param tx_positions: array of the position of the queried transcript in tx_reads for every interval
+        :param starts: array of 1-based genomic interval starts (inclusive)
+        :param stops: array of 1-based genomic interval stops (inclusive)
+        :param overlap: return the transcript bases overlapping each interval (as get_sequence 'coordinates_overlap'),
+                        otherwise both interval ends must be within exons (as get_sequence 'coordinates')
+        :return: list of spliced sequences in transcript orientation, '' for intervals without sequence
+        """
+        tx_positions = np.asarray(tx_positions, dtype=np.int64)
+        query_starts = np.minimum(starts, stops).astype(np.int64)
+        query_stops = np.maximum(starts, stops).astype(np.int64)
+        if len(self._starts) == 0 or len(tx_positions) == 0:
+            return [''] * len(tx_positions)
+        shift = tx_positions * self._shift
+        # first block ending at or after the interval start and last block starting at or before the interval stop
+        first = np.searchsorted(self._shifted_stops, query_starts + shift, side='left')
+        last = np.searchsorted(self._shifted_starts, query_stops + shift, side='right') - 1
+        valid = (first < self._first_blocks[tx_positions + 1]) & (last >= self._first_blocks[tx_positions]) & \
+                (first <= last)
+        first = np.clip(first, 0, len(self._starts) - 1)
+        last = np.clip(last, 0, len(self._starts) - 1)
+        if not overlap:
+            valid &= (self._starts[first] <= query_starts) & (query_stops <= self._stops[last])
+        low = np.maximum(query_starts, self._starts[first])
+        high = np.minimum(query_stops, self._stops[last])
+
+        # transcript indices of the lowest and highest overlapping genomic base
+        minus = self._minus[first]
+        low_index = np.where(minus, self._offsets[first] + self._stops[first] - low,
+                             self._offsets[first] + low - self._starts[first])
+        high_index = np.where(minus, self._offsets[last] + self._stops[last] - high,
+                              self._offsets[last] + high - self._starts[last])
+        seq_starts = self._seq_starts[tx_positions]
+        slice_starts = (np.minimum(low_index, high_index) + seq_starts).tolist()
+        slice_stops = (np.maximum(low_index, high_index) + seq_starts + 1).tolist()
+        return [self._sequence[slice_start:slice_stop] if is_valid else ''
+                for slice_start, slice_stop, is_valid in zip(slice_starts, slice_stops, valid.tolist())]
+
+
 class ProteinRead:
     # Protein sequence
     class Sequence:
@@ -2,145 +2,406 @@
 Takes assembled transcripts and returns dictionary of transcript features.
 """
 
+import hashlib
 import logging
+import os
 import time
 
-from txfeature.db_builder import utils, tx_classes
+import numpy as np
+
+from txfeature.db_builder import utils, tx_classes, intervals
 from txfeature.db_builder import txseq_properties as tp
-from txfeature.db_builder import build_config
+from txfeature.db_builder import txseq_batch as tb
+from txfeature.db_builder import build_config, fold_engine, fold_cache, assembly_store
+
+# regions of this length or longer are only scanned with RNALfold, the 5'UTR cap structure covers cap_length bases
+rnafold_max_length = 1500
+cap_length = 50
+
+# columns of the txfeat_db table in output order and their types, integer columns may contain missing values
+feature_schema = [('tx_id', 'string'), ('gene_id', 'string'), ('tx_type', 'string'), ('chrom', 'string'),
+                  ('tx.length', 'int64'), ('tx.exon_count', 'int32'), ('tx.gc', 'float64'), ('tx.kozac_score', 'int32'),
+                  ('utr5.length', 'int64'), ('utr5.gc', 'float64'), ('utr5.cap_structure_mfe', 'float64'),
+                  ('utr5.structure_min_scan', 'float64'), ('utr5.structure_mfe', 'float64'),
+                  ('utr5.structure_mea', 'float64'), ('utr5.structure_centroid', 'float64'),
+                  ('cds.length', 'int64'), ('cds.gc', 'float64'), ('cds.structure_min_scan', 'float64'),
+                  ('cds.structure_mfe', 'float64'), ('cds.structure_mea', 'float64'),
+                  ('cds.structure_centroid', 'float64'),
+                  ('utr3.length', 'int64'), ('utr3.gc', 'float64'), ('utr3.au_pentamer', 'int32'),
+                  ('utr3.au_count', 'int32'), ('utr3.au_fraction', 'float64'), ('utr3.au_longest', 'int32'),
+                  ('utr3.strucutre_min_scan', 'float64'), ('utr3.structure_mfe', 'float64'),
+                  ('utr3.structure_mea', 'float64'), ('utr3.structure_centroid', 'float64'),
+                  ('stop_codon.seleno', 'string')]
+feature_columns = [column for column, _ in feature_schema]
+
+
+def restore_na(row):
+    """
+    Restores the 'NA' kozac score of a non-coding transcript in a row read back from parquet or feather output, the
+    typed formats store it as a missing value while csv output keeps 'NA'.
+    :param row: feature dict read back from a txfeat_db, changed in place
+    :return: row
+    """
+    if row.get('tx.kozac_score') is None and row.get('tx.length') is not None and row['tx_type'] != 'protein_coding':
+        row['tx.kozac_score'] = 'NA'
+    return row
+
 
+def region_sequences(tx_reads, job=None):
+    """
+    Extracts the mRNA region sequences of transcripts, the spliced sequences of all regions are sliced in one
+    vectorized pass of tx_classes.TxReadBatch.
+    :param tx_reads: list of TxRead
+    :param job: job number used for logging, undetermined regions are not logged if None
+    :return: dict of region -> list of sequences aligned with tx_reads, None where the region is not defined
+    """
+    logger = logging.getLogger(__name__ + '.region_sequences')
+    region_seqs = {region: [None] * len(tx_reads) for region in ['five_prime_UTR', 'CDS', 'three_prime_UTR']}
+    queries, tx_positions, starts, stops = [], [], [], []
+    for i, tx_read in enumerate(tx_reads):
+        for region, seqs in region_seqs.items():
+            try:
+                if tx_read.tx_status[region] != 'defined':
+                    continue
+                if region not in tx_read.tx_annot:
+                    seqs[i] = ''
+                    continue
+                start, stop = intervals.span(tx_read.region_blocks(region))
+            except:
+                if job is not None:
+                    logger.debug('Job %s Error: Transcript %s %s feature undetermined' % (job, tx_read.tx_id, region))
+                continue
+            queries.append((region, i))
+            tx_positions.append(i)
+            starts.append(start)
+            stops.append(stop)
+    # both ends of a region span lie within exons, an empty slice means the region is outside the transcript
+    sequences = tx_classes.TxReadBatch(tx_reads).sequences(tx_positions, starts, stops, overlap=False)
+    for (region, i), sequence in zip(queries, sequences):
+        if sequence:
+            region_seqs[region][i] = sequence
+        elif job is not None:
+            logger.debug('Job %s Error: Transcript %s %s feature undetermined' % (job, tx_reads[i].tx_id, region))
+    return region_seqs
+
+
+def fold_requests(region_seqs):
+    """
+    Sequences to fold for the structure features of each transcript.
+    :param region_seqs: region sequences as returned by region_sequences
+    :return: tuple of rnafold and rnalfold request dicts, (label, transcript index) -> sequence
+    """
+    rnafold_requests = {}
+    rnalfold_requests = {}
+    for i in range(len(region_seqs['CDS'])):
+        utr5_sequence = region_seqs['five_prime_UTR'][i]
+        if utr5_sequence is not None:
+            rnalfold_requests[('utr5', i)] = utr5_sequence
+            rnafold_requests[('utr5.cap', i)] = utr5_sequence[0:cap_length]
+            if len(utr5_sequence) < rnafold_max_length:
+                rnafold_requests[('utr5', i)] = utr5_sequence
+        for label, region in [('cds', 'CDS'), ('utr3', 'three_prime_UTR')]:
+            sequence = region_seqs[region][i]
+            if sequence is not None:
+                rnalfold_requests[(label, i)] = sequence
+                if len(sequence) < rnafold_max_length:
+                    rnafold_requests[(label, i)] = sequence
+    return rnafold_requests, rnalfold_requests
 
-# def add_features(tx_assembled, tx_dict, job):
-def add_features(tx_assembled, job, chunk_len, threads):
+
+def chunk_transcripts(tx_assembled):
+    """
+    Assembled transcripts of a chunk.
+    :param tx_assembled: dict of assembled transcripts, or tuple of assembly_store path and store indices to restore
+                         them from the memory mapped store within the worker
+    :return: tuple of dict of assembled transcripts and the packed_seq.PackedBatch of their sequences if restored from
+             a store, None otherwise
     """
-    :param tx_assembled: parsed gff file using gff_parser
-    :param tx_dict: list of transcript id for assembly
+    if isinstance(tx_assembled, tuple):
+        store = assembly_store.AssemblyStore(tx_assembled[0])
+        packed = store.packed_batch(tx_assembled[1])
+        tx_assembled = store.assembled(tx_assembled[1], packed)
+        store.close()
+        return tx_assembled, packed
+    return tx_assembled, None
+
+
+def sequence_digest(sequence):
+    """sha1 hex digest identifying a sequence to fold, fold requests are passed between processes by digest."""
+    return hashlib.sha1(sequence.encode()).hexdigest()
+
+
+def sequence_features(tx_reads, region_seqs, packed=None):
+    """
+    Features of a chunk computed from the transcript and region sequences, everything but the fold energies.
+    :param tx_reads: list of TxRead
+    :param region_seqs: region sequences as returned by region_sequences
+    :param packed: packed_seq.PackedBatch of the transcript sequences, the transcripts are encoded if None
+    :return: list of dicts aligned with tx_reads, see chunk_rows
+    """
+    # sequence properties computed for the whole chunk at once, gc content is counted on the packed bytes
+    if packed is not None:
+        tx_batch = packed.unpack()
+        tx_gc = packed.gc_content().tolist()
+    else:
+        tx_batch = tb.encode(tx_read.sequence for tx_read in tx_reads)
+        tx_gc = tb.gc_content(tx_batch).tolist()
+    kozac_starts = []
+    for tx_read in tx_reads:
+        try:
+            kozac_starts.append(tp.kozac_start(tx_read) if tx_read.tx_type == 'protein_coding' else -1)
+        except:
+            kozac_starts.append(None)
+    tx_kozac = tb.kozac_score(tx_batch, [-1 if start is None else start for start in kozac_starts]).tolist()
+    region_gc = {region: tb.gc_content(tb.encode(seq or '' for seq in seqs)).tolist()
+                 for region, seqs in region_seqs.items()}
+    utr3_au = {key: values.tolist() for key, values in
+               tb.au_element(tb.encode(seq or '' for seq in region_seqs['three_prime_UTR'])).items()}
+
+    records = []
+    for i, tx_read in enumerate(tx_reads):
+        record = {'tx_id': tx_read.tx_id,
+                  'gene_id': tx_read.gene_id,
+                  'tx_type': tx_read.tx_type,
+                  'chrom': tx_read.chrom,
+                  'length': len(tx_read.sequence),
+                  'num_exons': tx_read.num_exons,
+                  'gc': tx_gc[i],
+                  'kozac_score': tx_kozac[i] if kozac_starts[i] is not None else None,
+                  'region_lengths': {region: tx_read.length('mrna_region', region) for region in region_seqs},
+                  'regions': {},
+                  'utr3_au': {key: values[i] for key, values in utr3_au.items()},
+                  'seleno': None}
+        for region, seqs in region_seqs.items():
+            if seqs[i] is not None:
+                record['regions'][region] = {'seq_length': len(seqs[i]), 'gc': region_gc[region][i]}
+        try:
+            record['seleno'] = 'yes' if tx_read.tx_status['stop_codon_redefined_as_selenocysteine'] == 'defined' \
+                else 'no'
+        except:
+            pass
+        records.append(record)
+    return records
+
+
+def prepare_chunk(tx_assembled, job):
+    """
+    Sequence features and fold requests of a chunk, the transcripts are restored and their regions extracted once.
+    :param tx_assembled: dict of assembled transcripts or (assembly_store path, store indices), see chunk_transcripts
     :param job: specifies job number for multiprocessing
-    return dict of transcript with features
+    :return: dict with 'records' (see sequence_features), 'rnafold' and 'rnalfold' ((label, transcript index) ->
+             sequence digest) and 'sequences' (digest -> sequence of the distinct sequences to fold)
+    """
+    tx_assembled, packed = chunk_transcripts(tx_assembled)
+    tx_reads = [tx_classes.TxRead(tx_assembled[tx]) for tx in tx_assembled.keys()]
+    region_seqs = region_sequences(tx_reads, job)
+    prepared = {'records': sequence_features(tx_reads, region_seqs, packed), 'sequences': {}}
+    for kind, requests in zip(['rnafold', 'rnalfold'], fold_requests(region_seqs)):
+        prepared[kind] = {}
+        for key, sequence in requests.items():
+            digest = sequence_digest(sequence)
+            prepared[kind][key] = digest
+            prepared['sequences'][digest] = sequence
+    return prepared
+
+
+def spill_chunk(tx_assembled, job, spill_path):
+    """
+    Prepares a chunk within a worker of a batch build. The distinct sequences to fold are written to spill_path as one
+    byte buffer so only their digests and locations are returned to the main process.
+    :param spill_path: .npy file of the sequences
+    :return: chunk as returned by prepare_chunk, 'sequences' holding digest -> (offset, length) within the spill file
+    """
+    prepared = prepare_chunk(tx_assembled, job)
+    locations = {}
+    offset = 0
+    for digest, sequence in prepared['sequences'].items():
+        locations[digest] = (offset, len(sequence))
+        offset += len(sequence)
+    buffer = ''.join(prepared['sequences'].values()).encode()
+    with open(spill_path + '.tmp', 'wb') as tmp:
+        np.save(tmp, np.frombuffer(buffer, dtype=np.uint8))
+    os.replace(spill_path + '.tmp', spill_path)
+    prepared['sequences'] = locations
+    return prepared
+
+
+def fold_sequences(sequences, job):
+    """
+    Folds sequences with the fold engine (and fold cache) set in build_db.cfg.
+    :param sequences: dict of 'rnafold' / 'rnalfold' -> dict of key -> sequence
+    :param job: specifies job number for multiprocessing
+    :return: dict of 'rnafold' / 'rnalfold' -> dict of key -> result, failed folds are left out, and 'usage', the fold
+             cache 'hits' and 'misses' of the job
+    """
+    logger = logging.getLogger(__name__ + '.fold_sequences')
+    rnafold_command = build_config.cfg['viennarna_dir'] + build_config.cfg['rnafold_command']
+    rnalfold_command = build_config.cfg['viennarna_dir'] + build_config.cfg['rnalfold_command']
+    fold = fold_engine.get_engine(build_config.cfg['fold_engine'], rnafold_command, rnalfold_command)
+    if build_config.cfg['fold_cache']:
+        fold = fold_cache.cached_engine(fold, build_config.cfg['fold_cache'])
+    folds = {'rnafold': fold.rnafold(sequences['rnafold']),
+             'rnalfold': fold.rnalfold(sequences['rnalfold']),
+             'usage': {'hits': 0, 'misses': 0}}
+    if build_config.cfg['fold_cache']:
+        logger.debug('Job %s fold cache: %i hits, %i misses' % (job, fold.hits, fold.misses))
+        folds['usage'] = {'hits': fold.hits, 'misses': fold.misses}
+    return folds
+
+
+def fold_spilled(requests, job):
+    """
+    Folds sequences written by spill_chunk.
+    :param requests: dict of 'rnafold' / 'rnalfold' -> list of (digest, spill path, offset, length)
+    :param job: specifies job number for multiprocessing
+    :return: as fold_sequences, results keyed by digest
+    """
+    buffers = {}
+    sequences = {}
+    for kind, kind_requests in requests.items():
+        sequences[kind] = {}
+        for digest, spill_path, offset, length in kind_requests:
+            if spill_path not in buffers:
+                buffers[spill_path] = np.load(spill_path, mmap_mode='r')
+            sequences[kind][digest] = buffers[spill_path][offset:offset + length].tobytes().decode()
+    return fold_sequences(sequences, job)
+
+
+def add_features(tx_assembled, job, chunk_len, threads, fold_usage=None):
+    """
+    Features of a chunk of assembled transcripts, the distinct sequences of the chunk are folded within the job.
+    :param tx_assembled: dict of assembled transcripts or (assembly_store path, store indices), see chunk_transcripts
+    :param job: specifies job number for multiprocessing
+    :param fold_usage: dict of fold cache 'hits' and 'misses' incremented by the folds of the job
+    return list of feature dicts
+    """
+    prepared = prepare_chunk(tx_assembled, job)
+    folds = fold_sequences({kind: {digest: prepared['sequences'][digest] for digest in set(prepared[kind].values())}
+                            for kind in ['rnafold', 'rnalfold']}, job)
+    if fold_usage is not None:
+        for name in fold_usage:
+            fold_usage[name] += folds['usage'][name]
+    return chunk_rows(prepared, folds, job, chunk_len, threads)
+
+
+def chunk_rows(prepared, folds, job, chunk_len, threads):
+    """
+    Feature rows of a prepared chunk.
+    :param prepared: chunk as returned by prepare_chunk or spill_chunk
+    :param folds: dict of 'rnafold' / 'rnalfold' -> dict of sequence digest -> result, covering the chunk requests
+    :return: list of feature dicts
     """
 
     # setup logger and time
     logger = logging.getLogger(__name__ + '.add_features')
-    # logger.debug('Feature aggregation job %i initiated...' % job)
     initial_time = time.time()
 
-    # setup return structure and tx list
+    # setup return structure
     tx_feature = []
 
     # progress bar variables
-    # progress = 0
-    # total_tx = len(tx_dict.keys())
     stepper = 0
 
-    # set up commands
-    rnafold_command = build_config.cfg['viennarna_dir'] + build_config.cfg['rnafold_command']
-    rnalfold_command = build_config.cfg['viennarna_dir'] + build_config.cfg['rnalfold_command']
+    rnafold_results = {key: folds['rnafold'][digest] for key, digest in prepared['rnafold'].items()
+                       if digest in folds['rnafold']}
+    rnalfold_results = {key: folds['rnalfold'][digest] for key, digest in prepared['rnalfold'].items()
+                        if digest in folds['rnalfold']}
 
-    # iterate through tx_list and construct table
-    for tx in tx_assembled.keys():
+    # iterate through the transcripts and construct table
+    for i, record in enumerate(prepared['records']):
         # display progress of txfeat construction
         if job % threads == 0:
             utils.waiting_bar(stepper, message='Chunk %i / %i completed' % (job, chunk_len))
 
-        # load transcript into TxRead class
-        tx_read = tx_classes.TxRead(tx_assembled[tx])
-
         # initialize tx_feature dict
-        txfeat_dict = {'tx_id': tx_read.tx_id,
-                       'gene_id': tx_read.gene_id,
-                       'tx_type': tx_read.tx_type}
+        txfeat_dict = {'tx_id': record['tx_id'],
+                       'gene_id': record['gene_id'],
+                       'tx_type': record['tx_type'],
+                       'chrom': record['chrom']}
 
         try:
             # get all transcript features
-            txfeat_dict.update({'tx.length': len(tx_read.sequence),
-                                'tx.exon_count': tx_read.num_exons,
-                                'tx.gc': tp.gc_content(tx_read.sequence)})
+            txfeat_dict.update({'tx.length': record['length'],
+                                'tx.exon_count': record['num_exons'],
+                                'tx.gc': record['gc']})
 
-            if tx_read.tx_type == 'protein_coding':
-                txfeat_dict.update({'tx.kozac_score': tp.kozac_score(tx_read)})
+            if record['tx_type'] == 'protein_coding':
+                if record['kozac_score'] is None:
+                    raise ValueError('start codon not found in transcript')
+                txfeat_dict.update({'tx.kozac_score': record['kozac_score']})
             else:
                 txfeat_dict.update({'tx.kozac_score': 'NA'})
         except:
-            logger.debug('Job %s Error: Transcript %s features could not be determined' % (job, tx_read.tx_id))
+            logger.debug('Job %s Error: Transcript %s features could not be determined' % (job, record['tx_id']))
 
         # get utr5 features
         try:
-            if tx_read.tx_status['five_prime_UTR'] == 'defined':
-                utr5_sequence = tx_read.get_sequence('mrna_region', 'five_prime_UTR')
-                scan_energy = tp.rnalfold_energy(utr5_sequence, rnalfold_command)
-                if len(utr5_sequence) > 50:
-                    cap_energy = tp.rnafold_energy(utr5_sequence[0:50], rnafold_command)
-                else:
-                    cap_energy = tp.rnafold_energy(utr5_sequence, rnafold_command)
-                txfeat_dict.update({'utr5.length': tx_read.length('mrna_region', 'five_prime_UTR'),
-                                    'utr5.gc': tp.gc_content(utr5_sequence),
+            utr5 = record['regions'].get('five_prime_UTR')
+            if utr5 is not None:
+                scan_energy = rnalfold_results[('utr5', i)]
+                cap_energy = rnafold_results[('utr5.cap', i)]
+                txfeat_dict.update({'utr5.length': record['region_lengths']['five_prime_UTR'],
+                                    'utr5.gc': utr5['gc'],
                                     'utr5.cap_structure_mfe': cap_energy['mfe'],
                                     'utr5.structure_min_scan': scan_energy})
-                if len(utr5_sequence) < 1500:
-                    region_energy = tp.rnafold_energy(utr5_sequence, rnafold_command)
+                if utr5['seq_length'] < rnafold_max_length:
+                    region_energy = rnafold_results[('utr5', i)]
                     txfeat_dict.update({'utr5.structure_mfe': region_energy['mfe'],
                                         'utr5.structure_mea': region_energy['mea'],
                                         'utr5.structure_centroid': region_energy['centroid']})
         except:
-            logger.debug('Job %s Error: Transcript %s five_prime_UTR feature undetermined' % (job, tx_read.tx_id))
+            logger.debug('Job %s Error: Transcript %s five_prime_UTR feature undetermined' % (job, record['tx_id']))
 
         # get cds features
         try:
-            if tx_read.tx_status['CDS'] == 'defined':
-                cds_sequence = tx_read.get_sequence('mrna_region', 'CDS')
-                scan_energy = tp.rnalfold_energy(cds_sequence, rnalfold_command)
-                txfeat_dict.update({'cds.length': tx_read.length('mrna_region', 'CDS'),
-                                    'cds.gc': tp.gc_content(cds_sequence),
+            cds = record['regions'].get('CDS')
+            if cds is not None:
+                scan_energy = rnalfold_results[('cds', i)]
+                txfeat_dict.update({'cds.length': record['region_lengths']['CDS'],
+                                    'cds.gc': cds['gc'],
                                     'cds.structure_min_scan': scan_energy})
-                if len(cds_sequence) < 1500:
-                    region_energy = tp.rnafold_energy(cds_sequence, rnafold_command)
+                if cds['seq_length'] < rnafold_max_length:
+                    region_energy = rnafold_results[('cds', i)]
                     txfeat_dict.update({'cds.structure_mfe': region_energy['mfe'],
                                         'cds.structure_mea': region_energy['mea'],
                                         'cds.structure_centroid': region_energy['centroid']})
         except:
-            logger.debug('Job %s Error: Transcript %s cds feature undetermined' % (job, tx_read.tx_id))
+            logger.debug('Job %s Error: Transcript %s cds feature undetermined' % (job, record['tx_id']))
 
         # get utr3 features
         try:
-            if tx_read.tx_status['three_prime_UTR'] == 'defined':
-                utr3_sequence = tx_read.get_sequence('mrna_region', 'three_prime_UTR')
-                scan_energy = tp.rnalfold_energy(utr3_sequence, rnalfold_command)
-                au_element = tp.au_element(utr3_sequence)
-                txfeat_dict.update({'utr3.length': tx_read.length('mrna_region', 'CDS'),
-                                    'utr3.gc': tp.gc_content(utr3_sequence),
-                                    'utr3.au_pentamer': au_element['au_pentamer'],
-                                    'utr3.au_count': au_element['au_num'],
-                                    'utr3.au_fraction': au_element['au_fraction'],
-                                    'utr3.au_longest': au_element['au_longest'],
+            utr3 = record['regions'].get('three_prime_UTR')
+            if utr3 is not None:
+                scan_energy = rnalfold_results[('utr3', i)]
+                txfeat_dict.update({'utr3.length': record['region_lengths']['CDS'],
+                                    'utr3.gc': utr3['gc'],
+                                    'utr3.au_pentamer': record['utr3_au']['au_pentamer'],
+                                    'utr3.au_count': record['utr3_au']['au_num'],
+                                    'utr3.au_fraction': record['utr3_au']['au_fraction'],
+                                    'utr3.au_longest': record['utr3_au']['au_longest'],
                                     'utr3.strucutre_min_scan': scan_energy})
-                if len(utr3_sequence) < 1500:
-                    region_energy = tp.rnafold_energy(utr3_sequence, rnafold_command)
+                if utr3['seq_length'] < rnafold_max_length:
+                    region_energy = rnafold_results[('utr3', i)]
                     txfeat_dict.update({'utr3.structure_mfe': region_energy['mfe'],
                                         'utr3.structure_mea': region_energy['mea'],
                                         'utr3.structure_centroid': region_energy['centroid']})
         except:
-            logger.debug('Job %s Error: Transcript %s three_prime_UTR feature undetermined' % (job, tx_read.tx_id))
+            logger.debug('Job %s Error: Transcript %s three_prime_UTR feature undetermined' % (job, record['tx_id']))
 
         # get selenocysteine feature
-        try:
-            if tx_read.tx_status['stop_codon_redefined_as_selenocysteine'] == 'defined':
-                txfeat_dict.update({'stop_codon.seleno': 'yes'})
-            else:
-                txfeat_dict.update({'stop_codon.seleno': 'no'})
-        except:
-            logger.debug('Job %s Error: Transcript %s stop_codon_seleno feature undetermined' % (job, tx_read.tx_id))
+        if record['seleno'] is not None:
+            txfeat_dict.update({'stop_codon.seleno': record['seleno']})
+        else:
+            logger.debug('Job %s Error: Transcript %s stop_codon_seleno feature undetermined' % (job, record['tx_id']))
 
         # append feature to return list
         tx_feature.append(txfeat_dict)
 
         # progress bar up increment
-        # progress += 1
         stepper += 1
 
     # Completion time
     task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
-    # if job == 0:
-    #    utils.progress_bar(1, 1, status='Complete!')
     if job == chunk_len - 1:
         utils.waiting_bar(1, message='Chunk %i / %i completed' % (job, chunk_len))
         logger.debug('Feature aggregation took an average of %s minutes per chunk' % (task_time))
@@ -0,0 +1,197 @@
+"""
+Streaming mode of the db_builder pipeline. Transcripts are processed in batches of whole genes and every worker
+assembles and featurizes its batch end to end, only the finished feature rows are sent back to the main process where
+they are appended to the output. Batches are contiguous runs of genes in genomic order so every worker reads a single
+window of the genome. The number of batches in flight is bounded so memory use does not grow with the size
+of the annotation.
+"""
+
+import concurrent.futures
+import logging
+import time
+
+import numpy as np
+
+from txfeature.db_builder import tx_assembly, tx_features, checkpoints, scheduler, build_config, assembly_store
+from txfeature.db_builder import fold_cache
+
+
+def gene_batches(store, batch_size, costs=None, num_units=1):
+    """
+    Groups the transcripts of a store into batches of consecutive whole genes ordered by chromosome and start.
+    :param store: FeatureStore
+    :param batch_size: number of transcripts per batch, batches are closed at the first gene boundary after it
+    :param costs: estimated cost per transcript (see scheduler.store_costs), batches are then closed once they reach
+                  their share of the total cost and returned most expensive first
+    :param num_units: targeted number of batches if costs are given
+    :return: list of arrays of transcript indices
+    """
+    # genes are placed at the position of their first transcript, transcripts of a gene stay together
+    starts, _ = store.tx_spans()
+    tx_genes = store.transcripts['gene_id']
+    chroms = store.transcripts['chrom']
+    gene_chrom = np.zeros(len(store.strings['gene_id']), dtype=chroms.dtype)
+    gene_start = np.full(len(store.strings['gene_id']), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(gene_start, tx_genes, starts)
+    gene_chrom[tx_genes] = chroms
+    order = np.lexsort((starts, tx_genes, gene_start[tx_genes], gene_chrom[tx_genes]))
+    genes = tx_genes[order]
+    # index into order at which each gene starts, a batch may only end at one of them
+    gene_starts = np.flatnonzero(np.concatenate(([True], genes[1:] != genes[:-1])))
+    gene_starts = np.append(gene_starts, len(order))
+
+    if costs is not None:
+        gene_groups = [order[start:stop] for start, stop in zip(gene_starts[:-1], gene_starts[1:])]
+        gene_costs = [sum(costs[tx_index] for tx_index in group) for group in gene_groups]
+        units = scheduler.cost_units(gene_groups, gene_costs, num_units, sizes=[len(group) for group in gene_groups],
+                                     max_size=batch_size, keep_order=True)
+        return [np.concatenate(unit) for _, unit in units]
+
+    batches = []
+    batch_start = 0
+    for gene_start in gene_starts[1:]:
+        if gene_start - batch_start >= batch_size or gene_start == len(order):
+            batches.append(order[batch_start:gene_start])
+            batch_start = gene_start
+    return batches
+
+
+def featurize(store_handle, tx_indices, fasta, job, num_batches, threads, previous_hashes=None, pack_assembly=False):
+    """
+    Assembles a batch of transcripts and aggregates their features.
+    :param store_handle: handle of the shared memory FeatureStore holding the parsed gff file
+    :param tx_indices: indices of the transcripts within the store
+    :param fasta: fasta file for associated gff
+    :param job: integer value of the job
+    :param num_batches: total number of batches
+    :param threads: number of worker processes
+    :param previous_hashes: dict of tx_id -> hash of a previous build, transcripts with unchanged hash are not
+                            featurized again
+    :param pack_assembly: return the packed sequences of the batch for the assembly store
+    :return: dict with 'rows' (list of feature dicts), 'reused' (tx_id -> chrom of unchanged transcripts),
+             'hashes' (tx_id -> hash), 'exon_usage' (exon cache hits and misses), 'fold_usage' (fold cache hits and
+             misses) and with pack_assembly 'assembly' (sequences packed with assembly_store.pack and their 'tx_ids')
+    """
+    tx_assembled, exon_usage = tx_assembly.assemble(store_handle, tx_indices, fasta, job, show_progress=False)
+    hashes = {tx: checkpoints.transcript_hash(transcript) for tx, transcript in tx_assembled.items()}
+    assembly = None
+    if pack_assembly:
+        tx_ids = list(tx_assembled)
+        assembly = assembly_store.pack([tx_assembled[tx]['tx_seq'] for tx in tx_ids])
+        assembly['tx_ids'] = tx_ids
+    reused = {}
+    if previous_hashes:
+        for tx, tx_hash in hashes.items():
+            if previous_hashes.get(tx) == tx_hash:
+                reused[tx] = tx_assembled.pop(tx)['chrom']
+    fold_usage = {'hits': 0, 'misses': 0}
+    rows = tx_features.add_features(tx_assembled, job, num_batches, threads, fold_usage=fold_usage) \
+        if tx_assembled else []
+    return {'rows': rows, 'reused': reused, 'hashes': hashes, 'exon_usage': exon_usage, 'fold_usage': fold_usage,
+            'assembly': assembly}
+
+
+def stream_build(store, fasta, writer, threads, batch_size=500, hash_path=None, checkpoint=None, previous=None,
+                 assembly_writer=None):
+    """
+    Runs assembly and feature aggregation of all transcripts in the store and writes the rows as batches finish.
+    :param store: FeatureStore created by the main process
+    :param fasta: fasta file for associated gff
+    :param writer: txfeat_writer writer receiving the feature rows
+    :param threads: number of worker processes
+    :param batch_size: number of transcripts per batch
+    :param hash_path: path of the transcript hash file written alongside the output
+    :param checkpoint: checkpoints.Checkpoints of the build, completed batches are skipped and replayed to the writer
+    :param previous: previous build as returned by checkpoints.previous_build, unchanged transcripts are copied
+    :param assembly_writer: assembly_store.AssemblyWriter receiving the packed sequences of every batch, the store is
+                            incomplete if batches replayed from checkpoints were saved without their sequences
+    :return: number of rows written
+    """
+    logger = logging.getLogger(__name__ + '.stream_build')
+    initial_time = time.time()
+    window = scheduler.lfold_window(build_config.cfg['rnalfold_command'])
+    batches = gene_batches(store, batch_size, scheduler.store_costs(store, window),
+                           threads * scheduler.units_per_worker)
+    logger.info('Streaming %i transcripts in %i gene batches...' % (len(store), len(batches)))
+    hash_writer = checkpoints.HashWriter(hash_path) if hash_path else None
+    num_reused = 0
+    num_replayed = 0
+    exon_usage = {'hits': 0, 'misses': 0}
+    fold_usage = {'hits': 0, 'misses': 0}
+
+    def finish(job, result):
+        rows = result['rows']
+        if result['reused']:
+            rows += checkpoints.previous_rows(previous, result['reused'])
+        assembly = result['assembly']
+        if assembly is not None:
+            index_of = {store.tx_id(tx_index): tx_index for tx_index in batches[job]}
+            tx_ids = assembly.pop('tx_ids')
+            assembly['tx_indices'] = np.array([index_of[tx] for tx in tx_ids], dtype=np.int64)
+            assembly['tx_hashes'] = assembly_store.hash_array([result['hashes'][tx] for tx in tx_ids])
+            assembly_writer.add(assembly['tx_indices'], assembly)
+        if checkpoint is not None:
+            checkpoint.save(job, rows, result['hashes'], assembly)
+        writer.write(rows)
+        if hash_writer is not None:
+            hash_writer.write(result['hashes'])
+        for name in exon_usage:
+            exon_usage[name] += result['exon_usage'][name]
+            fold_usage[name] += result['fold_usage'][name]
+        return len(result['reused'])
+
+    # batches completed by an interrupted build
+    completed = checkpoint.completed() if checkpoint is not None else set()
+    if completed:
+        logger.info('Resuming build, %i of %i gene batches already completed.' % (len(completed), len(batches)))
+        for job in sorted(completed):
+            saved = checkpoint.load(job)
+            writer.write(saved['rows'])
+            num_replayed += len(saved['rows'])
+            if hash_writer is not None:
+                hash_writer.write(saved['hashes'])
+            if assembly_writer is not None and 'assembly' in saved:
+                assembly = saved['assembly']
+                if 'tx_hashes' not in assembly:
+                    # checkpoints of earlier versions saved the sequences without their hashes
+                    assembly['tx_hashes'] = assembly_store.hash_array([saved['hashes'][store.tx_id(tx_index)]
+                                                                       for tx_index in assembly['tx_indices']])
+                assembly_writer.add(assembly['tx_indices'], assembly)
+
+    # at most two batches per worker are pending, one running and one queued, batches are submitted most expensive
+    # first and idle workers take the next one from the shared queue
+    max_pending = 2 * threads
+    utilization = scheduler.Utilization('Streaming build', threads)
+    pending = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+            for job, batch in enumerate(batches):
+                if job in completed:
+                    continue
+                if len(pending) >= max_pending:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        num_reused += finish(pending.pop(future), utilization.add(future.result()))
+                previous_hashes = None
+                if previous is not None:
+                    tx_ids = [store.tx_id(tx_index) for tx_index in batch]
+                    previous_hashes = {tx: previous['hashes'][tx] for tx in tx_ids if tx in previous['hashes']}
+                future = executor.submit(scheduler.timed, featurize, store.handle, batch, fasta, job, len(batches),
+                                         threads, previous_hashes, assembly_writer is not None)
+                pending[future] = job
+            for future in concurrent.futures.as_completed(pending):
+                num_reused += finish(pending[future], utilization.add(future.result()))
+    finally:
+        if hash_writer is not None:
+            hash_writer.close()
+
+    utilization.log()
+    logger.info(tx_assembly.exon_report(exon_usage))
+    if build_config.cfg['fold_cache']:
+        logger.info(fold_cache.usage_report(fold_usage))
+    if previous is not None:
+        logger.info('Incremental build: %i transcripts unchanged, %i recomputed'
+                    % (num_reused, writer.num_rows - num_reused - num_replayed))
+    task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
+    logger.debug('Streaming build of %i transcripts took %s minutes' % (writer.num_rows, task_time))
+    return writer.num_rows
@@ -3,29 +3,27 @@ contains functions for the purpose of txfeat database construction and cli funct
 """
 from itertools import islice
 
+# Feature types of a transcript tracked during assembly
+tx_feature_types = ['five_prime_UTR', 'stop_codon_redefined_as_selenocysteine', 'exon', 'stop_codon', 'CDS',
+                    'three_prime_UTR', 'start_codon']
+
+
 # Function for looking up transcript features within the gff_table
 def tx2gff_lookup(gff, tx):
-    from .tx_classes import GffReadEntry
-    entry_matches = []
-    gene = gff['tx_attr'][tx]['gene_id']
-    for item in gff['table'][gene]:
-        gff_entry = GffReadEntry(item)
-        if tx == gff_entry.transcript_id:
-            entry_matches.append(item)
-        else:
-            continue
-    return entry_matches
+    return gff['tx_index'].get(tx, {})
+
+
+# Function for converting indexed transcript features into the tx_annot coordinate structure
+def annot_coords(tx_features):
+    tx_annot = {}
+    for ftype in tx_feature_types:
+        tx_annot[ftype] = {}
+        for exon_number, feature in tx_features.get(ftype, {}).items():
+            tx_annot[ftype][exon_number] = {'start': feature.start, 'stop': feature.stop}
+    return tx_annot
+
 
 def chunks(data, size=10000):
     it = iter(data)
     for i in range(0, len(data), size):
         yield {i:data[i] for i in islice(it, size)}
-
-def region_coord_aggregate(exon_dict):
-    agg_coord = []
-    for exon, coord in exon_dict.items():
-        if coord['start'] < coord['stop']:
-            agg_coord = agg_coord + list(range(coord['start'],coord['stop'] + 1))
-        else:
-            agg_coord = agg_coord + list(range(coord['stop'], coord['start'] + 1))
-    return agg_coord
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+Incremental writers of the txfeat_db table. Feature rows are appended batch by batch as they are completed so the
+whole table never needs to be held in memory. Besides csv the table can be written as parquet or feather (arrow ipc)
+files with a fixed typed schema, partitioned by chromosome in hive style (<out_dir>/chrom=<chrom>/part-0.<format>) so
+readers can skip chromosomes and memory map columns. The parquet and feather writers require pyarrow.
+"""
+
+import csv
+import glob
+import os
+
+output_formats = ['csv', 'parquet', 'feather']
+
+
+class CsvWriter:
+    """
+    Appends feature rows to a csv file with a fixed set of columns, missing values are written as NULL.
+    :param path: path of the csv file, overwritten if present
+    :param columns: list of column names
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.num_rows = 0
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        """
+        :param rows: list of feature dicts as returned by tx_features.add_features
+        """
+        for row in rows:
+            self._writer.writerow([_format(row.get(column)) for column in self.columns])
+        self.num_rows += len(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return 'NULL'
+    return value
+
+
+def pyarrow_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+class PartitionedWriter:
+    """
+    Writes feature rows into one typed file per chromosome, rows are buffered per chromosome and written as row groups
+    (parquet) or record batches (feather) of row_group_size rows.
+    :param out_dir: output directory of the partitions
+    :param schema: list of (column, type) with types 'string', 'int32', 'int64' or 'float64'
+    :param file_format: 'parquet' or 'feather'
+    :param row_group_size: number of rows per row group, bounds what a single row lookup of db_reader has to read
+    """
+
+    def __init__(self, out_dir, schema, file_format, row_group_size=10000):
+        import pyarrow
+        self._pa = pyarrow
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.num_rows = 0
+        # the chromosome is stored in the partition path
+        self.schema = [(column, dtype) for column, dtype in schema if column != 'chrom']
+        self.arrow_schema = pyarrow.schema([(column, getattr(pyarrow, dtype)()) for column, dtype in self.schema])
+        self._buffers = {}
+        self._writers = {}
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def write(self, rows):
+        """
+        :param rows: list of feature dicts as returned by tx_features.add_features
+        """
+        for row in rows:
+            self._buffers.setdefault(row['chrom'], []).append(row)
+        for chrom, buffer in self._buffers.items():
+            if len(buffer) >= self.row_group_size:
+                self._flush(chrom)
+        self.num_rows += len(rows)
+
+    def _flush(self, chrom):
+        rows = self._buffers[chrom]
+        if not rows:
+            return
+        columns = [self._pa.array([_typed(row.get(column), dtype) for row in rows], type=getattr(self._pa, dtype)())
+                   for column, dtype in self.schema]
+        table = self._pa.Table.from_arrays(columns, schema=self.arrow_schema)
+        if chrom not in self._writers:
+            self._writers[chrom] = self._open(chrom)
+        if self.file_format == 'parquet':
+            self._writers[chrom].write_table(table, row_group_size=self.row_group_size)
+        else:
+            self._writers[chrom].write_table(table, max_chunksize=self.row_group_size)
+        self._buffers[chrom] = []
+
+    def _open(self, chrom):
+        partition = os.path.join(self.out_dir, 'chrom=%s' % chrom.replace('/', '_'))
+        if not os.path.exists(partition):
+            os.makedirs(partition)
+        path = os.path.join(partition, 'part-0.%s' % self.file_format)
+        if self.file_format == 'parquet':
+            import pyarrow.parquet
+            return pyarrow.parquet.ParquetWriter(path, self.arrow_schema)
+        else:
+            import pyarrow.ipc
+            return pyarrow.ipc.new_file(path, self.arrow_schema)
+
+    def close(self):
+        for chrom in list(self._buffers.keys()):
+            self._flush(chrom)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _typed(value, dtype):
+    """Converts a feature value to the column type, 'NA', 'NULL' and nan become missing values."""
+    if value is None or value == 'NA' or value == 'NULL' or (isinstance(value, float) and value != value):
+        return None
+    if dtype == 'string':
+        return str(value)
+    if dtype == 'float64':
+        return float(value)
+    return int(value)
+
+
+def open_writer(file_format, out_path, schema):
+    """
+    Creates the writer of an output format.
+    :param file_format: one of output_formats
+    :param out_path: csv file for 'csv', partition directory otherwise
+    :param schema: list of (column, type), see PartitionedWriter
+    """
+    if file_format == 'csv':
+        return CsvWriter(out_path, [column for column, _ in schema])
+    return PartitionedWriter(out_path, schema, file_format)
+
+
+def read_rows(out_dir, schema=None):
+    """
+    Reads the feature rows of a finished build back, from txfeat_db.csv or the partitioned parquet / feather output.
+    :param out_dir: output directory of the build (-out)
+    :param schema: list of (column, type) used to type csv values, defaults to tx_features.feature_schema
+    :return: iterator of feature dicts, missing values are None
+    """
+    if schema is None:
+        from txfeature.db_builder import tx_features
+        schema = tx_features.feature_schema
+    types = dict(schema)
+    csv_path = os.path.join(out_dir, 'txfeat_db.csv')
+    if os.path.isfile(csv_path):
+        with open(csv_path, 'r', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield typed_row(row, types)
+        return
+
+    import pyarrow
+    import pyarrow.dataset
+    partition_dir = os.path.join(out_dir, 'txfeat_db')
+    # chromosome names like 1 or X are always read back as strings instead of the inferred type
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('chrom', pyarrow.string())]), flavor='hive')
+    for file_format, extension in [('parquet', '.parquet'), ('ipc', '.feather')]:
+        if glob.glob(os.path.join(partition_dir, 'chrom=*', '*' + extension)):
+            dataset = pyarrow.dataset.dataset(partition_dir, format=file_format, partitioning=partitioning)
+            for batch in dataset.to_batches():
+                for row in batch.to_pylist():
+                    yield row
+            return
+    raise IOError('No txfeat_db output found in %s' % out_dir)
+
+
+def typed_row(row, types):
+    """
+    Converts a row read from txfeat_db.csv to typed values.
+    :param row: dict of column -> csv value
+    :param types: dict of column -> type, columns not found are kept as string
+    """
+    return {column: _parse(value, types.get(column, 'string')) for column, value in row.items()}
+
+
+def _parse(value, dtype):
+    """Converts a csv value to the column type, 'NA' is kept as written by tx_features for non-coding transcripts."""
+    if value == 'NULL' or value == '':
+        return None
+    if value == 'NA' or dtype == 'string':
+        return value
+    if dtype == 'float64':
+        return float(value)
+    return int(float(value))
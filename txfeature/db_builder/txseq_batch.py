@@ -0,0 +1,163 @@
+"""
+contains vectorized versions of the txseq_properties functions which operate on many sequences at once. Sequences are
+encoded a single time into a concatenated uint8 array with offsets and every property is returned as a numpy array
+aligned with the order of the input sequences.
+"""
+
+import numpy as np
+
+_A, _C, _G, _N, _T, _U = (ord(base) for base in 'ACGNTU')
+
+# (relative position to start codon, base(s), weight) used for the kozac score, see txseq_properties.kozac_score
+_kozac_positions = [(1, (_G,), 3), (-3, (_C,), 1), (-4, (_C,), 1), (-5, (_A, _G), 3), (-6, (_C,), 1), (-7, (_C,), 1),
+                    (-8, (_G,), 3)]
+
+
+class SeqBatch:
+    """
+    Many sequences encoded as one uint8 array, sequence i is codes[offsets[i]:offsets[i + 1]].
+    :param seqs: iterable of sequences as strings or PackedSeq
+    """
+
+    def __init__(self, seqs):
+        seqs = [str(seq) for seq in seqs]
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        self.offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.lengths = lengths
+        self.codes = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+
+    @classmethod
+    def from_codes(cls, codes, lengths):
+        """
+        SeqBatch on already encoded sequences (ex. unpacked by packed_seq.PackedBatch).
+        :param codes: uint8 array of the concatenated sequences
+        :param lengths: number of bases of every sequence
+        """
+        batch = cls.__new__(cls)
+        batch.lengths = np.asarray(lengths, dtype=np.int64)
+        batch.offsets = np.zeros(len(batch.lengths) + 1, dtype=np.int64)
+        np.cumsum(batch.lengths, out=batch.offsets[1:])
+        batch.codes = codes
+        return batch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def seq_index(self, positions):
+        """Index of the sequence each position of the concatenated array belongs to."""
+        return np.searchsorted(self.offsets, positions, side='right') - 1
+
+    def count(self, mask):
+        """Number of True values of a per base mask within each sequence."""
+        cumulative = np.zeros(len(mask) + 1, dtype=np.int64)
+        np.cumsum(mask, out=cumulative[1:])
+        return cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
+
+def encode(seqs):
+    """
+    Encodes sequences for the batch functions.
+    :param seqs: iterable of sequences as strings
+    :return: SeqBatch
+    """
+    return SeqBatch(seqs)
+
+
+def gc_content(batch):
+    """
+    Vectorized txseq_properties.gc_content, fraction of G and C ignoring any N present in each sequence.
+    :param batch: SeqBatch
+    :return: float array, 0 for sequences without any non-N base
+    """
+    codes = batch.codes
+    num_gc = batch.count((codes == _G) | (codes == _C))
+    denominator = batch.lengths - batch.count(codes == _N)
+    percent_gc = np.zeros(len(batch), dtype=np.float64)
+    np.divide(num_gc, denominator, out=percent_gc, where=denominator > 0)
+    return percent_gc
+
+
+def au_element(batch):
+    """
+    Vectorized txseq_properties.au_element. T is treated as U, AU elements are runs of A or U of at least 5 bases and
+    'AUUUA' pentamers are counted without overlap (as str.count).
+    :param batch: SeqBatch
+    :return: dict of arrays with keys 'au_pentamer', 'au_num', 'au_fraction', 'au_longest'
+    """
+    codes = batch.codes
+    num_seqs = len(batch)
+    total = len(codes)
+    is_u = (codes == _U) | (codes == _T)
+    is_au = is_u | (codes == _A)
+
+    # runs of A/U bases, runs are broken at sequence boundaries
+    first_base = np.zeros(total, dtype=bool)
+    last_base = np.zeros(total, dtype=bool)
+    nonempty = batch.lengths > 0
+    first_base[batch.offsets[:-1][nonempty]] = True
+    last_base[batch.offsets[1:][nonempty] - 1] = True
+    previous_au = np.concatenate(([False], is_au[:-1])) & ~first_base
+    next_au = np.concatenate((is_au[1:], [False])) & ~last_base
+    run_starts = np.flatnonzero(is_au & ~previous_au)
+    run_stops = np.flatnonzero(is_au & ~next_au) + 1
+    run_lengths = run_stops - run_starts
+    elements = run_lengths >= 5
+    element_seq = batch.seq_index(run_starts[elements])
+    element_lengths = run_lengths[elements]
+
+    au_num = np.bincount(element_seq, minlength=num_seqs)
+    au_bases = np.bincount(element_seq, weights=element_lengths, minlength=num_seqs)
+    au_longest = np.zeros(num_seqs, dtype=np.int64)
+    np.maximum.at(au_longest, element_seq, element_lengths)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        au_fraction = au_bases / batch.lengths
+
+    # 'AUUUA' pentamers which do not run past the end of their sequence
+    au_pentamer = np.zeros(num_seqs, dtype=np.int64)
+    if total >= 5:
+        match = ((codes[:-4] == _A) & is_u[1:-3] & is_u[2:-2] & is_u[3:-1] & (codes[4:] == _A))
+        positions = np.flatnonzero(match)
+        match_seq = batch.seq_index(positions)
+        within = positions + 5 <= batch.offsets[match_seq + 1]
+        positions = positions[within]
+        match_seq = match_seq[within]
+        if len(positions) > 0:
+            # consecutive pentamers 4 bases apart share an A, str.count only counts every other one of such a chain
+            chain_break = np.concatenate(([True], np.diff(positions) != 4))
+            chain_id = np.cumsum(chain_break) - 1
+            chain_length = np.bincount(chain_id)
+            chain_seq = match_seq[chain_break]
+            au_pentamer = np.bincount(chain_seq, weights=(chain_length + 1) // 2, minlength=num_seqs).astype(np.int64)
+
+    return {'au_pentamer': au_pentamer,
+            'au_num': au_num,
+            'au_fraction': au_fraction,
+            'au_longest': au_longest}
+
+
+def kozac_score(batch, start_indices):
+    """
+    Vectorized txseq_properties.kozac_score using the position of the start codon within each transcript.
+    :param batch: SeqBatch of transcript sequences
+    :param start_indices: array of 0-based start codon index per transcript (txseq_properties.kozac_start), negative
+                          values mark transcripts without a kozac score
+    :return: int array of kozac scores, -1 where not determined
+    """
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    valid = start_indices >= 0
+    scores = np.zeros(len(batch), dtype=np.int64)
+    if len(batch.codes) == 0:
+        return scores - 1
+    for relative, bases, weight in _kozac_positions:
+        index = start_indices + relative
+        # negative indices wrap around as python string indexing does
+        index = np.where(index < 0, index + batch.lengths, index)
+        valid &= (index >= 0) & (index < batch.lengths)
+        base = batch.codes[np.where(valid, batch.offsets[:-1] + index, 0)]
+        hit = np.zeros(len(batch), dtype=bool)
+        for code in bases:
+            hit |= base == code
+        scores += weight * (hit & valid)
+    scores[~valid] = -1
+    return scores
@@ -11,11 +11,11 @@ def au_element(seq):
     Takes input string and calculates 1) 'AUUUA' ppentamer count 2) number of AU elements 3) fraction of sequence
     consisting of AU element and 4) longest AU element in sequence. AU element is considered a sequence of A or U longer
     than 5 bases.
-    :param seq: input mRNA sequence as string
+    :param seq: input mRNA sequence as string or PackedSeq
     :returns: dict of the calculated values. dict keys: 'au_pentamer', 'au_num', 'au_fraction', 'au_longest'
     """
     # convert T to U
-    seq = seq.replace('T', 'U')
+    seq = str(seq).replace('T', 'U')
 
     # pentamer count
     au_pentamer_count = seq.count('AUUUA')
@@ -41,7 +41,7 @@ def au_element(seq):
 def gc_content(seq):
     """
     Calculates % GC content of sequence ignoring any N present in sequence.
-    :param seq: input mRNA sequence as string
+    :param seq: input mRNA sequence as string or PackedSeq (counted from its packed bytes)
     :return: percent gc as float
     """
     # count G and C in seq
@@ -55,15 +55,12 @@ def gc_content(seq):
     return percent_gc
 
 
-def rnafold_energy(sequence, command):
-    if len(sequence) < 1:
-        return {'mfe': 0, 'ensemble': 0, 'centroid': 0, 'mea': 0}
-
-    out_array = []
-    output = utils.stdout_from_command("echo %s | %s" % (sequence, command))
-    for lines in output:
-        out_array.append(str(lines, 'utf-8'))
-
+def parse_rnafold(out_array):
+    """
+    Parses the output of RNAfold --MEA -p for a single sequence.
+    :param out_array: output lines starting with the sequence line (any fasta header removed)
+    :return: dict with keys 'mfe', 'ensemble', 'centroid', 'mea'
+    """
     # second line has the MFE
     mfe = float(re.sub('[()]', '', out_array[1].split()[-1]))
 
@@ -80,6 +77,28 @@ def rnafold_energy(sequence, command):
     return {'mfe': mfe, 'ensemble': ensemble, 'centroid': centroid, 'mea': mea}
 
 
+def parse_rnalfold(out_array):
+    """
+    Parses the output of RNALfold for a single sequence.
+    :param out_array: output lines of the sequence (any fasta header removed)
+    :return: minimum free energy of the whole sequence as float
+    """
+    pattern = re.compile(r'(?<=\().*?(?=\))')
+    energy = float(pattern.findall(out_array[-1])[0])
+    return energy
+
+
+def rnafold_energy(sequence, command):
+    if len(sequence) < 1:
+        return {'mfe': 0, 'ensemble': 0, 'centroid': 0, 'mea': 0}
+
+    out_array = []
+    output = utils.stdout_from_command("echo %s | %s" % (sequence, command))
+    for lines in output:
+        out_array.append(str(lines, 'utf-8'))
+    return parse_rnafold(out_array)
+
+
 def rnalfold_energy(sequence, command):
     if len(sequence) < 1:
         return 0
@@ -88,41 +107,49 @@ def rnalfold_energy(sequence, command):
     output = utils.stdout_from_command("echo %s | %s" % (sequence, command))
     for lines in output:
         out_array.append(str(lines, 'utf-8'))
-    pattern = re.compile(r'(?<=\().*?(?=\))')
-    energy = float(pattern.findall(out_array[-1])[0])
-    return energy
+    return parse_rnalfold(out_array)
 
 
-def kozac_score(txread):
+def kozac_start(txread):
+    """
+    Index of the start codon within the transcript sequence used to determine the kozac score, the kozac positions of
+    kozac_score are relative to this index.
+    :param txread: TxRead of transcript
+    :return: 0-based index of the last (3') base of the start codon, -1 if the kozac score can not be determined
+    """
     if txread.tx_status['five_prime_UTR'] == 'defined' and txread.tx_status['start_codon'] == 'defined':
         if txread.length('mrna_region', 'five_prime_UTR') > 9 and txread.length('mrna_region', 'CDS') > 15:
             if txread.strand == '+':
-                start_zero = txread.g2iloc.index(int(txread.start_codon_coord.split(':')[1].split('-')[1]))
+                return txread.coord_map.index(int(txread.start_codon_coord.split(':')[1].split('-')[1]))
             else:
-                start_zero = txread.g2iloc.index(int(txread.start_codon_coord.split(':')[1].split('-')[0]))
-            score_1 = 0
-            score_3 = 0
-            pos_1 = txread.sequence[start_zero + 1]  # +3 if G
-            neg_3 = txread.sequence[start_zero - 3]  # +1 if C
-            neg_4 = txread.sequence[start_zero - 4]  # +1 if C
-            neg_5 = txread.sequence[start_zero - 5]  # +3 if A or G
-            neg_6 = txread.sequence[start_zero - 6]  # +1 if C
-            neg_7 = txread.sequence[start_zero - 7]  # +1 if C
-            neg_8 = txread.sequence[start_zero - 8]  # +3 if G
-            for position in [neg_3, neg_4, neg_6, neg_7]:
-                if position == 'C':
-                    score_1 += 1
-            for position in [pos_1, neg_8]:
-                if position == 'G':
-                    score_3 += 1
-            if neg_5 == 'A' or neg_5 == 'G':
-                score_3 += 1
-            kozac_score = score_1 + 3*(score_3)
-        else:
-            return -1
-    else:
+                return txread.coord_map.index(int(txread.start_codon_coord.split(':')[1].split('-')[0]))
+    return -1
+
+
+def kozac_score(txread):
+    start_zero = kozac_start(txread)
+    if start_zero < 0:
         return -1
 
+    score_1 = 0
+    score_3 = 0
+    pos_1 = txread.sequence[start_zero + 1]  # +3 if G
+    neg_3 = txread.sequence[start_zero - 3]  # +1 if C
+    neg_4 = txread.sequence[start_zero - 4]  # +1 if C
+    neg_5 = txread.sequence[start_zero - 5]  # +3 if A or G
+    neg_6 = txread.sequence[start_zero - 6]  # +1 if C
+    neg_7 = txread.sequence[start_zero - 7]  # +1 if C
+    neg_8 = txread.sequence[start_zero - 8]  # +3 if G
+    for position in [neg_3, neg_4, neg_6, neg_7]:
+        if position == 'C':
+            score_1 += 1
+    for position in [pos_1, neg_8]:
+        if position == 'G':
+            score_3 += 1
+    if neg_5 == 'A' or neg_5 == 'G':
+        score_3 += 1
+    kozac_score = score_1 + 3*(score_3)
+
     return kozac_score
 
 
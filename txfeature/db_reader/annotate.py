@@ -0,0 +1,285 @@
+"""
+Bulk annotation of genomic positions (VCF-like chrom / pos lists) with the transcript regions they fall in. The region
+blocks of a build (see region_index) are loaded once into sorted numpy arrays per chromosome and block length class,
+the positions file is read in chunks which are sorted and swept against the blocks with searchsorted by worker
+processes, so files larger than memory are annotated in parallel with bounded memory. Results are written in the
+order of the input.
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from txfeature.db_builder import txfeat_functions
+from txfeature.db_reader import region_index
+
+# label of positions within the span of a transcript that are not within any of its exons
+intron_label = 'intron'
+# pseudo region of the transcript span, positions only overlapping it are intronic
+_span_label = 'transcript'
+
+# region labels in the order they are reported
+region_labels = txfeat_functions.tx_feature_types + [intron_label]
+
+# blocks of the builds loaded by the current process, see load_blocks
+_blocks = {}
+
+
+class Blocks:
+    """
+    Region blocks of a build in numpy arrays. Blocks of every chromosome are split into classes of blocks of up to
+    2^k bases sorted by start, the blocks of a class that can overlap a position then start within 2^k bases before it.
+    :param out_dir: output directory of the build (-out)
+    """
+
+    def __init__(self, out_dir):
+        path = region_index.region_path(out_dir)
+        if not os.path.isfile(path):
+            raise IOError('%s not found, the region index is written by build_db' % path)
+        db = sqlite3.connect(path)
+        rows = db.execute('SELECT chrom, start, stop, tx_id, region, strand, tx_offset FROM blocks').fetchall()
+        db.close()
+
+        self.tx_ids = []
+        tx_codes = {}
+        chroms, starts, stops, txs, regions, offsets = [], [], [], [], [], []
+        minus = []
+        for chrom, start, stop, tx_id, region, strand, tx_offset in rows:
+            if tx_id not in tx_codes:
+                tx_codes[tx_id] = len(self.tx_ids)
+                self.tx_ids.append(tx_id)
+                minus.append(strand == '-')
+            chroms.append(chrom)
+            starts.append(start)
+            stops.append(stop)
+            txs.append(tx_codes[tx_id])
+            regions.append(region_labels.index(region))
+            offsets.append(tx_offset or 0)
+        del rows
+        self.tx_minus = np.array(minus, dtype=bool)
+        starts = np.array(starts, dtype=np.int64)
+        stops = np.array(stops, dtype=np.int64)
+        txs = np.array(txs, dtype=np.int64)
+        regions = np.array(regions, dtype=np.int64)
+        offsets = np.array(offsets, dtype=np.int64)
+        chroms = np.array(chroms, dtype=object)
+
+        # span of every transcript, positions overlapping only the span are intronic
+        exons = regions == region_labels.index('exon')
+        span_starts = np.full(len(self.tx_ids), np.iinfo(np.int64).max, dtype=np.int64)
+        span_stops = np.zeros(len(self.tx_ids), dtype=np.int64)
+        np.minimum.at(span_starts, txs[exons], starts[exons])
+        np.maximum.at(span_stops, txs[exons], stops[exons])
+        span_chroms = np.empty(len(self.tx_ids), dtype=object)
+        span_chroms[txs] = chroms
+        has_span = span_stops > 0
+        self.starts = np.concatenate((starts, span_starts[has_span]))
+        self.stops = np.concatenate((stops, span_stops[has_span]))
+        self.txs = np.concatenate((txs, np.flatnonzero(has_span)))
+        self.regions = np.concatenate((regions, np.full(int(has_span.sum()), -1, dtype=np.int64)))
+        self.offsets = np.concatenate((offsets, np.zeros(int(has_span.sum()), dtype=np.int64)))
+        chroms = np.concatenate((chroms, span_chroms[has_span]))
+
+        # chromosome -> list of (starts, stops, block ids, maximum length) per length class
+        self.classes = {}
+        length_class = np.ceil(np.log2(self.stops - self.starts + 1)).astype(np.int64)
+        for chrom in np.unique(chroms):
+            on_chrom = np.flatnonzero(chroms == chrom)
+            self.classes[chrom] = []
+            for k in np.unique(length_class[on_chrom]):
+                ids = on_chrom[length_class[on_chrom] == k]
+                ids = ids[np.argsort(self.starts[ids], kind='stable')]
+                self.classes[chrom].append((self.starts[ids], self.stops[ids], ids, 2 ** int(k)))
+
+    def overlaps(self, chrom, positions):
+        """
+        Blocks overlapping positions of a chromosome.
+        :param positions: sorted array of 1-based positions
+        :return: arrays of position indices and block ids of every overlap
+        """
+        matched_positions = []
+        matched_blocks = []
+        for starts, stops, ids, max_length in self.classes.get(chrom, []):
+            low = np.searchsorted(starts, positions - max_length + 1, side='left')
+            high = np.searchsorted(starts, positions, side='right')
+            counts = high - low
+            num_candidates = int(counts.sum())
+            if num_candidates == 0:
+                continue
+            candidate_positions = np.repeat(np.arange(len(positions)), counts)
+            candidates = np.arange(num_candidates) - np.repeat(np.cumsum(counts) - counts, counts) \
+                + np.repeat(low, counts)
+            overlapping = stops[candidates] >= positions[candidate_positions]
+            matched_positions.append(candidate_positions[overlapping])
+            matched_blocks.append(ids[candidates[overlapping]])
+        if not matched_positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(matched_positions), np.concatenate(matched_blocks)
+
+
+def load_blocks(out_dir):
+    """Blocks of a build, loaded once per process."""
+    if out_dir not in _blocks:
+        _blocks[out_dir] = Blocks(out_dir)
+    return _blocks[out_dir]
+
+
+def parse_positions(lines):
+    """
+    Reads chrom and position from the first two columns of tab or space separated lines, lines starting with '#' are
+    skipped.
+    :return: list of chromosomes and array of positions
+    """
+    chroms = []
+    positions = []
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.split(None, 2)
+        if len(fields) < 2 or not fields[1].isdigit():
+            raise ValueError('Invalid position line: %s' % line.rstrip())
+        chroms.append(fields[0])
+        positions.append(int(fields[1]))
+    return chroms, np.array(positions, dtype=np.int64)
+
+
+def annotate_chunk(out_dir, lines):
+    """
+    Annotates a chunk of position lines.
+    :param out_dir: output directory of the build (-out)
+    :param lines: list of lines of the positions file
+    :return: tab separated output lines as string, one line per overlapped transcript of each position and a single
+             intergenic line for positions without transcripts
+    """
+    blocks = load_blocks(out_dir)
+    chroms, positions = parse_positions(lines)
+    chrom_array = np.array(chroms, dtype=object)
+    annotations = [[] for _ in chroms]
+
+    # positions are sorted by chromosome and position before the sweep
+    for chrom in sorted(set(chroms)):
+        selected = np.flatnonzero(chrom_array == chrom)
+        selected = selected[np.argsort(positions[selected], kind='stable')]
+        chrom_positions = positions[selected]
+        position_indices, block_ids = blocks.overlaps(chrom, chrom_positions)
+        if len(block_ids) == 0:
+            continue
+        txs = blocks.txs[block_ids]
+        regions = blocks.regions[block_ids]
+        # transcript-relative offset of positions within exons
+        exonic = regions == region_labels.index('exon')
+        offsets = np.where(blocks.tx_minus[txs],
+                           blocks.stops[block_ids] - chrom_positions[position_indices],
+                           chrom_positions[position_indices] - blocks.starts[block_ids]) + blocks.offsets[block_ids]
+        offsets[~exonic] = 0
+        order = np.lexsort((regions, txs, position_indices))
+
+        current = None
+        for match in order.tolist():
+            key = (int(position_indices[match]), int(txs[match]))
+            if key != current:
+                current = key
+                annotation = [blocks.tx_ids[key[1]], [], 0]
+                annotations[selected[key[0]]].append(annotation)
+            if regions[match] >= 0:
+                annotation[1].append(region_labels[regions[match]])
+            if exonic[match]:
+                annotation[2] = int(offsets[match])
+
+    output = []
+    for chrom, position, position_annotations in zip(chroms, positions.tolist(), annotations):
+        if not position_annotations:
+            output.append('%s\t%i\t.\tintergenic\t.\n' % (chrom, position))
+        for tx_id, labels, offset in position_annotations:
+            output.append('%s\t%i\t%s\t%s\t%s\n' % (chrom, position, tx_id, ';'.join(labels) or intron_label,
+                                                    offset if offset > 0 else '.'))
+    return ''.join(output)
+
+
+def read_chunks(path, chunk_size):
+    """Yields lists of at most chunk_size lines of a file."""
+    with open(path, 'r') as positions_file:
+        chunk = []
+        for line in positions_file:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def annotate(out_dir, positions_path, output_path, threads=1, chunk_size=500000):
+    """
+    Annotates all positions of a file.
+    :param out_dir: output directory of the build (-out)
+    :param positions_path: file of chrom and position columns (ex. VCF)
+    :param output_path: tab separated output file
+    :param threads: number of worker processes
+    :param chunk_size: number of lines annotated per job
+    :return: number of annotated lines
+    """
+    logger = logging.getLogger(__name__ + '.annotate')
+    initial_time = time.time()
+    # blocks are loaded before the workers start so forked workers share them
+    load_blocks(out_dir)
+    num_lines = 0
+    with open(output_path, 'w') as output:
+        output.write('chrom\tpos\ttx_id\tregion\ttx_pos\n')
+        if threads <= 1:
+            for chunk in read_chunks(positions_path, chunk_size):
+                output.write(annotate_chunk(out_dir, chunk))
+                num_lines += len(chunk)
+        else:
+            # at most two chunks per worker are pending, results are written in input order
+            with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+                pending = []
+                for chunk in read_chunks(positions_path, chunk_size):
+                    if len(pending) >= 2 * threads:
+                        output.write(pending.pop(0).result())
+                    pending.append(executor.submit(annotate_chunk, out_dir, chunk))
+                    num_lines += len(chunk)
+                for future in pending:
+                    output.write(future.result())
+    task_time = format(round((time.time() - initial_time) / 60, 2), '0.2f')
+    logger.debug('Annotated %i lines of %s in %s minutes' % (num_lines, positions_path, task_time))
+    return num_lines
+
+
+def main():
+    # Setup of argparse for script arguments
+    parser = argparse.ArgumentParser(description="Annotate genomic positions with the transcript regions of a "
+                                                 "txfeat_db built with build_db.", prog="txfeature annotate")
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument("-db", type=str, default=None, metavar="<db_dir>",
+                          help="specify output directory of build_db (-out)", required=True)
+    required.add_argument("-positions", type=str, default=None, metavar="<positions_file>",
+                          help="file with chromosome and 1-based position in the first two columns (ex. VCF)",
+                          required=True)
+    optional.add_argument("-out", type=str, default=None, metavar="<output_file>",
+                          help="tab separated output file (default = <positions_file>.txfeat.tsv)")
+    optional.add_argument("-t", "--threads", nargs='?', const=1, type=int, default=1, metavar="",
+                          help='number of threads to utilize (default = 1)')
+    optional.add_argument("--chunk_size", type=int, default=500000, metavar="",
+                          help='number of lines annotated per job (default = 500000)')
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+
+    for path in [args.db, args.positions]:
+        if not os.path.exists(path):
+            print('txfeature annotate: error: %s not found' % path)
+            sys.exit(1)
+    output_path = args.out if args.out is not None else args.positions + '.txfeat.tsv'
+    num_lines = annotate(args.db, args.positions, output_path, args.threads, args.chunk_size)
+    print('Annotated %i lines, results written to %s' % (num_lines, output_path))
+
+
+if __name__ == '__main__':
+    main()
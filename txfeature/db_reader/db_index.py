@@ -0,0 +1,171 @@
+"""
+On-disk lookup index of a built txfeat_db. The index is a SQLite database stored next to the table
+(<out>/txfeat_db/_index.sqlite) mapping tx_id, gene_id, gene_name and tx_type to the location of each row: the byte
+offset and length of the line within txfeat_db.csv, or the partition file, row group and row number within the row
+group of the parquet / feather output (record batches of feather files are indexed as row groups). The index is
+written by build_db and rebuilt by the reader if the table changed since it was indexed.
+"""
+
+import csv
+import glob
+import io
+import logging
+import os
+import sqlite3
+
+index_file = '_index.sqlite'
+
+# columns that can be looked up
+key_columns = ['tx_id', 'gene_id', 'gene_name', 'tx_type']
+
+# layout version of the index, older indexes are rebuilt
+index_version = '2'
+
+_extensions = {'.parquet': 'parquet', '.feather': 'feather'}
+
+
+def index_path(out_dir):
+    return os.path.join(out_dir, 'txfeat_db', index_file)
+
+
+def table_files(out_dir):
+    """
+    Files holding the txfeat_db table of a build.
+    :param out_dir: output directory of the build (-out)
+    :return: list of (path relative to out_dir, format), format is 'csv', 'parquet' or 'feather'
+    """
+    if os.path.isfile(os.path.join(out_dir, 'txfeat_db.csv')):
+        return [('txfeat_db.csv', 'csv')]
+    files = []
+    for path in sorted(glob.glob(os.path.join(out_dir, 'txfeat_db', 'chrom=*', 'part-*'))):
+        extension = os.path.splitext(path)[1]
+        if extension in _extensions:
+            files.append((os.path.relpath(path, out_dir), _extensions[extension]))
+    if not files:
+        raise IOError('No txfeat_db output found in %s' % out_dir)
+    return files
+
+
+def _signature(out_dir, files):
+    """Sizes and modification times of the table files, the index is stale once they change."""
+    stats = []
+    for path, _ in files:
+        stat = os.stat(os.path.join(out_dir, path))
+        stats.append('%s:%i:%i' % (path, stat.st_size, stat.st_mtime_ns))
+    return '|'.join(stats)
+
+
+def _csv_locations(path):
+    """
+    Yields the key columns and the location of every row of a csv table.
+    :return: iterator of (row dict, None, byte offset, byte length)
+    """
+    with open(path, 'rb') as csv_file:
+        header = next(csv.reader([csv_file.readline().decode()]))
+        offset = csv_file.tell()
+        for line in csv_file:
+            values = next(csv.reader(io.StringIO(line.decode())))
+            yield dict(zip(header, values)), None, offset, len(line)
+            offset += len(line)
+
+
+def _arrow_locations(path, file_format):
+    """
+    Yields the key columns and the location of every row of a parquet or feather partition.
+    :return: iterator of (row dict, row group, row number within the row group, 1)
+    """
+    import pyarrow
+    columns = ['tx_id', 'gene_id', 'tx_type']
+    chrom = os.path.basename(os.path.dirname(path))[len('chrom='):]
+    if file_format == 'parquet':
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        groups = (parquet_file.read_row_group(i, columns=columns) for i in range(parquet_file.num_row_groups))
+    else:
+        import pyarrow.ipc
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+        groups = (pyarrow.Table.from_batches([reader.get_batch(i)]).select(columns)
+                  for i in range(reader.num_record_batches))
+    for row_group, table in enumerate(groups):
+        for row_number, row in enumerate(table.to_pylist()):
+            row['chrom'] = chrom
+            yield row, row_group, row_number, 1
+
+
+def build_index(out_dir, gene_names=None):
+    """
+    Creates the lookup index of a built txfeat_db, replacing an existing index.
+    :param out_dir: output directory of the build (-out)
+    :param gene_names: dict of tx_id -> gene_name, the gene names of the existing index are kept if not given
+    :return: number of indexed rows
+    """
+    logger = logging.getLogger(__name__ + '.build_index')
+    path = index_path(out_dir)
+    if gene_names is None:
+        gene_names = {}
+        if os.path.isfile(path):
+            previous = sqlite3.connect(path)
+            try:
+                gene_names = dict(previous.execute('SELECT tx_id, gene_name FROM rows WHERE gene_name IS NOT NULL'))
+            except sqlite3.DatabaseError:
+                pass
+            previous.close()
+
+    files = table_files(out_dir)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # written to a temporary file first so readers never see a partial index
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    db = sqlite3.connect(path + '.tmp')
+    num_rows = 0
+    with db:
+        db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        db.execute('CREATE TABLE parts (part INTEGER PRIMARY KEY, path TEXT NOT NULL, format TEXT NOT NULL)')
+        db.execute('CREATE TABLE rows (tx_id TEXT, gene_id TEXT, gene_name TEXT, tx_type TEXT, chrom TEXT, '
+                   'part INTEGER NOT NULL, row_group INTEGER, position INTEGER NOT NULL, length INTEGER NOT NULL)')
+        for part, (file_path, file_format) in enumerate(files):
+            db.execute('INSERT INTO parts VALUES (?, ?, ?)', (part, file_path, file_format))
+            full_path = os.path.join(out_dir, file_path)
+            if file_format == 'csv':
+                locations = _csv_locations(full_path)
+            else:
+                locations = _arrow_locations(full_path, file_format)
+            batch = []
+            for row, row_group, offset, length in locations:
+                batch.append((row['tx_id'], row['gene_id'], gene_names.get(row['tx_id']), row['tx_type'],
+                              row.get('chrom'), part, row_group, offset, length))
+                if len(batch) >= 10000:
+                    db.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                    num_rows += len(batch)
+                    batch = []
+            db.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            num_rows += len(batch)
+        for column in key_columns:
+            db.execute('CREATE INDEX rows_%s ON rows (%s)' % (column, column))
+        db.execute('INSERT INTO meta VALUES (?, ?)', ('signature', _signature(out_dir, files)))
+        db.execute('INSERT INTO meta VALUES (?, ?)', ('version', index_version))
+    db.close()
+    os.replace(path + '.tmp', path)
+    logger.debug('Indexed %i rows of %s' % (num_rows, out_dir))
+    return num_rows
+
+
+def is_current(out_dir):
+    """True if the index exists, has the current layout and the table did not change since it was indexed."""
+    path = index_path(out_dir)
+    if not os.path.isfile(path):
+        return False
+    db = sqlite3.connect(path)
+    try:
+        meta = dict(db.execute('SELECT name, value FROM meta'))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        db.close()
+    if meta.get('version') != index_version:
+        return False
+    try:
+        return 'signature' in meta and meta['signature'] == _signature(out_dir, table_files(out_dir))
+    except IOError:
+        return False
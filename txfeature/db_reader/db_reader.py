@@ -0,0 +1,244 @@
+"""
+Random access to a built txfeat_db. Rows are looked up by tx_id, gene_id, gene_name or tx_type through the on-disk
+index (see db_index) and only the matching rows are read from the csv file or the parquet / feather partitions.
+Results of repeated queries are served from an in-memory LRU cache. Transcripts overlapping genomic coordinates are
+found through the region index (see region_index).
+"""
+
+import argparse
+import collections
+import csv
+import io
+import logging
+import os
+import sqlite3
+import sys
+
+from txfeature.db_builder import tx_features, txfeat_writer
+from txfeature.db_reader import db_index, region_index
+
+
+class TxfeatDB:
+    """
+    Reader of a built txfeat_db, the index is created if missing or out of date.
+    :param out_dir: output directory of the build (-out)
+    :param cache_size: number of queries kept in the LRU cache, 0 to read every query from the table files
+    """
+
+    def __init__(self, out_dir, cache_size=1024):
+        logger = logging.getLogger(__name__ + '.TxfeatDB')
+        self.out_dir = out_dir
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        if not db_index.is_current(out_dir):
+            logger.debug('Indexing txfeat_db of %s' % out_dir)
+            db_index.build_index(out_dir)
+        self._index = sqlite3.connect(db_index.index_path(out_dir))
+        self._parts = {part: (os.path.join(out_dir, path), file_format)
+                       for part, path, file_format in self._index.execute('SELECT part, path, format FROM parts')}
+        self._types = dict(tx_features.feature_schema)
+        self._cache = collections.OrderedDict()
+        self._files = {}
+        self._arrow_files = {}
+        self._groups = collections.OrderedDict()
+        self._header = None
+        self._regions = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._index.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+
+    @property
+    def columns(self):
+        """Columns of the rows returned by the lookups."""
+        if self._parts and list(self._parts.values())[0][1] == 'csv':
+            self._csv_file(0)
+            return list(self._header)
+        return tx_features.feature_columns
+
+    def lookup(self, column, values):
+        """
+        Rows with one of the values in the key column.
+        :param column: one of db_index.key_columns
+        :param values: value or list of values
+        :return: list of feature dicts, missing values are None
+        """
+        if column not in db_index.key_columns:
+            raise ValueError('Cannot look up %s, expected one of %s' % (column, ', '.join(db_index.key_columns)))
+        if isinstance(values, str):
+            values = [values]
+        rows = []
+        for value in values:
+            key = (column, value)
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                found = self._cache[key]
+            else:
+                self.misses += 1
+                found = self._read(column, value)
+                self._cache[key] = found
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            rows += [dict(row) for row in found]
+        return rows
+
+    def tx_ids(self):
+        """Iterator over the tx_id of every row."""
+        for (tx_id,) in self._index.execute('SELECT tx_id FROM rows'):
+            yield tx_id
+
+    def tx(self, tx_id):
+        """Row of a transcript, None if not found."""
+        rows = self.lookup('tx_id', tx_id)
+        return rows[0] if rows else None
+
+    def gene(self, gene_id):
+        return self.lookup('gene_id', gene_id)
+
+    def gene_name(self, gene_name):
+        return self.lookup('gene_name', gene_name)
+
+    def tx_type(self, tx_type):
+        return self.lookup('tx_type', tx_type)
+
+    def regions(self, locus):
+        """
+        Transcripts and region types overlapping a locus.
+        :param locus: 'chrom:pos' or 'chrom:start-stop'
+        :return: dict of tx_id -> list of region types
+        """
+        if self._regions is None:
+            self._regions = region_index.RegionIndex(self.out_dir)
+        return self._regions.query(locus)
+
+    def _read(self, column, value):
+        """Reads the rows matching the value from the table files."""
+        locations = self._index.execute('SELECT part, row_group, position, length, chrom FROM rows WHERE %s = ? '
+                                        'ORDER BY part, row_group, position' % column, (value,)).fetchall()
+        rows = []
+        for part, row_group, position, length, chrom in locations:
+            if self._parts[part][1] == 'csv':
+                rows.append(self._csv_row(part, position, length))
+            else:
+                row = self._arrow_row(part, row_group, position)
+                row['chrom'] = chrom
+                rows.append(row)
+        return rows
+
+    def _csv_file(self, part):
+        if part not in self._files:
+            self._files[part] = open(self._parts[part][0], 'rb')
+            self._header = next(csv.reader([self._files[part].readline().decode()]))
+        return self._files[part]
+
+    def _csv_row(self, part, position, length):
+        csv_file = self._csv_file(part)
+        csv_file.seek(position)
+        values = next(csv.reader(io.StringIO(csv_file.read(length).decode())))
+        return txfeat_writer.typed_row(dict(zip(self._header, values)), self._types)
+
+    def _arrow_row(self, part, row_group, row_number):
+        """
+        Row of a parquet or feather partition. Only the row group holding the row is read, the most recently used
+        row groups are kept.
+        """
+        key = (part, row_group)
+        if key not in self._groups:
+            path, file_format = self._parts[part]
+            import pyarrow
+            if part not in self._arrow_files:
+                if file_format == 'parquet':
+                    import pyarrow.parquet
+                    self._arrow_files[part] = pyarrow.parquet.ParquetFile(path, memory_map=True)
+                else:
+                    import pyarrow.ipc
+                    self._arrow_files[part] = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+            if file_format == 'parquet':
+                self._groups[key] = self._arrow_files[part].read_row_group(row_group)
+            else:
+                self._groups[key] = pyarrow.Table.from_batches([self._arrow_files[part].get_batch(row_group)])
+            if len(self._groups) > 16:
+                self._groups.popitem(last=False)
+        self._groups.move_to_end(key)
+        return self._groups[key].slice(row_number, 1).to_pylist()[0]
+
+    def close(self):
+        for csv_file in self._files.values():
+            csv_file.close()
+        self._files = {}
+        self._arrow_files = {}
+        self._groups.clear()
+        self._cache.clear()
+        self._index.close()
+        if self._regions is not None:
+            self._regions.close()
+
+
+def main():
+    # Setup of argparse for script arguments
+    parser = argparse.ArgumentParser(description="Look up transcripts of a txfeat_db built with build_db.",
+                                     prog="txfeature query")
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+    required.add_argument("-db", type=str, default=None, metavar="<db_dir>",
+                          help="specify output directory of build_db (-out)", required=True)
+    for column in db_index.key_columns:
+        optional.add_argument("-" + column, type=str, nargs='+', default=None, metavar="",
+                              help="return rows with the given %s(s)" % column)
+    optional.add_argument("-locus", type=str, nargs='+', default=None, metavar="",
+                          help="list transcripts and region types overlapping chrom:pos or chrom:start-stop")
+    optional.add_argument("-out", type=str, default=None, metavar="<csv_file>",
+                          help="write rows to csv file instead of the terminal")
+    optional.add_argument("--reindex", action='store_true', help="rebuild the index of the txfeat_db")
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+    queries = [(column, getattr(args, column)) for column in db_index.key_columns if getattr(args, column) is not None]
+    if args.locus is not None:
+        # loci are listed as a table of their own, not combined with the rows of other queries
+        if queries:
+            parser.error('-locus cannot be combined with %s' % ', '.join('-' + column for column, _ in queries))
+        for locus in args.locus:
+            try:
+                region_index.parse_locus(locus)
+            except ValueError as error:
+                parser.error(str(error))
+
+    if not os.path.isdir(args.db):
+        print('txfeature query: error: %s not found' % args.db)
+        return
+    if args.reindex:
+        print('Indexed %i rows.' % db_index.build_index(args.db))
+
+    with TxfeatDB(args.db) as db:
+        if args.locus is not None:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['locus', 'tx_id', 'regions'])
+            for locus in args.locus:
+                for tx_id, regions in db.regions(locus).items():
+                    writer.writerow([locus, tx_id, ';'.join(regions)])
+            return
+        if not queries:
+            print('%i transcripts in %s' % (len(db), args.db))
+            return
+        rows = []
+        for column, values in queries:
+            rows += db.lookup(column, values)
+        if args.out is not None:
+            with txfeat_writer.CsvWriter(args.out, db.columns) as writer:
+                writer.write(rows)
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(db.columns)
+            for row in rows:
+                writer.writerow(['NULL' if row.get(column) is None else row.get(column) for column in db.columns])
+
+
+if __name__ == '__main__':
+    main()
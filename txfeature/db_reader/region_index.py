@@ -0,0 +1,192 @@
+"""
+Genome-wide interval index of the transcript regions of a built txfeat_db. The exon, CDS, UTR and codon blocks of all
+transcripts are stored in a SQLite database next to the table (<out>/txfeat_db/_regions.sqlite) together with their
+UCSC bin, so a query for chr:pos or chr:start-end only compares the blocks of the few bins that can overlap it instead
+of all blocks of the chromosome. Exon blocks also record the strand and the transcript coordinate of their 5' base so
+positions can be converted to transcript-relative offsets (see annotate).
+"""
+
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+from txfeature.db_builder import txfeat_functions
+
+region_file = '_regions.sqlite'
+
+# UCSC binning scheme, bins of 128 kb at the lowest level and 8 times larger bins on each of the 4 levels above,
+# offsets of the first bin of each level from the lowest level up
+_bin_first_shift = 17
+_bin_next_shift = 3
+_bin_offsets = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+
+
+def region_path(out_dir):
+    return os.path.join(out_dir, 'txfeat_db', region_file)
+
+
+def ucsc_bins(starts, stops):
+    """
+    Smallest UCSC bin fully containing each block, blocks beyond the 512 Mb covered by the scheme are placed in bin 0
+    which is searched by every query.
+    :param starts: array of 1-based start coordinates (inclusive)
+    :param stops: array of 1-based stop coordinates (inclusive)
+    :return: array of bins
+    """
+    start_bins = (np.asarray(starts, dtype=np.int64) - 1) >> _bin_first_shift
+    stop_bins = (np.asarray(stops, dtype=np.int64) - 1) >> _bin_first_shift
+    bins = np.full(len(start_bins), -1, dtype=np.int64)
+    for offset in _bin_offsets:
+        fits = (bins < 0) & (start_bins == stop_bins)
+        bins[fits] = offset + start_bins[fits]
+        start_bins = start_bins >> _bin_next_shift
+        stop_bins = stop_bins >> _bin_next_shift
+    bins[bins < 0] = 0
+    return bins
+
+
+def overlapping_bins(start, stop):
+    """
+    All UCSC bins that may hold blocks overlapping a region, at most a handful per level.
+    :param start: 1-based start coordinate (inclusive)
+    :param stop: 1-based stop coordinate (inclusive)
+    """
+    start_bin = (start - 1) >> _bin_first_shift
+    stop_bin = (stop - 1) >> _bin_first_shift
+    bins = set()
+    for offset in _bin_offsets:
+        bins.update(range(offset + start_bin, offset + stop_bin + 1))
+        start_bin >>= _bin_next_shift
+        stop_bin >>= _bin_next_shift
+    bins.add(0)
+    return sorted(bins)
+
+
+def parse_locus(locus):
+    """
+    :param locus: 'chrom:pos' or 'chrom:start-stop', thousands separators are ignored
+    :return: (chrom, start, stop)
+    """
+    chrom, _, coords = locus.rpartition(':')
+    coords = coords.replace(',', '').split('-')
+    if not chrom or len(coords) > 2 or not all(coord.isdigit() for coord in coords):
+        raise ValueError('Invalid locus %s, expected chrom:pos or chrom:start-stop' % locus)
+    start = int(coords[0])
+    stop = int(coords[-1])
+    return chrom, min(start, stop), max(start, stop)
+
+
+def exon_offsets(tx_of_feature, features, starts, stops):
+    """
+    Transcript coordinate of the 5' base of every exon, exons are concatenated in exon_number order as in
+    tx_build.build.
+    :param tx_of_feature: array of the transcript index of each feature
+    :param features: feature table of a FeatureStore
+    :param starts: array of the lower coordinate of each feature
+    :param stops: array of the upper coordinate of each feature
+    :return: array of 1-based transcript coordinates aligned with features, 0 for features other than exons
+    """
+    offsets = np.zeros(len(features), dtype=np.int64)
+    exons = np.flatnonzero(features['ftype'] == txfeat_functions.tx_feature_types.index('exon'))
+    if len(exons) == 0:
+        return offsets
+    exons = exons[np.lexsort((features['exon_number'][exons], tx_of_feature[exons]))]
+    lengths = stops[exons] - starts[exons] + 1
+    preceding = np.cumsum(lengths) - lengths
+    # exonic length of the preceding transcripts is subtracted at the first exon of each transcript
+    first = np.flatnonzero(np.concatenate(([True], tx_of_feature[exons][1:] != tx_of_feature[exons][:-1])))
+    group_sizes = np.diff(np.append(first, len(exons)))
+    offsets[exons] = preceding - np.repeat(preceding[first], group_sizes) + 1
+    return offsets
+
+
+def build_region_index(out_dir, store):
+    """
+    Creates the region index from the annotation of a build, replacing an existing index.
+    :param out_dir: output directory of the build (-out)
+    :param store: FeatureStore holding the parsed gff file
+    :return: number of indexed blocks
+    """
+    logger = logging.getLogger(__name__ + '.build_region_index')
+    path = region_path(out_dir)
+    transcripts = store.transcripts
+    features = store.features
+    tx_of_feature = np.repeat(np.arange(len(transcripts)), transcripts['feat_stop'] - transcripts['feat_start'])
+    starts = np.minimum(features['start'], features['stop'])
+    stops = np.maximum(features['start'], features['stop'])
+    bins = ucsc_bins(starts, stops)
+    chroms = [value.decode() for value in store.strings['chrom']]
+    strands = [value.decode() for value in transcripts['strand'][tx_of_feature]]
+    tx_offsets = exon_offsets(tx_of_feature, features, starts, stops)
+
+    # written to a temporary file first so readers never see a partial index
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    db = sqlite3.connect(path + '.tmp')
+    with db:
+        db.execute('CREATE TABLE blocks (chrom TEXT NOT NULL, bin INTEGER NOT NULL, start INTEGER NOT NULL, '
+                   'stop INTEGER NOT NULL, tx_id TEXT NOT NULL, region TEXT NOT NULL, strand TEXT NOT NULL, '
+                   'tx_offset INTEGER)')
+        for i in range(0, len(features), 100000):
+            selected = slice(i, i + 100000)
+            db.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(chroms[transcripts['chrom'][tx_index]], block_bin, start, stop, store.tx_id(tx_index),
+                             txfeat_functions.tx_feature_types[ftype], strand, tx_offset if tx_offset > 0 else None)
+                            for tx_index, block_bin, start, stop, ftype, strand, tx_offset
+                            in zip(tx_of_feature[selected].tolist(), bins[selected].tolist(),
+                                   starts[selected].tolist(), stops[selected].tolist(),
+                                   features['ftype'][selected].tolist(), strands[selected],
+                                   tx_offsets[selected].tolist())])
+        db.execute('CREATE INDEX blocks_bin ON blocks (chrom, bin)')
+    db.close()
+    os.replace(path + '.tmp', path)
+    logger.debug('Indexed %i transcript region blocks of %s' % (len(features), out_dir))
+    return len(features)
+
+
+class RegionIndex:
+    """
+    Coordinate queries against the region index of a build.
+    :param out_dir: output directory of the build (-out)
+    """
+
+    def __init__(self, out_dir):
+        path = region_path(out_dir)
+        if not os.path.isfile(path):
+            raise IOError('%s not found, the region index is written by build_db' % path)
+        self._db = sqlite3.connect(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def blocks(self, chrom, start, stop):
+        """
+        Region blocks overlapping a genomic region.
+        :param start: 1-based start coordinate (inclusive)
+        :param stop: 1-based stop coordinate (inclusive)
+        :return: list of (tx_id, region type, block start, block stop) sorted by transcript and block
+        """
+        bins = overlapping_bins(start, stop)
+        return self._db.execute('SELECT tx_id, region, start, stop FROM blocks WHERE chrom = ? AND bin IN (%s) '
+                                'AND start <= ? AND stop >= ? ORDER BY tx_id, start, region'
+                                % ','.join('?' * len(bins)), [chrom] + bins + [stop, start]).fetchall()
+
+    def query(self, locus):
+        """
+        Transcripts and region types overlapping a locus, the genome-wide counterpart of TxRead.coord_to_region.
+        :param locus: 'chrom:pos' or 'chrom:start-stop'
+        :return: dict of tx_id -> list of region types
+        """
+        regions = {}
+        for tx_id, region, _, _ in self.blocks(*parse_locus(locus)):
+            if region not in regions.setdefault(tx_id, []):
+                regions[tx_id].append(region)
+        return regions
+
+    def close(self):
+        self._db.close()
@@ -6,6 +6,9 @@
 import sys
 import shutil
 import db_builder.db_builder as db_build
+import db_builder.fold_cache as fold_cache
+import db_reader.db_reader as db_read
+import db_reader.annotate as annotate
 import txfeature.env_variables
 
 help_text_txfeat = """txfeature v1.0
@@ -16,9 +19,12 @@ usage: txfeature <mode|command> [options] [-h]
 
 modes:
 build_db          pipeline to construct transcript feature database
+query             look up transcripts of a constructed database by tx_id, gene_id, gene_name or tx_type
+annotate          annotate genomic positions with the transcript regions of a constructed database
 
 commands:
 build_db_config   output configuration file to working directory to modify build settings
+fold_cache        inspect or prune the fold energy cache shared between builds
 
 Note: Further [options] for mode can be obtained by <mode> --help."""
 
@@ -29,6 +35,14 @@ if __name__ == '__main__':
         sys.argv = sys.argv[1:]
         db_build.main()
 
+    elif sys.argv[1] == 'query':
+        sys.argv = sys.argv[1:]
+        db_read.main()
+
+    elif sys.argv[1] == 'annotate':
+        sys.argv = sys.argv[1:]
+        annotate.main()
+
     elif sys.argv[1] == 'build_check':
         sys.argv =['build_db', '-gff', txfeature.env_variables.test_path + 'test_data/test_set_500.gff3', '-fa',
                    txfeature.env_variables.test_path + '/test_data/GRCm38.primary_assembly.genome.fa', '-out', 'test/']
@@ -38,6 +52,10 @@ if __name__ == '__main__':
         cfg = txfeature.env_variables.db_builder_path + 'build_db.cfg'
         shutil.copyfile(cfg, './build_db.cfg')
 
+    elif sys.argv[1] == 'fold_cache':
+        sys.argv = sys.argv[1:]
+        fold_cache.main()
+
     elif sys.argv[1] == '-h' or sys.argv[1] == '--help':
         print(help_text_txfeat)
 